@@ -18,32 +18,109 @@ def regen_datasvc(settings, job_id):
     root = elita.dataservice.root_tree.RootTree(db, updater, tree, None)
     return client, elita.dataservice.DataService(settings, db, root, job_id=job_id)
 
+# job_type -> celery queue. Anything not listed here goes to the shared job queue, where messages are consumed in
+# priority order (see JOB_PRIORITIES). Builds get their own queue so long uploads can't hold up deployments. Queues are
+# declared in celeryconfig; dedicated workers can be started per queue with "celery worker -Q <queue>"
+JOB_QUEUES = {
+    'build': 'elita_build'
+}
+DEFAULT_JOB_QUEUE = 'elita_jobs'
+
+# job_type -> message priority within the shared job queue (higher is more urgent)
+JOB_PRIORITIES = {
+    'deployment': 9,
+    'gitdeploy': 5
+}
+DEFAULT_JOB_PRIORITY = 0
+
+# seconds to wait before retrying a job that was held back by a concurrency limit
+CONCURRENCY_RETRY_COUNTDOWN = 5
+# seconds a job waits for a concurrency slot before it's failed (elita.jobs.max_queue_wait)
+DEFAULT_MAX_QUEUE_WAIT = 3600
+
+
+def get_job_routing(settings, job_type):
+    '''
+    Return (queue, priority) for job_type. Can be overridden in the ini via elita.jobs.queue.<job_type> and
+    elita.jobs.priority.<job_type>
+    '''
+    queue = settings.get('elita.jobs.queue.{}'.format(job_type), JOB_QUEUES.get(job_type, DEFAULT_JOB_QUEUE))
+    priority = int(settings.get('elita.jobs.priority.{}'.format(job_type),
+                                JOB_PRIORITIES.get(job_type, DEFAULT_JOB_PRIORITY)))
+    return queue, priority
+
+
+def get_concurrency_limits(settings, job_type, application):
+    '''
+    Return (type_limit, app_limit) for a job. Zero (the default) means unlimited.
+
+    elita.jobs.concurrency.<job_type>: maximum simultaneously running jobs of that type
+    elita.jobs.app_concurrency: maximum simultaneously running jobs per application
+    elita.jobs.app_concurrency.<app_name>: per-application override of the above
+    '''
+    type_limit = int(settings.get('elita.jobs.concurrency.{}'.format(job_type), 0))
+    app_limit = int(settings.get('elita.jobs.app_concurrency', 0))
+    if application:
+        app_limit = int(settings.get('elita.jobs.app_concurrency.{}'.format(application), app_limit))
+    return type_limit, app_limit
+
+
 @elita.celeryinit.celery.task(bind=True, name="elita_task_run_job")
-def run_job(self, settings, callable, args):
+def run_job(self, settings, callable, args, job_type=None, application=None):
     ''' Generate new dataservice, run callable, store results
     '''
     job_id = self.request.id
     client, datasvc = regen_datasvc(settings, job_id)
+    type_limit, app_limit = get_concurrency_limits(settings, job_type, application)
+    if not datasvc.jobsvc.StartJob(type_limit=type_limit, app_limit=app_limit):
+        max_retries = int(settings.get('elita.jobs.max_queue_wait', DEFAULT_MAX_QUEUE_WAIT)) / \
+            CONCURRENCY_RETRY_COUNTDOWN
+        if self.request.retries >= max_retries:
+            datasvc.jobsvc.SaveJobResults({"error": "gave up waiting for a concurrency slot after {} seconds"
+                                                    .format(max_retries * CONCURRENCY_RETRY_COUNTDOWN)})
+            client.close()
+            return
+        client.close()
+        raise self.retry(countdown=CONCURRENCY_RETRY_COUNTDOWN, max_retries=max_retries)
     try:
-        results = callable(datasvc, **args)
-    except:
-        exc_type, exc_obj, tb = sys.exc_info()
-        f_exc = traceback.format_exception(exc_type, exc_obj, tb)
-        results = {
-            "error": "unhandled exception during callable!",
-            "exception": f_exc
-        }
-        logging.debug("EXCEPTION: {}".format(f_exc))
-    datasvc.jobsvc.SaveJobResults(results if results else {"status": "job returned no data"})
-    client.close()
+        try:
+            results = callable(datasvc, **args)
+        except:
+            exc_type, exc_obj, tb = sys.exc_info()
+            f_exc = traceback.format_exception(exc_type, exc_obj, tb)
+            results = {
+                "error": "unhandled exception during callable!",
+                "exception": f_exc
+            }
+            logging.debug("EXCEPTION: {}".format(f_exc))
+        datasvc.jobsvc.SaveJobResults(results if results else {"status": "job returned no data"})
+    finally:
+        datasvc.jobsvc.ReleaseJobSlots()
+        client.close()
+
+def submit_job(datasvc, name, job_type, data, callable, args, application=None):
+    '''
+    Create job object and enqueue it on the celery queue for its job_type. Returns job_id
+    '''
+    queue, priority = get_job_routing(datasvc.settings, job_type)
+    job = datasvc.jobsvc.NewJob(name, job_type, data, application=application, queue=queue, priority=priority)
+    job_id = str(job.job_id)
+    run_job.apply_async((datasvc.settings, callable, args), {'job_type': job_type, 'application': application},
+                        task_id=job_id, queue=queue, priority=priority)
+    return job_id
+
+def cancel_job(datasvc, job_id, reason):
+    '''
+    Stop a queued or running job: revoke its celery task (terminating the worker process if it already started, so
+    its finally blocks don't run) and mark it failed with reason. Safe to call for jobs whose worker has died
+    '''
+    elita.celeryinit.celery.control.revoke(job_id, terminate=True)
+    datasvc.jobsvc.CancelJob(job_id, reason)
 
 #generic interface to run code async (not explicit named actions/hooks)
-def run_async(datasvc, name, job_type, data, callable, args):
+def run_async(datasvc, name, job_type, data, callable, args, application=None):
     logging.debug("run_async: create new async task: {}; args: {}".format(callable, args))
-    job = datasvc.jobsvc.NewJob(name, job_type, data)
-    job_id = str(job.job_id)
-    run_job.apply_async((datasvc.settings, callable, args), task_id=job_id)
-    return job_id
+    return submit_job(datasvc, name, job_type, data, callable, args, application=application)
 
 class ActionService:
     __metaclass__ = elita.util.LoggingMetaClass
@@ -63,12 +140,10 @@ class ActionService:
 
     def async(self, app, action_name, params):
         action = self.actions.actionmap[app][action_name]['callable']
-        job = self.datasvc.jobsvc.NewJob("{}.{}".format(app, action_name), "Action", {
+        job_id = submit_job(self.datasvc, "{}.{}".format(app, action_name), "Action", {
             "application": app,
             "params": params
-        })
-        job_id = str(job.job_id)
-        run_job.apply_async((self.datasvc.settings, action, {'params': params}), task_id=job_id)
+        }, action, {'params': params}, application=app)
         return {"action": action_name, "job_id": job_id, "status": "async/running"}
 
 
@@ -1,6 +1,7 @@
 __author__ = 'bkeroack'
 
 import os
+import sys
 import shutil
 import requests
 import zipfile
@@ -64,6 +65,15 @@ def store_uploaded_build(datasvc, app, build, file_type, temp_file, package_map)
         for pkg in packages:
             build_doc['packages'][pkg] = packages[pkg]
 
+    # manifests are computed here (once per package) so deployment plans never have to read the archives
+    datasvc.jobsvc.NewJobData({'status': 'computing package manifests'})
+    for k in build_doc['packages']:
+        try:
+            build_doc['packages'][k]['manifest'] = BuildFile(build_doc['packages'][k]).get_manifest()
+        except:
+            logging.warning("store_uploaded_build: could not compute manifest for package {}: {}"
+                            .format(k, sys.exc_info()[1]))
+
     for k in build_doc['packages']:
         fname = build_doc['packages'][k]['filename']
         ftype = build_doc['packages'][k]['file_type']
@@ -204,6 +214,24 @@ class BuildFile:
         with zipfile.ZipFile(self.filename, 'r') as zf:
             zf.extractall(target_path)
 
+    def get_manifest(self):
+        '''
+        List the regular files in the package without extracting it. Returns sorted list of [ path, signature ] pairs.
+        Signature is CRC/size for zips and size/mtime for tarballs, so it can be compared across builds to detect
+        modified files.
+        '''
+        if self.file_type == SupportedFileType.Zip:
+            with zipfile.ZipFile(self.filename, 'r') as zf:
+                manifest = [[i.filename, "{:08x}:{}".format(i.CRC, i.file_size)] for i in zf.infolist()
+                            if not i.filename.endswith('/')]
+        elif self.file_type in (SupportedFileType.TarGz, SupportedFileType.TarBz2):
+            ext = 'gz' if self.file_type == SupportedFileType.TarGz else 'bz2'
+            with tarfile.open(name=self.filename, mode='r:{}'.format(ext)) as tf:
+                manifest = [[m.name, "{}:{}".format(m.size, m.mtime)] for m in tf.getmembers() if m.isfile()]
+        else:
+            raise BuildError
+        return sorted(manifest)
+
 
 def _threadsafe_apply_package(output_dir, package_name, package, target_type, cwd, q):
     '''
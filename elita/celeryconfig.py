@@ -1,6 +1,16 @@
+from kombu import Queue
+
 BROKER_URL = 'amqp://localhost'
 CELERY_RESULT_BACKEND = 'amqp://'
 
 CELERY_TASK_SERIALIZER = 'pickle'
 #CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['pickle', 'json']
+
+# job queues (see elita.actions.action.JOB_QUEUES). A worker started without -Q consumes all of them.
+# elita_jobs is shared by every job type except builds so that job priorities (JOB_PRIORITIES) compete with each other
+CELERY_QUEUES = (
+    Queue('celery', routing_key='celery'),
+    Queue('elita_jobs', routing_key='elita_jobs', queue_arguments={'x-max-priority': 10}),
+    Queue('elita_build', routing_key='elita_build'),
+)
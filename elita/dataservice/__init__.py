@@ -4,18 +4,23 @@ import logging
 import os
 import shutil
 import bson
+import pymongo.errors
 import datetime
 import pytz
-import copy
 import sys
 import jsonpatch
+import json
+import zlib
+import uuid
 import traceback
 
 import elita.util
 import elita.elita_exceptions
+import elita.builds
 import models
 from root_tree import RootTree
 from mongo_service import MongoService
+from progress import ProgressAggregator
 from elita.deployment.gitservice import EMBEDDED_YAML_DOT_REPLACEMENT
 from elita.actions.action import ActionService
 from elita.deployment import deploy, salt_control
@@ -239,6 +244,22 @@ class BuildDataService(GenericChildDataService):
         doc['created_datetime'] = doc['_id'].generation_time
         return {k: doc[k] for k in doc if k[0] != '_'}
 
+    def GetPackageManifest(self, app_name, build_name, package):
+        '''
+        Get list of [ path, signature ] for every file in a build package. Manifests are computed when the build is
+        uploaded (see elita.builds.store_uploaded_build); this only reads the build document.
+
+        Returns None if the build doesn't have the package or it has no manifest (ex: uploaded before manifests were
+        recorded)
+        '''
+        assert elita.util.type_check.is_string(app_name)
+        assert elita.util.type_check.is_string(build_name)
+        assert elita.util.type_check.is_string(package)
+        build_doc = self.GetBuild(app_name, build_name)
+        if package not in build_doc['packages']:
+            return None
+        return build_doc['packages'][package].get('manifest')
+
 
 class UserDataService(GenericChildDataService):
 
@@ -711,6 +732,16 @@ class GroupDataService(GenericChildDataService):
                 return False
         return True
 
+JOB_STATUSES = ('queued', 'running', 'completed', 'failed')
+DEFAULT_RESULTS_COMPRESS_THRESHOLD = 1024*1024
+DEFAULT_RESULTS_MAX_SIZE = 8*1024*1024
+DEFAULT_JOB_LIST_LIMIT = 50      # jobs returned by a job listing unless a limit is given
+RESULTS_PREVIEW_SIZE = 4096       # bytes of serialized results kept when results are too large to store
+DEFAULT_JOB_COUNTER_WINDOW = 24*3600     # seconds of finished jobs included in job counters (elita.jobs.counter_window)
+DEFAULT_JOB_SLOT_TTL = 6*3600     # seconds after which a concurrency slot is considered stale (elita.jobs.slot_ttl)
+JOB_SUMMARY_FIELDS = ['job_id', 'name', 'job_type', 'application', 'status', 'started_datetime', 'completed_datetime',
+                      'duration_in_seconds']
+
 class JobDataService(GenericChildDataService):
     def GetAllActions(self, app_name):
         '''
@@ -732,18 +763,24 @@ class JobDataService(GenericChildDataService):
         actions = self.deps['ActionService'].get_action_details(app_name, action_name)
         return {k: actions[k] for k in actions if k is not "callable"}
 
-    def NewJob(self, name, job_type, data):
+    def NewJob(self, name, job_type, data, application=None, queue=None, priority=None):
         '''
-        Create new job object.
+        Create new job object. Jobs start out 'queued' and are marked 'running' by StartJob once a worker picks them up.
 
         data parameter can be anything serializable (including None) so that's all we will check for
         '''
         assert name and job_type
         assert elita.util.type_check.is_serializable(data)
+        assert elita.util.type_check.is_optional_str(application)
+        assert elita.util.type_check.is_optional_str(queue)
+        assert priority is None or isinstance(priority, int)
         job = models.Job({
-            'status': "running",
+            'status': "queued",
             'name': name,
             'job_type': job_type,
+            'application': application,
+            'queue': queue,
+            'priority': priority,
             'data': data,
             'attributes': {
                 'name': name
@@ -754,6 +791,120 @@ class JobDataService(GenericChildDataService):
         self.AddThreadLocalRootTree(('job', str(job.job_id)))
         return job
 
+    def StartJob(self, type_limit=0, app_limit=0):
+        '''
+        Called by the async worker before running the job callable. Enforces concurrency caps (zero means unlimited)
+        by atomically claiming a slot in the job_slots document for the job_type (and the application): a slot can only
+        be claimed while fewer than limit jobs hold one, so concurrent workers can't both take the last slot. If a cap
+        is reached the job is left queued and False is returned so the caller can requeue it.
+
+        Slots are released by ReleaseJobSlots when the job finishes. Slots held longer than elita.jobs.slot_ttl
+        seconds (ex: the worker running the job died) are considered stale and dropped.
+
+        Otherwise mark job as running, record how long it waited in the queue and return True.
+        '''
+        assert self.job_id
+        assert isinstance(type_limit, int) and isinstance(app_limit, int)
+        doc = self.mongo_service.get('jobs', {'job_id': self.job_id})
+        assert doc and elita.util.type_check.is_dictlike(doc) and '_id' in doc
+        now = datetime.datetime.now(tz=pytz.utc)
+        slots = list()
+        if type_limit > 0:
+            slots.append(("job_type.{}".format(doc['job_type']), type_limit))
+        if app_limit > 0 and doc.get('application'):
+            slots.append(("application.{}".format(doc['application']), app_limit))
+        for name, limit in slots:
+            if not self.ClaimJobSlot(name, limit, now):
+                logging.debug("StartJob: concurrency limit reached ({}: {})".format(name, limit))
+                self.ReleaseJobSlots()
+                return False
+        self.job_created_datetime = doc['_id'].generation_time
+        self.mongo_service.modify_multi('jobs', {'job_id': self.job_id}, {
+            ('status',): "running",
+            ('started_datetime',): now,
+            ('wait_in_seconds',): (now - self.job_created_datetime).total_seconds()
+        })
+        return True
+
+    def ClaimJobSlot(self, name, limit, now):
+        '''
+        Atomically add this job to the holders of slot name if fewer than limit jobs hold it. Stale holders are
+        dropped first. Returns True if the slot was claimed (or is already held by this job)
+        '''
+        assert self.job_id
+        assert elita.util.type_check.is_string(name)
+        assert isinstance(limit, int) and limit > 0
+        ttl = int(self.settings.get('elita.jobs.slot_ttl', DEFAULT_JOB_SLOT_TTL))
+        try:
+            self.mongo_service.update('job_slots', {'name': name}, {
+                '$pull': {'holders': {'started_datetime': {'$lt': now - datetime.timedelta(seconds=ttl)}}}
+            }, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            pass    # another worker created the slot document at the same time
+        if self.mongo_service.count('job_slots', {'name': name, 'holders.job_id': self.job_id}):
+            return True
+        # holders.<limit-1> only exists if the slot already has limit holders
+        return self.mongo_service.find_and_modify('job_slots', {
+            'name': name,
+            'holders.{}'.format(limit - 1): {'$exists': False}
+        }, {'$push': {'holders': {'job_id': self.job_id, 'started_datetime': now}}}) is not None
+
+    def ReleaseJobSlots(self):
+        '''
+        Release any concurrency slots held by this job. Called when the job finishes (or fails to start)
+        '''
+        assert self.job_id
+        self.mongo_service.update('job_slots', {'holders.job_id': self.job_id},
+                                  {'$pull': {'holders': {'job_id': self.job_id}}}, multi=True)
+
+    def CancelJob(self, job_id, reason):
+        '''
+        Mark another job as failed (see elita.actions.action.cancel_job) and release its concurrency slots. Jobs that
+        already finished are left alone
+        '''
+        assert job_id and reason
+        assert elita.util.type_check.is_string(job_id)
+        now = datetime.datetime.now(tz=pytz.utc)
+        self.mongo_service.update('jobs', {'job_id': job_id, 'status': {'$in': ['queued', 'running']}}, {
+            '$set': {'status': "failed", 'completed_datetime': now, 'cancel_reason': reason}
+        })
+        self.mongo_service.update('job_slots', {'holders.job_id': job_id}, {'$pull': {'holders': {'job_id': job_id}}},
+                                  multi=True)
+
+    def GetQueueStats(self, sample_size=100):
+        '''
+        Get queue depth and wait times per job_type. Depth is the number of jobs still waiting for a worker; oldest_wait
+        is how long the oldest of those has been waiting and average_wait is the mean queue time of the last sample_size
+        jobs of that type that were started.
+        '''
+        assert isinstance(sample_size, int) and sample_size > 0
+        now = datetime.datetime.now(tz=pytz.utc)
+        stats = dict()
+        for d in self.mongo_service.get('jobs', {'status': {'$in': ['queued', 'running']}}, multi=True, empty=True,
+                                        fields=['job_type', 'status', 'queue']):
+            jt = d['job_type']
+            if jt not in stats:
+                stats[jt] = {
+                    'queue': d.get('queue'),
+                    'depth': 0,
+                    'running': 0,
+                    'oldest_wait_in_seconds': 0,
+                    'average_wait_in_seconds': None
+                }
+            if d['status'] == 'running':
+                stats[jt]['running'] += 1
+            else:
+                stats[jt]['depth'] += 1
+                stats[jt]['oldest_wait_in_seconds'] = max(stats[jt]['oldest_wait_in_seconds'],
+                                                          (now - d['_id'].generation_time).total_seconds())
+        for jt in stats:
+            waits = [d['wait_in_seconds'] for d in
+                     self.mongo_service.get('jobs', {'job_type': jt, 'wait_in_seconds': {'$ne': None}}, multi=True,
+                                            empty=True, fields=['wait_in_seconds'],
+                                            sort=[('started_datetime', -1)], limit=sample_size)]
+            stats[jt]['average_wait_in_seconds'] = sum(waits)/len(waits) if waits else None
+        return stats
+
     def NewJobData(self, data):
         '''
         Insert new job_data record. Called by async jobs to log progress. Data inserted here can be viewed by user
@@ -764,45 +915,178 @@ class JobDataService(GenericChildDataService):
         assert data
         assert elita.util.type_check.is_serializable(data)
         assert self.job_id
-        elita.util.change_dict_keys(data, '.', '_')
         self.mongo_service.create_new('job_data', {}, None, {
             'job_id': self.job_id,
-            'data': data
+            'data': elita.util.replace_dict_keys(data, '.', '_')
         }, remove_existing=False)
 
-    def GetJobs(self, active):
+    def AddSaltJob(self, jid, cmd, minions, timeout):
+        '''
+        Record a salt job published by this job (see SaltController.submit_job) so that its returns can be collected
+        later and users can see which salt jobs the elita job is waiting on
+        '''
+        assert jid and cmd
+        assert elita.util.type_check.is_string(jid)
+        assert elita.util.type_check.is_seq(minions)
+        assert self.job_id
+        self.mongo_service.modify_multi('jobs', {'job_id': self.job_id}, {
+            ('salt_jobs', jid): {
+                'cmd': cmd,
+                'minions': list(minions),
+                'timeout': timeout,
+                'submitted_datetime': datetime.datetime.now(tz=pytz.utc),
+                'returned': 0,
+                'status': 'running'
+            }
+        })
+
+    def UpdateSaltJob(self, jid, returned, status):
         '''
-        Get all actively running jobs. Pulling from mongo could possibly be more efficient (maybe) than using
-        in-memory root_tree because we're querying on the status field
+        Update number of minions that have returned and the status (running | complete | timeout) of a salt job
         '''
-        return [d['job_id'] for d in self.mongo_service.get('jobs', {'status': 'running'}, multi=True)]
+        assert jid and status
+        assert elita.util.type_check.is_string(jid)
+        assert isinstance(returned, int)
+        assert status in ('running', 'complete', 'timeout')
+        assert self.job_id
+        self.mongo_service.modify_multi('jobs', {'job_id': self.job_id}, {
+            ('salt_jobs', jid, 'returned'): returned,
+            ('salt_jobs', jid, 'status'): status
+        })
+
+    def GetSaltJobs(self, job_id=None, status=None):
+        '''
+        Get salt jobs recorded for a job (default: this job): { jid: { 'cmd', 'minions', 'timeout', 'status', ... } },
+        optionally only those with a particular status
+        '''
+        job_id = job_id if job_id else self.job_id
+        assert job_id
+        assert elita.util.type_check.is_optional_str(status)
+        docs = self.mongo_service.get('jobs', {'job_id': job_id}, multi=True, empty=True, fields=['salt_jobs'])
+        salt_jobs = docs[0].get('salt_jobs') if docs and docs[0].get('salt_jobs') else dict()
+        return {jid: salt_jobs[jid] for jid in salt_jobs if status is None or salt_jobs[jid]['status'] == status}
+
+    def GetJobs(self, active=False, status=None, job_type=None, application=None, skip=0, limit=0, summary=False):
+        '''
+        Get jobs (newest first), optionally filtered by status (list), job_type and application. If active, only queued
+        or running jobs are returned (status is ignored). Served from the indexed jobs collection rather than the
+        root_tree. skip/limit are for pagination (limit of zero means no limit).
+
+        If summary, return a list of dicts (job_id, name, job_type, application, status, created/started datetimes and
+        duration) instead of bare job_ids.
+        '''
+        assert elita.util.type_check.is_optional_seq(status)
+        assert elita.util.type_check.is_optional_str(job_type)
+        assert elita.util.type_check.is_optional_str(application)
+        assert isinstance(skip, int) and isinstance(limit, int) and skip >= 0 and limit >= 0
+        keys = self._get_jobs_query(active, status, job_type, application)
+        fields = JOB_SUMMARY_FIELDS if summary else ['job_id']
+        docs = self.mongo_service.get('jobs', keys, multi=True, empty=True, fields=fields, sort=[('_id', -1)],
+                                      skip=skip, limit=limit)
+        if not summary:
+            return [d['job_id'] for d in docs]
+        for d in docs:
+            d['created_datetime'] = d['_id'].generation_time
+            del d['_id']
+        return docs
+
+    def GetJobCount(self, active=False, status=None, job_type=None, application=None):
+        '''
+        Get total number of jobs matching the same filters as GetJobs (for pagination)
+        '''
+        return self.mongo_service.count('jobs', self._get_jobs_query(active, status, job_type, application))
+
+    def GetJobCounters(self):
+        '''
+        Get aggregate job counters per job_type: { job_type: { 'queued': n, 'running': n, 'completed': n, 'failed': n } }
+        Completed/failed jobs are only counted if they finished within the last elita.jobs.counter_window seconds, so
+        the aggregation only touches active and recent jobs (both indexed) regardless of job history size.
+        '''
+        window = int(self.settings.get('elita.jobs.counter_window', DEFAULT_JOB_COUNTER_WINDOW))
+        cutoff = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(seconds=window)
+        counters = dict()
+        for r in self.mongo_service.aggregate('jobs', [
+            {'$match': {'$or': [{'status': {'$in': ['queued', 'running']}}, {'completed_datetime': {'$gte': cutoff}}]}},
+            {'$group': {'_id': {'job_type': '$job_type', 'status': '$status'}, 'count': {'$sum': 1}}}
+        ]):
+            jt = r['_id'].get('job_type')
+            if jt not in counters:
+                counters[jt] = {s: 0 for s in JOB_STATUSES}
+            counters[jt][r['_id'].get('status')] = r['count']
+        return counters
+
+    def _get_jobs_query(self, active, status, job_type, application):
+        keys = dict()
+        if active:
+            keys['status'] = {'$in': ['queued', 'running']}
+        elif status:
+            keys['status'] = {'$in': list(status)}
+        if job_type:
+            keys['job_type'] = job_type
+        if application:
+            keys['application'] = application
+        return keys
 
     def GetJobData(self, job_id):
         '''
-        Get job data for a specific job sorted by created_datetime (ascending)
+        Get job data for a specific job sorted by created_datetime (ascending). Compressed results are decompressed.
         '''
         assert job_id
         assert elita.util.type_check.is_string(job_id)
-        return sorted([{'created_datetime': d['_id'].generation_time.isoformat(' '), 'data': d['data']} for
+        return sorted([{'created_datetime': d['_id'].generation_time.isoformat(' '),
+                        'data': self._decompress_job_data(d) if 'compressed_data' in d else d['data']} for
                        d in self.mongo_service.get('job_data', {'job_id': job_id}, multi=True, empty=True)],
                       key=lambda k: k['created_datetime'])
 
+    def _decompress_job_data(self, doc):
+        return json.loads(zlib.decompress(doc['compressed_data']))
+
     def SaveJobResults(self, results):
         '''
-        Called at the end of async jobs. Changes state of job object to reflect job completion.
+        Called at the end of async jobs. Changes state of job object to reflect job completion (one atomic update) and
+        writes the results as job data.
+
+        Results that serialize to more than elita.jobs.results_compress_threshold bytes are stored zlib-compressed (no
+        key sanitization needed). If the compressed results are still larger than elita.jobs.results_max_size they are
+        replaced with a truncated preview (the first RESULTS_PREVIEW_SIZE bytes of the serialized results).
+
+        The job is marked failed if results has an 'error' key. Results must be serializable; this is checked before
+        the job status is changed.
         '''
         assert self.job_id
-        assert elita.util.type_check.is_serializable(results)
+        serialized = json.dumps({"completed_results": results})    # also validates results are serializable
         now = datetime.datetime.now(tz=pytz.utc)
-        doc = self.mongo_service.get('jobs', {'job_id': self.job_id})
-        assert doc and elita.util.type_check.is_dictlike(doc) and '_id' in doc
-        results_sanitized = copy.deepcopy(results)
-        elita.util.change_dict_keys(results_sanitized, '.', '_')
-        diff = (now - doc['_id'].generation_time).total_seconds()
-        self.mongo_service.modify('jobs', {'job_id': self.job_id}, ('status',), "completed")
-        self.mongo_service.modify('jobs', {'job_id': self.job_id}, ('completed_datetime',), now)
-        self.mongo_service.modify('jobs', {'job_id': self.job_id}, ('duration_in_seconds',), diff)
-        self.NewJobData({"completed_results": results_sanitized})
+        if not hasattr(self, 'job_created_datetime'):
+            doc = self.mongo_service.get('jobs', {'job_id': self.job_id})
+            assert doc and elita.util.type_check.is_dictlike(doc) and '_id' in doc
+            self.job_created_datetime = doc['_id'].generation_time
+        failed = elita.util.type_check.is_dictlike(results) and 'error' in results
+        self.mongo_service.modify_multi('jobs', {'job_id': self.job_id}, {
+            ('status',): "failed" if failed else "completed",
+            ('completed_datetime',): now,
+            ('duration_in_seconds',): (now - self.job_created_datetime).total_seconds()
+        })
+        compress_threshold = int(self.settings.get('elita.jobs.results_compress_threshold',
+                                                   DEFAULT_RESULTS_COMPRESS_THRESHOLD))
+        if len(serialized) <= compress_threshold:
+            self.NewJobData({"completed_results": results})
+            return
+        max_size = int(self.settings.get('elita.jobs.results_max_size', DEFAULT_RESULTS_MAX_SIZE))
+        compressed = zlib.compress(serialized)
+        if len(compressed) > max_size:
+            logging.warning("SaveJobResults: results too large ({} bytes compressed); truncating".format(
+                len(compressed)))
+            self.NewJobData({"completed_results": {
+                "truncated": True,
+                "original_size_in_bytes": len(serialized),
+                "preview": serialized[:RESULTS_PREVIEW_SIZE]
+            }})
+            return
+        self.mongo_service.create_new('job_data', {}, None, {
+            'job_id': self.job_id,
+            'compressed_data': bson.Binary(compressed),
+            'original_size_in_bytes': len(serialized)
+        }, remove_existing=False)
 
     def NewAction(self, app_name, action_name, params):
         '''
@@ -883,8 +1167,68 @@ class ServerDataService(GenericChildDataService):
                 self.UpdateObjectFromPatch('servers', {'name': name}, doc)
             except:
                 return False
+        # the server may have been rebuilt/reconfigured, so any cached remote home is suspect (status updates by elita
+        # itself don't count)
+        if not elita.util.type_check.is_dictlike(doc) or not set(doc.keys()).issubset(('status', 'remote_home')):
+            self.mongo_service.modify_multi('servers', {'name': name}, {('remote_home',): None})
         return True
 
+    def GetRemoteHomes(self, servers):
+        '''
+        Get cached remote home directories (see RemoteCommands.get_remote_home), in one query: { server: home }
+        '''
+        assert elita.util.type_check.is_seq(servers)
+
+        docs = self.mongo_service.get('servers', {'name': {'$in': list(servers)}}, multi=True, empty=True,
+                                      fields=['name', 'remote_home'])
+        return {d['name']: d['remote_home'] for d in docs if d.get('remote_home')} if docs else dict()
+
+    def SetRemoteHomes(self, homes):
+        '''
+        Cache remote home directories: { server: home }
+        '''
+        assert elita.util.type_check.is_dictlike(homes)
+        assert all([s in self.root['server'] for s in homes])
+
+        for s in homes:
+            self.mongo_service.modify_multi('servers', {'name': s}, {('remote_home',): homes[s]})
+
+    def GetServerInventory(self, servers, ttl):
+        '''
+        Get cached grains for servers, in one query. Servers without grains or with grains older than ttl seconds are
+        left out: { server: { 'server_type': str, 'grains': dict } }
+        '''
+        assert elita.util.type_check.is_seq(servers)
+        assert isinstance(ttl, int) and ttl >= 0
+
+        docs = self.mongo_service.get('servers', {'name': {'$in': list(servers)}}, multi=True, empty=True,
+                                      fields=['name', 'server_type', 'grains', 'grains_updated_datetime'])
+        now = datetime.datetime.now(tz=pytz.utc)
+        inventory = dict()
+        for d in docs if docs else []:
+            updated = d.get('grains_updated_datetime')
+            if not d.get('grains') or not updated:
+                continue
+            updated = updated if updated.tzinfo else pytz.utc.localize(updated)
+            if (now - updated).total_seconds() <= ttl:
+                inventory[d['name']] = {'server_type': d['server_type'], 'grains': d['grains']}
+        return inventory
+
+    def UpdateServerGrains(self, grains_by_server):
+        '''
+        Store freshly retrieved grains (and the server_type derived from them): { server: { grain: value } }
+        '''
+        assert elita.util.type_check.is_dictlike(grains_by_server)
+        assert all([s in self.root['server'] for s in grains_by_server])
+
+        now = datetime.datetime.now(tz=pytz.utc)
+        for s in grains_by_server:
+            self.mongo_service.modify_multi('servers', {'name': s}, {
+                ('grains',): grains_by_server[s],
+                ('server_type',): salt_control.server_type_from_grains(grains_by_server[s]),
+                ('grains_updated_datetime',): now
+            })
+
     def DeleteServer(self, name):
         '''
         Delete a server object
@@ -1043,6 +1387,35 @@ class GitDataService(GenericChildDataService):
         return True
 
 
+    def UpdateServerCommits(self, app, name, servers, commit):
+        '''
+        Record the commit the gitdeploy is at on servers (None if unknown, ex: after deinitializing)
+        '''
+        assert app and name and servers
+        assert all([elita.util.type_check.is_string(p) for p in (app, name)])
+        assert elita.util.type_check.is_seq(servers)
+        assert elita.util.type_check.is_optional_str(commit)
+
+        # server names are keys, so replace '.' (hostnames) to keep mongo happy
+        self.mongo_service.modify_multi('gitdeploys', {'name': name, 'application': app}, {
+            ('server_commits', s.replace('.', EMBEDDED_YAML_DOT_REPLACEMENT)): commit for s in servers
+        })
+
+    def GetServerCommits(self, app, name):
+        '''
+        Get commit the gitdeploy is at on each server as of the last deployment to it: { server: commit_hash }
+
+        @rtype: dict
+        '''
+        assert app and name
+        assert all([elita.util.type_check.is_string(p) for p in (app, name)])
+
+        docs = self.mongo_service.get('gitdeploys', {'name': name, 'application': app}, multi=True, empty=True,
+                                      fields=['server_commits'])
+        commits = docs[0].get('server_commits') if docs else None
+        return {s.replace(EMBEDDED_YAML_DOT_REPLACEMENT, '.'): commits[s] for s in commits if commits[s]} \
+            if commits else dict()
+
     def DeleteGitDeploy(self, app, name):
         '''
         Delete a gitdeploy object and the root_tree reference
@@ -1233,7 +1606,32 @@ class GitDataService(GenericChildDataService):
         self.RmThreadLocalRootTree(('app', app, 'gitrepos', name))
         self.mongo_service.delete('gitrepos', {'name': name, 'application': app})
 
+DEFAULT_PROGRESS_FLUSH_MS = 1000
+DEFAULT_PLAN_TTL = 3600         # seconds a cached deployment plan can be executed (elita.deployment.plan_ttl)
+TIMING_SAMPLE_SIZE = 10         # recent deployments used to estimate batch duration
+
 class DeploymentDataService(GenericChildDataService):
+    def GetProgressAggregator(self, app, name):
+        '''
+        Get (or create) the in-memory progress aggregator for a deployment. Phase 1/phase 2 progress updates are
+        buffered and written every elita.deployment.progress_flush_ms milliseconds (or immediately on state transitions)
+        '''
+        if not hasattr(self, 'progress_aggregators'):
+            self.progress_aggregators = dict()
+        if (app, name) not in self.progress_aggregators:
+            flush_ms = int(self.settings.get('elita.deployment.progress_flush_ms', DEFAULT_PROGRESS_FLUSH_MS))
+            self.progress_aggregators[(app, name)] = ProgressAggregator(self.mongo_service, 'deployments',
+                                                                         {'application': app, 'name': name}, flush_ms)
+        return self.progress_aggregators[(app, name)]
+
+    def FlushProgress(self, app=None, name=None):
+        '''
+        Write any buffered progress updates (for one deployment or all of them)
+        '''
+        for k in getattr(self, 'progress_aggregators', {}):
+            if app is None or k == (app, name):
+                self.progress_aggregators[k].flush()
+
     def NewDeployment(self, app, build_name, environments, groups, servers, gitdeploys, username, options):
         '''
         Create new deployment object
@@ -1318,6 +1716,134 @@ class DeploymentDataService(GenericChildDataService):
         doc['created_datetime'] = doc['_id'].generation_time
         return {k: doc[k] for k in doc if k[0] != '_'}
 
+    def CheckpointPlan(self, app, name, stages):
+        '''
+        Record the batches (grouped into stages) a rolling deployment is executing, so a resumed deployment runs the
+        same plan
+        '''
+        assert app and name and stages
+        assert elita.util.type_check.is_seq(stages)
+        assert app in self.root['app']
+        assert name in self.root['app'][app]['deployments']
+
+        self.mongo_service.modify_multi('deployments', {'application': app, 'name': name}, {
+            ('checkpoint', 'plan'): {'stage_sizes': [len(s) for s in stages], 'batches': [b for s in stages for b in s]}
+        })
+
+    def CheckpointGitRepo(self, app, name, gitrepo, build_name):
+        '''
+        Record that phase 1 is done for gitrepo
+        '''
+        assert app and name and gitrepo and build_name
+        assert all([elita.util.type_check.is_string(p) for p in (app, name, gitrepo, build_name)])
+
+        self.mongo_service.modify_multi('deployments', {'application': app, 'name': name}, {
+            ('checkpoint', 'gitrepos', gitrepo): build_name
+        })
+
+    def CheckpointGitDeploys(self, app, name, batch_number, gitdeploys):
+        '''
+        Record that phase 2 completed without errors for gitdeploys in batch batch_number
+        '''
+        assert app and name and gitdeploys
+        assert all([elita.util.type_check.is_string(p) for p in (app, name)])
+        assert isinstance(batch_number, int) and batch_number >= 0
+        assert elita.util.type_check.is_seq(gitdeploys)
+
+        self.mongo_service.modify_multi('deployments', {'application': app, 'name': name}, {
+            ('checkpoint', 'batches', 'batch{}'.format(batch_number), 'gitdeploys', gd): True for gd in gitdeploys
+        })
+
+    def CheckpointBatch(self, app, name, batch_number):
+        '''
+        Record that batch batch_number is complete
+        '''
+        assert app and name
+        assert all([elita.util.type_check.is_string(p) for p in (app, name)])
+        assert isinstance(batch_number, int) and batch_number >= 0
+
+        self.mongo_service.modify_multi('deployments', {'application': app, 'name': name}, {
+            ('checkpoint', 'batches', 'batch{}'.format(batch_number), 'complete'): True
+        })
+
+    def GetCheckpoint(self, app, name):
+        '''
+        Get checkpoint data for deployment (empty checkpoint for deployments created before checkpointing)
+        '''
+        assert app and name
+        assert app in self.root['app']
+        assert name in self.root['app'][app]['deployments']
+
+        doc = self.mongo_service.get('deployments', {'application': app, 'name': name})
+        checkpoint = doc['checkpoint'] if doc.get('checkpoint') else dict()
+        return {
+            'plan': checkpoint.get('plan'),
+            'gitrepos': checkpoint.get('gitrepos') or dict(),
+            'batches': checkpoint.get('batches') or dict()
+        }
+
+    def SavePlan(self, app, plan):
+        '''
+        Cache a deployment plan (see elita.deployment.plan) so it can be executed later by ID. Plans expire after
+        elita.deployment.plan_ttl seconds.
+
+        Returns plan_id
+        @rtype: str
+        '''
+        assert app and plan
+        assert elita.util.type_check.is_string(app)
+        assert elita.util.type_check.is_dictlike(plan)
+        assert app in self.root['app']
+
+        plan_id = str(uuid.uuid4())
+        self.mongo_service.create_new('deployment_plans', {'application': app, 'plan_id': plan_id}, 'DeploymentPlan', {
+            'created_datetime': datetime.datetime.now(tz=pytz.utc),
+            'plan': plan
+        })
+        return plan_id
+
+    def GetPlan(self, app, plan_id):
+        '''
+        Get a cached deployment plan. Returns None if it doesn't exist or has expired
+        '''
+        assert app and plan_id
+        assert elita.util.type_check.is_string(app)
+        assert elita.util.type_check.is_string(plan_id)
+        assert app in self.root['app']
+
+        doc = self.mongo_service.get('deployment_plans', {'application': app, 'plan_id': plan_id}, empty=True)
+        if not doc:
+            return None
+        ttl = int(self.settings.get('elita.deployment.plan_ttl', DEFAULT_PLAN_TTL))
+        created = doc['created_datetime']
+        created = created if created.tzinfo else pytz.utc.localize(created)
+        if (datetime.datetime.now(tz=pytz.utc) - created).total_seconds() > ttl:
+            return None
+        return doc['plan']
+
+    def GetBatchTimings(self, app, sample_size=TIMING_SAMPLE_SIZE):
+        '''
+        Get average seconds per batch for the most recent completed deployments of app (newest first). Used to
+        estimate the duration of a planned deployment.
+
+        @rtype: list(float)
+        '''
+        assert app
+        assert elita.util.type_check.is_string(app)
+        assert isinstance(sample_size, int) and sample_size > 0
+
+        deployments = self.mongo_service.get('deployments', {'application': app, 'status': 'complete'}, multi=True,
+                                             empty=True, fields=['job_id', 'progress.phase2'],
+                                             sort=[('_id', -1)], limit=sample_size)
+        batch_counts = {d['job_id']: max(1, len(d['progress']['phase2'])) for d in deployments
+                        if d.get('job_id') and 'progress' in d and 'phase2' in d['progress']}
+        if not batch_counts:
+            return []
+        jobs = self.mongo_service.get('jobs', {'job_id': {'$in': batch_counts.keys()}}, multi=True, empty=True,
+                                      fields=['job_id', 'duration_in_seconds'], sort=[('_id', -1)])
+        return [j['duration_in_seconds'] / batch_counts[j['job_id']] for j in jobs
+                if j.get('duration_in_seconds') is not None]
+
     def UpdateDeployment(self, app, name, doc):
         '''
         Modify deployment object with the data in doc
@@ -1338,10 +1864,13 @@ class DeploymentDataService(GenericChildDataService):
                 return False
         return True
 
-    def InitializeDeploymentPlan(self, app, name, batches, gitrepos):
+    def InitializeDeploymentPlan(self, app, name, batches, gitrepos, start_batch=0):
         '''
         Create the appropriate structure in the "progress" field of the deployment.
 
+        If start_batch > 0 the plan is being recomputed mid-deployment (adaptive rolling deployments), so phase 1 and
+        batches before start_batch are left alone and each later batch is replaced as a whole.
+
         @type app: str
         @type name: str
         @type batches: list(dict)
@@ -1352,8 +1881,9 @@ class DeploymentDataService(GenericChildDataService):
         assert elita.util.type_check.is_seq(batches)
         assert all([elita.util.type_check.is_dictlike(b) for b in batches])
         assert elita.util.type_check.is_seq(gitrepos)  # list of all gitdeploys
+        assert isinstance(start_batch, int) and 0 <= start_batch <= len(batches)
 
-        for gr in gitrepos:
+        for gr in (gitrepos if start_batch == 0 else []):
             doc = {
                 'progress': {
                     'phase1': {
@@ -1367,7 +1897,8 @@ class DeploymentDataService(GenericChildDataService):
                     }
                 }
             }
-            self.UpdateDeployment(app, name, doc)
+            self.GetProgressAggregator(app, name).update({p[:-1]: p[-1] for p in
+                                                          elita.util.paths_from_nested_dict(doc)})
 
         # at a low level, deployment operates in a gitdeploy-centric way
         # but on a human level, a server-centric view is more intuitive, so we generate a list of servers per batch,
@@ -1392,6 +1923,8 @@ class DeploymentDataService(GenericChildDataService):
             }
         }
         for i, batch in enumerate(batches):
+            if i < start_batch:
+                continue
             batch_name = 'batch{}'.format(i)
             doc['progress']['phase2'][batch_name] = {}
             for server in batch['servers']:
@@ -1407,7 +1940,12 @@ class DeploymentDataService(GenericChildDataService):
                         }
 
         logging.debug('InitializeDeploymentPlan: doc: {}'.format(doc))
-        self.UpdateDeployment(app, name, doc)
+        if start_batch > 0:
+            path_values = {('progress', 'phase2', b): doc['progress']['phase2'][b] for b in doc['progress']['phase2']}
+        else:
+            path_values = {p[:-1]: p[-1] for p in elita.util.paths_from_nested_dict(doc)}
+        # one coalesced write for the whole plan rather than one per server/gitdeploy field
+        self.GetProgressAggregator(app, name).update(path_values, transition=True)
 
     def StartDeployment_Phase(self, app, name, phase):
         '''
@@ -1419,6 +1957,7 @@ class DeploymentDataService(GenericChildDataService):
         assert app in self.root['app']
         assert name in self.root['app'][app]['deployments']
 
+        self.FlushProgress(app, name)
         self.UpdateDeployment(app, name, {'progress': {'currently_on': 'phase{}'.format(phase)}})
 
     def FailDeployment(self, app, name):
@@ -1430,8 +1969,64 @@ class DeploymentDataService(GenericChildDataService):
         assert app in self.root['app']
         assert name in self.root['app'][app]['deployments']
 
-        self.UpdateDeployment(app, name, {'progress': {'currently_on': 'failure'}})
-        self.UpdateDeployment(app, name, {'status': 'error'})
+        self.FlushProgress(app, name)
+        self.UpdateDeployment(app, name, {'progress': {'currently_on': 'failure'}, 'status': 'error'})
+
+    def GetCommits(self, app, name):
+        '''
+        Get the commit each gitrepo is at for this deployment's build (recorded during phase 1): { gitrepo: commit_hash }
+
+        @rtype: dict
+        '''
+        assert app and name
+        assert all([elita.util.type_check.is_string(p) for p in (app, name)])
+
+        docs = self.mongo_service.get('deployments', {'application': app, 'name': name}, multi=True, empty=True,
+                                      fields=['commits'])
+        return (docs[0].get('commits') or dict()) if docs else dict()
+
+    def RequestCancel(self, app, name):
+        '''
+        Ask a running deployment to stop. The deployment job notices the request between batches or while waiting for
+        phase 1/phase 2 tasks, terminates in-flight work and marks the deployment cancelled
+        '''
+        assert app and name
+        assert all([elita.util.type_check.is_string(p) for p in (app, name)])
+        assert app in self.root['app']
+        assert name in self.root['app'][app]['deployments']
+
+        self.mongo_service.modify_multi('deployments', {'application': app, 'name': name}, {
+            ('cancel_requested_datetime',): datetime.datetime.now(tz=pytz.utc),
+            ('status',): 'cancelling'
+        })
+
+    def GetCancelRequest(self, app, name):
+        '''
+        Get the time a cancel was requested for the deployment (None if not requested). Only fetches that field, as it
+        is polled throughout the deployment
+
+        @rtype: datetime.datetime | None
+        '''
+        assert app and name
+        assert all([elita.util.type_check.is_string(p) for p in (app, name)])
+
+        docs = self.mongo_service.get('deployments', {'application': app, 'name': name}, multi=True, empty=True,
+                                      fields=['cancel_requested_datetime'])
+        return docs[0].get('cancel_requested_datetime') if docs else None
+
+    def CancelDeployment(self, app, name, latency):
+        '''
+        Mark deployment as cancelled. latency is seconds between the cancel request and in-flight work being stopped
+        '''
+        assert app and name
+        assert all([elita.util.type_check.is_string(p) for p in (app, name)])
+        assert app in self.root['app']
+        assert name in self.root['app'][app]['deployments']
+
+        self.FlushProgress(app, name)
+        self.UpdateDeployment(app, name, {'progress': {'currently_on': 'cancelled',
+                                                       'cancellation_latency_in_seconds': latency},
+                                          'status': 'cancelled'})
 
     def CompleteDeployment(self, app, name):
         '''
@@ -1442,6 +2037,7 @@ class DeploymentDataService(GenericChildDataService):
         assert app in self.root['app']
         assert name in self.root['app'][app]['deployments']
 
+        self.FlushProgress(app, name)
         self.UpdateDeployment(app, name, {'progress': {'currently_on': 'completed'}})
 
     def UpdateDeployment_Phase1(self, app, name, gitrepo, progress=None, step=None, changed_files=None):
@@ -1456,15 +2052,17 @@ class DeploymentDataService(GenericChildDataService):
         assert app in self.root['app']
         assert name in self.root['app'][app]['deployments']
 
-        progress_dict = dict()
+        path = ('progress', 'phase1', 'gitrepos', gitrepo)
+        path_values = dict()
         if progress:
-            progress_dict['progress'] = progress
+            path_values[path + ('progress',)] = progress
         if step:
-            progress_dict['step'] = step
+            path_values[path + ('step',)] = step
         if changed_files:
-            progress_dict['changed_files'] = changed_files
-
-        self.UpdateDeployment(app, name, {'progress': {'phase1': {'gitrepos': {gitrepo: progress_dict}}}})
+            path_values[path + ('changed_files',)] = changed_files
+        if path_values:
+            self.GetProgressAggregator(app, name).update(path_values,
+                                                         transition=self._is_progress_transition(progress, step))
 
     def UpdateDeployment_Phase2(self, app, name, gitdeploy, servers, batch, progress=None, state=None):
         '''
@@ -1478,17 +2076,25 @@ class DeploymentDataService(GenericChildDataService):
         assert app in self.root['app']
         assert name in self.root['app'][app]['deployments']
 
-        progress_dict = {'batch{}'.format(batch): {}}
-
+        path_values = dict()
         for s in servers:
-            progress_dict['batch{}'.format(batch)][s] = dict()
-            progress_dict['batch{}'.format(batch)][s][gitdeploy] = dict()
+            path = ('progress', 'phase2', 'batch{}'.format(batch), s, gitdeploy)
             if progress:
-                progress_dict['batch{}'.format(batch)][s][gitdeploy]['progress'] = progress
+                path_values[path + ('progress',)] = progress
             if state:
-                progress_dict['batch{}'.format(batch)][s][gitdeploy]['state'] = state
+                path_values[path + ('state',)] = state
+        if path_values:
+            self.GetProgressAggregator(app, name).update(path_values,
+                                                         transition=self._is_progress_transition(progress, state))
 
-        self.UpdateDeployment(app, name, {'progress': {'phase2': progress_dict}})
+    def _is_progress_transition(self, progress, step_or_state):
+        '''
+        Completion and errors are written through immediately; intermediate progress can be buffered
+        '''
+        if progress == 100 or elita.util.type_check.is_seq(step_or_state):    # error steps are lists of lines
+            return True
+        return elita.util.type_check.is_string(step_or_state) and \
+            any([w in step_or_state for w in ('ERROR', 'FAILURE', 'Complete')])
 
 class KeyDataService(GenericChildDataService):
     def GetKeyPairs(self):
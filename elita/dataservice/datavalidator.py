@@ -6,6 +6,7 @@ import collections
 
 import elita.util
 import models
+from elita.dataservice import DEFAULT_PLAN_TTL
 
 DEFAULT_ADMIN_USERNAME = 'admin'
 DEFAULT_ADMIN_PASSWORD = 'elita'
@@ -61,6 +62,7 @@ class DataValidator:
         self.check_gitdeploys()
         self.check_gitrepos()
         self.check_groups()
+        self.check_indexes()
         self.SaveRoot()
 
     def SaveRoot(self):
@@ -320,6 +322,30 @@ class DataValidator:
         for d in job_fixlist:
             self.db['jobs'].save(d)
 
+    def check_indexes(self):
+        '''
+        Make sure indexes used by job listing/queue and deployment plan queries exist. ensure_index is a no-op if the
+        index is already there
+        '''
+        self.db['jobs'].ensure_index('job_id')
+        self.db['jobs'].ensure_index([('status', 1), ('job_type', 1), ('_id', -1)])
+        self.db['jobs'].ensure_index([('application', 1), ('_id', -1)])
+        self.db['jobs'].ensure_index([('job_type', 1), ('started_datetime', -1)])
+        self.db['jobs'].ensure_index('completed_datetime')
+        self.db['job_data'].ensure_index('job_id')
+        self.db['job_slots'].ensure_index('name', unique=True)
+        self.db['job_slots'].ensure_index('holders.job_id')
+        self.db['deployment_plans'].ensure_index([('application', 1), ('plan_id', 1)])
+        # mongo removes plans older than elita.deployment.plan_ttl itself (within a minute or so; GetPlan checks too)
+        plan_ttl = int(self.settings.get('elita.deployment.plan_ttl', DEFAULT_PLAN_TTL))
+        ttl_index = self.db['deployment_plans'].index_information().get('created_datetime_1')
+        if ttl_index and ttl_index.get('expireAfterSeconds') != plan_ttl:
+            # expireAfterSeconds of an existing index can only be changed with collMod
+            self.db.command('collMod', 'deployment_plans',
+                            index={'keyPattern': {'created_datetime': 1}, 'expireAfterSeconds': plan_ttl})
+        else:
+            self.db['deployment_plans'].ensure_index('created_datetime', expireAfterSeconds=plan_ttl)
+
     def check_apps(self):
         app_sublevels = {
             'builds': {
@@ -93,6 +93,9 @@ class Server(GenericDataModel):
     default_values = {
         "name": None,
         "server_type": None,
+        "grains": dict(),   # subset of minion grains, refreshed by RemoteCommands.get_inventory
+        "grains_updated_datetime": None,
+        "remote_home": None,    # cached expansion of ~ (cleared when the server is updated)
         "status": None,
         "environment": None,
         "attributes": dict(),
@@ -133,10 +136,12 @@ class GitDeploy(GenericDataModel):
         'servers': list(),
         'attributes': dict(),
         'deployed_build': None,
+        'server_commits': dict(),   # { server: commit_hash } as of the last deployment to each server
         'options': {
             'favor': 'ours',
             'ignore-whitespace': 'true',
-            'gitignore': list()
+            'gitignore': list(),
+            'timeouts': dict()   # optional per-gitdeploy overrides of deployment timeouts: { task, state, ping }
         },
         'actions': {
             'prepull': [],
@@ -170,6 +175,7 @@ class Deployment(GenericDataModel):
         'username': None,
         'options': dict(),  # pauses, divisor
         'status': None,
+        'cancel_requested_datetime': None,
         'commits': dict(),    # { gitrepo_name: commit_hash }
         'progress': {
             'currently_on': None,
@@ -178,6 +184,11 @@ class Deployment(GenericDataModel):
             },
             'phase2': dict()
         },
+        'checkpoint': {     # completed work, so a failed deployment can be resumed
+            'plan': None,       # { 'stage_sizes': [...], 'batches': [...] } (rolling deployments)
+            'gitrepos': dict(),     # { gitrepo_name: build_name } (phase 1 done)
+            'batches': dict()       # { 'batchN': { 'complete': bool, 'gitdeploys': { gitdeploy_name: True } } }
+        },
         'job_id': None
     }
 
@@ -261,13 +272,19 @@ class Token(GenericDataModel):
 
 class Job(GenericDataModel):
     default_values = {
-        'status': 'running',
+        'status': 'queued',     # queued | running | completed | failed
         'name': None,
         'job_type': None,
+        'application': None,
+        'queue': None,
+        'priority': None,
         'data': None,
+        'started_datetime': None,
+        'wait_in_seconds': None,
         'completed_datetime': None,
         'duration_in_seconds': None,
         'attributes': None,
+        'salt_jobs': dict(),    # { jid: { 'cmd', 'minions', 'timeout', 'submitted_datetime', 'returned', 'status' } }
         'job_id': None
     }
 
@@ -72,6 +72,47 @@ class MongoService:
         result = self.db[collection].update({'_id': canonical_id}, {'$set': {path_dot_notation: doc_or_obj}}, fsync=True)
         return result['n'] == 1 and result['updatedExisting'] and not result['err']
 
+    def modify_multi(self, collection, keys, path_values):
+        '''
+        Like modify() but sets several paths in one atomic update. path_values is a dict of path tuple -> value.
+        Unlike modify(), does not look for (or clean up) duplicates first, so keys should be unique
+
+        Returns boolean indicating success
+        '''
+        assert elita.util.type_check.is_string(collection)
+        assert isinstance(keys, dict)
+        assert elita.util.type_check.is_dictlike(path_values)
+        assert collection and keys and path_values
+        assert all([hasattr(p, '__iter__') and p for p in path_values])
+        result = self.db[collection].update(keys, {'$set': {'.'.join(p): path_values[p] for p in path_values}},
+                                            fsync=True)
+        return result['n'] == 1 and result['updatedExisting'] and not result['err']
+
+    def update(self, collection, keys, update, multi=False, upsert=False):
+        '''
+        Thin wrapper around update() for atomic operators other than $set ($push, $pull, $inc, etc)
+
+        Returns number of documents updated
+        '''
+        assert elita.util.type_check.is_string(collection)
+        assert isinstance(keys, dict)
+        assert elita.util.type_check.is_dictlike(update)
+        assert collection and update
+        result = self.db[collection].update(keys, update, multi=multi, upsert=upsert, fsync=True)
+        return result['n']
+
+    def find_and_modify(self, collection, keys, update, upsert=False):
+        '''
+        Thin wrapper around find_and_modify(): atomically update the first document matching keys
+
+        Returns the updated document, or None if nothing matched
+        '''
+        assert elita.util.type_check.is_string(collection)
+        assert isinstance(keys, dict)
+        assert elita.util.type_check.is_dictlike(update)
+        assert collection and update
+        return self.db[collection].find_and_modify(keys, update, upsert=upsert, new=True)
+
     def save(self, collection, doc):
         '''
         Replace a document completely with a new one. Must have an '_id' field
@@ -126,19 +167,24 @@ class MongoService:
         result = self.db['root_tree'].update({}, {'$unset': {path_dot_notation: ''}}, fsync=True)
         return result['n'] == 1 and result['updatedExisting'] and not result['err']
 
-    def get(self, collection, keys, multi=False, empty=False):
+    def get(self, collection, keys, multi=False, empty=False, fields=None, sort=None, skip=0, limit=0):
         '''
         Thin wrapper around find()
         Retrieve a document from Mongo, keyed by name. Optionally, if duplicates are found, delete all but the first.
         If empty, it's ok to return None if nothing matches
 
+        fields/sort/skip/limit are passed through to find() and only make sense with multi=True
+
         Returns document
         @rtype: dict | list(dict) | None
         '''
         assert elita.util.type_check.is_string(collection)
         assert isinstance(keys, dict)
         assert collection
-        dlist = [d for d in self.db[collection].find(keys)]
+        assert elita.util.type_check.is_optional_seq(fields)
+        assert elita.util.type_check.is_optional_seq(sort)
+        assert multi or not (fields or sort or skip or limit)
+        dlist = [d for d in self.db[collection].find(keys, fields=fields, sort=sort, skip=skip, limit=limit)]
         assert dlist or empty
         if len(dlist) > 1 and not multi:
             logging.warning("Found duplicate entries ({}) for query {} in collection {}; dropping all but the first"
@@ -147,6 +193,27 @@ class MongoService:
             self.db[collection].remove(keys)
         return dlist if multi else (dlist[0] if dlist else dlist)
 
+    def count(self, collection, keys):
+        '''
+        Thin wrapper around find().count()
+        Returns the number of documents in collection matching keys
+        '''
+        assert elita.util.type_check.is_string(collection)
+        assert isinstance(keys, dict)
+        assert collection
+        return self.db[collection].find(keys).count()
+
+    def aggregate(self, collection, pipeline):
+        '''
+        Thin wrapper around aggregate()
+        Returns list of result documents
+        '''
+        assert elita.util.type_check.is_string(collection)
+        assert elita.util.type_check.is_seq(pipeline)
+        assert collection
+        result = self.db[collection].aggregate(pipeline)
+        return result['result'] if elita.util.type_check.is_dictlike(result) else [d for d in result]
+
     def dereference(self, dbref):
         '''
         Simple wrapper around db.dereference()
@@ -0,0 +1,87 @@
+__author__ = 'bkeroack'
+
+import logging
+import threading
+import time
+
+import elita.util
+
+
+class ProgressAggregator:
+    '''
+    Buffers progress updates for a single document (ex: one deployment) in memory and writes them as one coalesced
+    $set, either when flush_interval_ms has elapsed since the first buffered update or immediately on a state
+    transition. Later updates to the same path replace earlier ones (and updates under a pending object are merged into
+    it), so a burst of per-server callbacks turns into a single write.
+    '''
+    # logspam
+    #__metaclass__ = elita.util.LoggingMetaClass
+
+    def __init__(self, mongo_service, collection, keys, flush_interval_ms):
+        '''
+        @type mongo_service: MongoService
+        '''
+        assert mongo_service and collection and keys
+        assert elita.util.type_check.is_string(collection)
+        assert elita.util.type_check.is_dictlike(keys)
+        assert isinstance(flush_interval_ms, int) and flush_interval_ms >= 0
+        self.mongo_service = mongo_service
+        self.collection = collection
+        self.keys = keys
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.pending = dict()   # { path_tuple: value }
+        self.lock = threading.RLock()
+        self.timer = None
+        self.last_flush = time.time()
+
+    def update(self, path_values, transition=False):
+        '''
+        Merge path_values ({ path_tuple: value }) into the pending buffer. Flush immediately if transition is True or
+        the flush interval has elapsed, otherwise make sure a flush is scheduled.
+        '''
+        assert elita.util.type_check.is_dictlike(path_values)
+        with self.lock:
+            for path in path_values:
+                self._merge(path, path_values[path])
+            if transition or self.flush_interval == 0 or time.time() - self.last_flush >= self.flush_interval:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _merge(self, path, value):
+        '''
+        A pending parent or child of path would conflict in the same $set. Pending children are replaced by the new
+        value; a new value under a pending parent object is merged into that object (keeping its other fields)
+        '''
+        for p in [p for p in self.pending if len(p) > len(path) and p[:len(path)] == path]:
+            del self.pending[p]
+        parents = [p for p in self.pending if len(p) < len(path) and path[:len(p)] == p]
+        if parents and elita.util.type_check.is_dictlike(self.pending[parents[0]]):
+            parent = parents[0]
+            obj = self.pending[parent] = dict(self.pending[parent])
+            for key in path[len(parent):-1]:
+                obj[key] = dict(obj[key]) if elita.util.type_check.is_dictlike(obj.get(key)) else dict()
+                obj = obj[key]
+            obj[path[-1]] = value
+            return
+        for p in parents:
+            del self.pending[p]
+        self.pending[path] = value
+
+    def flush(self):
+        '''
+        Write all pending updates in one atomic update
+        '''
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            self.last_flush = time.time()
+            if not self.pending:
+                return
+            pending = self.pending
+            self.pending = dict()
+            logging.debug("ProgressAggregator: flushing {} updates".format(len(pending)))
+            self.mongo_service.modify_multi(self.collection, self.keys, pending)
@@ -1,11 +1,14 @@
 __author__ = 'bkeroack'
 
 import sys
+import functools
 import logging
 import traceback
 import time
+import datetime
+import pytz
 import billiard
-import itertools
+import array
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -18,26 +21,91 @@ from elita.actions.action import regen_datasvc
 class FatalDeploymentError(Exception):
     pass
 
+class DeploymentCancelled(Exception):
+    '''
+    Raised by DeployController.check_cancelled when a cancel has been requested for the deployment.
+    requested_datetime is when the cancel was requested (used to compute cancellation latency)
+    '''
+    def __init__(self, requested_datetime):
+        Exception.__init__(self, "deployment cancelled")
+        self.requested_datetime = requested_datetime
+
+DEFAULT_DEPLOYMENT_WORKERS = 8     # size of per-deployment worker pool (elita.deployment.workers)
+DEFAULT_TASK_TIMEOUT = 150         # seconds to wait for each phase 1/phase 2 task (elita.deployment.task_timeout)
+DEFAULT_STATE_TIMEOUT = 600        # salt timeout for phase 2 state calls (elita.deployment.state_timeout)
+DEFAULT_PING_TIMEOUT = 10          # salt timeout for phase 2 connectivity checks (elita.deployment.ping_timeout)
+TIMEOUTS = ('task', 'state', 'ping')
+PIPELINE_POLL_INTERVAL = 0.25     # seconds between checks for finished phase 1/phase 2 tasks
+CANCEL_POLL_INTERVAL = 1.0        # minimum seconds between checks for a cancel request
+PREFLIGHT_ATTEMPTS = 3            # salt pings before giving up on a server
+DEFAULT_PING_CACHE_TTL = 60       # seconds a successful preflight ping is trusted (elita.deployment.ping_cache_ttl)
+DEFAULT_COMBINE_STATES = False    # one state run per server for gitdeploys pulled together (elita.deployment.combine_states)
+ROLLING_STRATEGIES = ('divisor', 'adaptive')
+DEFAULT_CANARY_SIZE = 1           # servers per rolling group in the first adaptive batch
+DEFAULT_GROWTH_FACTOR = 2         # adaptive batch size multiplier after each healthy stage
+
+def get_timeouts(settings, overrides=None):
+    '''
+    Deployment timeouts in seconds: { 'task': int, 'state': int, 'ping': int }
+    Defaults come from the ini (elita.deployment.<name>_timeout) and are overridden by any keys in overrides
+    (per-deployment or per-gitdeploy timeouts)
+    '''
+    defaults = {'task': DEFAULT_TASK_TIMEOUT, 'state': DEFAULT_STATE_TIMEOUT, 'ping': DEFAULT_PING_TIMEOUT}
+    timeouts = {t: int(settings.get('elita.deployment.{}_timeout'.format(t), defaults[t])) for t in TIMEOUTS}
+    if overrides:
+        timeouts.update({t: int(overrides[t]) for t in TIMEOUTS if overrides.get(t)})
+    return timeouts
+
 #async callable
-def run_deploy(datasvc, application, build_name, target, rolling_divisor, rolling_pause, ordered_pause, deployment_id):
+def run_deploy(datasvc, application, build_name, target, rolling_divisor, rolling_pause, ordered_pause, deployment_id,
+               salt_concurrency=None, rolling_strategy=None, planned_stages=None, resume=False, timeouts=None,
+               skip_current=True):
     '''
     Asynchronous entry point for deployments
+
+    If resume is True, continue a previous (failed) run of deployment_id from its checkpoint: gitrepos that finished
+    phase 1 and batches/gitdeploys that finished phase 2 are skipped.
+
+    timeouts (optional) are per-deployment overrides of the ini timeouts (see get_timeouts)
+
+    If skip_current is True, phase 2 skips servers that are already at the commit the build was committed as
     '''
 
     # normally there's a higher level try/except block for all async actions
     # we want to make sure the error is saved in the deployment object as well, not just the job
     # so we duplicate the functionality here
+    dc = DeployController(datasvc, deployment_id, salt_concurrency=salt_concurrency, timeouts=timeouts,
+                          skip_current=skip_current)
     try:
+        checkpoint = datasvc.deploysvc.GetCheckpoint(application, deployment_id) if resume else None
+        if checkpoint:
+            dc.restore_checkpoint(build_name, checkpoint)
         if target['groups']:
             logging.debug("run_deploy: Doing rolling deployment")
-            dc = DeployController(datasvc, deployment_id)
             rdc = RollingDeployController(datasvc, dc, deployment_id)
-            ret = rdc.run(application, build_name, target, rolling_divisor, rolling_pause, ordered_pause)
+            ret = rdc.run(application, build_name, target, rolling_divisor, rolling_pause, ordered_pause,
+                          strategy=rolling_strategy, planned_stages=planned_stages, checkpoint=checkpoint)
         else:
             logging.debug("run_deploy: Doing manual deployment")
-            dc = DeployController(datasvc, deployment_id)
-            ret, data = dc.run(application, build_name, target['servers'], target['gitdeploys'])
+            gitdeploys = remaining_gitdeploys(checkpoint, 0, target['gitdeploys'])
+            if gitdeploys:
+                ret, data = dc.run(application, build_name, target['servers'], gitdeploys)
+            else:
+                ret = True
+            if ret:
+                datasvc.deploysvc.CheckpointBatch(application, deployment_id, 0)
+        dc.close()
+    except DeploymentCancelled as e:
+        # kill in-flight phase 1/phase 2 tasks before recording how long the cancel took
+        dc.close(terminate=True)
+        requested = e.requested_datetime if e.requested_datetime.tzinfo else pytz.utc.localize(e.requested_datetime)
+        latency = (datetime.datetime.now(tz=pytz.utc) - requested).total_seconds()
+        logging.debug("run_deploy: cancelled (latency: {}s)".format(latency))
+        datasvc.jobsvc.NewJobData({"message": "deployment cancelled", "cancellation_latency_in_seconds": latency})
+        datasvc.deploysvc.CancelDeployment(application, deployment_id, latency)
+        return {"deploy_status": "cancelled", "cancellation_latency_in_seconds": latency}
     except:
+        dc.close(terminate=True)
         exc_type, exc_obj, tb = sys.exc_info()
         f_exc = traceback.format_exception(exc_type, exc_obj, tb)
         results = {
@@ -46,10 +114,24 @@ def run_deploy(datasvc, application, build_name, target, rolling_divisor, rollin
         }
         logging.debug("run_deploy: EXCEPTION: {}".format(f_exc))
         datasvc.deploysvc.UpdateDeployment(application, deployment_id, {"status": "error"})
-        return {"deploy_status": "error", "details": results}
+        return {"deploy_status": "error", "error": results["error"], "details": results}
     datasvc.deploysvc.CompleteDeployment(application, deployment_id)
     datasvc.deploysvc.UpdateDeployment(application, deployment_id, {"status": "complete" if ret else "error"})
-    return {"deploy_status": "done" if ret else "error"}
+    if not ret:
+        return {"deploy_status": "error", "error": "deployment failed"}   # 'error' key marks the job failed
+    return {"deploy_status": "done"}
+
+def remaining_gitdeploys(checkpoint, batch_number, gitdeploys):
+    '''
+    gitdeploys of batch batch_number that haven't completed according to checkpoint (all of them if checkpoint is None)
+    '''
+    if not checkpoint:
+        return gitdeploys
+    batch = checkpoint['batches'].get('batch{}'.format(batch_number), dict())
+    if batch.get('complete'):
+        return list()
+    done = batch.get('gitdeploys', dict())
+    return [gd for gd in gitdeploys if gd not in done]
 
 
 class BatchCompute:
@@ -58,143 +140,181 @@ class BatchCompute:
         compute the optimal batches of server/gitdeploy pairs. All non-rolling groups are added to the first batch.
         Splitting algorithm is tolerant of outrageously large rolling_divisors.
 
-        Written in a functional style to facilitate testing.
+        Servers and gitdeploys are interned to integer IDs and batches are assembled position by position from index
+        ranges, so planning is linear in the size of the output (no repeated list concatenation or set round trips).
+        Server/gitdeploy lists in the returned batches are in first-seen order.
     '''
 
     @staticmethod
-    def add_nonrolling_groups(batches, nonrolling_docs):
-        '''
-        Add servers and gitdeploys from nonrolling groups to the first batch
-        Not written in a functional style because that was totally unreadable
-        '''
-        if nonrolling_docs and len(nonrolling_docs) > 0:
-            assert all(map(lambda x: 'servers' in x and 'gitdeploys' in x, batches)) or not batches
-            assert all(map(lambda x: 'servers' in x[1] and 'gitdeploys' in x[1], nonrolling_docs.iteritems()))
-            non_rolling_batches = list()
-            for g in nonrolling_docs:
-                servers = nonrolling_docs[g]['servers']
-                gitdeploys = nonrolling_docs[g]['gitdeploys']
-                ordered = isinstance(nonrolling_docs[g]['gitdeploys'][0], list)
+    def split_ranges(count, divisor):
+        '''
+        (start, end) index ranges splitting count items into divisor approximately equal chunks, skipping empty chunks.
+        Same split as elita.util.split_seq
+        '''
+        if divisor >= count:
+            return [(i, i+1) for i in xrange(count)]    # at most one item per chunk
+        splitsize = 1.0/divisor*count
+        ranges = list()
+        for i in range(divisor):
+            start, end = int(round(i*splitsize)), int(round((i+1)*splitsize))
+            if end > start:
+                ranges.append((start, end))
+            if end >= count:
+                break
+        return ranges
+
+    @staticmethod
+    def compute_rolling_batches(divisor, rolling_group_docs, nonrolling_group_docs):
+        assert isinstance(divisor, int)
+        assert elita.util.type_check.is_optional_dict(rolling_group_docs)
+        assert not rolling_group_docs or all(map(lambda x: 'servers' in x[1] and 'gitdeploys' in x[1], rolling_group_docs.iteritems()))
+        assert not nonrolling_group_docs or all(map(lambda x: 'servers' in x[1] and 'gitdeploys' in x[1], nonrolling_group_docs.iteritems()))
+
+        server_ids = dict()     # name -> integer ID (IDs are assigned in first-seen order)
+        gd_ids = dict()
+
+        def intern_servers(servers):
+            return array.array('i', [server_ids.setdefault(s, len(server_ids)) for s in servers])
+
+        def intern_gitdeploys(gitdeploys):
+            return [gd_ids.setdefault(gd, len(gd_ids)) for gd in elita.util.flatten_list(gitdeploys)]
+
+        def group_plan(doc):
+            '''
+            (server id array, list of gitdeploy id lists, ordered) for a group. Unordered groups have one gitdeploy list
+            '''
+            ordered = isinstance(doc['gitdeploys'][0], list)
+            levels = [intern_gitdeploys(gdb) for gdb in doc['gitdeploys']] if ordered \
+                else [intern_gitdeploys(doc['gitdeploys'])]
+            return intern_servers(doc['servers']), levels, ordered
+
+        # each batch is [ server parts ((id array, start, end) ranges), gitdeploy id lists, ordered_gitdeploy ]
+        batches = list()
+
+        # rolling groups: batch N is chunk N // levels, gitdeploy level N % levels of every group, combined position-wise
+        rolling = [group_plan(rolling_group_docs[g]) for g in rolling_group_docs] if rolling_group_docs else list()
+        rolling_ranges = [BatchCompute.split_ranges(len(ids), divisor) for ids, levels, ordered in rolling]
+        group_batch_counts = [len(r) * len(p[1]) for r, p in zip(rolling_ranges, rolling)]
+        for position in range(max(group_batch_counts) if group_batch_counts else 0):
+            server_parts = list()
+            gd_parts = list()
+            # positions beyond the end of any group's batches are never ordered when combining multiple groups
+            ordered_flag = len(rolling) == 1 or all([position < c for c in group_batch_counts])
+            for (ids, levels, ordered), ranges, count in zip(rolling, rolling_ranges, group_batch_counts):
+                if position >= count:
+                    continue
+                start, end = ranges[position // len(levels)]
+                level = position % len(levels)
+                server_parts.append((ids, start, end))
+                gd_parts.append(levels[level])
+                ordered_flag = ordered_flag and ordered and level != len(levels) - 1
+            batches.append([server_parts, gd_parts, ordered_flag])
+
+        # non-rolling groups: ordered groups are merged level by level, unordered groups each add one more entry
+        if nonrolling_group_docs:
+            nonrolling = list()
+            for g in nonrolling_group_docs:
+                ids, levels, ordered = group_plan(nonrolling_group_docs[g])
                 if ordered:
-                    for i, gdb in enumerate(nonrolling_docs[g]['gitdeploys']):
-                        if i > len(non_rolling_batches)-1:
-                            non_rolling_batches.append({'gitdeploys': gdb, 'servers': servers})
-                        else:
-                            non_rolling_batches[i]['servers'] = list(set(servers + non_rolling_batches[i]['servers']))
-                            non_rolling_batches[i]['gitdeploys'] = list(set(gdb + non_rolling_batches[i]['gitdeploys']))
-                        if i == len(nonrolling_docs[g]['gitdeploys'])-1:
-                            non_rolling_batches[i]['ordered_gitdeploy'] = False
-                        else:
-                            non_rolling_batches[i]['ordered_gitdeploy'] = True
+                    for i, level in enumerate(levels):
+                        if i > len(nonrolling)-1:
+                            nonrolling.append([[], [], False])
+                        nonrolling[i][0].append((ids, 0, len(ids)))
+                        nonrolling[i][1].append(level)
+                        nonrolling[i][2] = i != len(levels)-1
                 else:
-                    non_rolling_batches.append({'gitdeploys': gitdeploys, 'servers': servers, 'ordered_gitdeploy': False})
-            for i, nrb in enumerate(non_rolling_batches):
+                    nonrolling.append([[(ids, 0, len(ids))], [levels[0]], False])
+            for i, nrb in enumerate(nonrolling):
                 if i > len(batches)-1:
                     batches.append(nrb)
                 else:
-                    batches[i]['servers'] = list(set(nrb['servers'] + batches[i]['servers']))
-                    batches[i]['gitdeploys'] = list(set(nrb['gitdeploys'] + batches[i]['gitdeploys']))
-                    batches[i]['ordered_gitdeploy'] = nrb['ordered_gitdeploy']
-        return batches
+                    batches[i][0].extend(nrb[0])
+                    batches[i][1].extend(nrb[1])
+                    batches[i][2] = nrb[2]
 
-    @staticmethod
-    def dedupe_batches(batches):
-        '''
-        Dedupe servers and gitdeploys list in the combined batches list:
-        [
-            { "servers": [ "server1", "server1", ...], "gitdeploys": [ "gd1", "gd1", ...] },  #batch 0 (all groups)
-            { "servers": [ "server1", "server1", ...], "gitdeploys": [ "gd1", "gd1", ...] },  #batch 1 (all groups)
-            ...
-        ]
-        '''
         assert len(batches) > 0
-        assert all(map(lambda x: 'servers' in x and 'gitdeploys' in x, batches))
-        return map(lambda x: {"servers": list(set(x['servers'])),
-                              "gitdeploys": list(set(elita.util.flatten_list(x['gitdeploys']))),
-                              "ordered_gitdeploy": x['ordered_gitdeploy']}, batches)
 
-    @staticmethod
-    def reduce_group_batches(accumulated, update):
-        assert 'servers' in accumulated and 'servers' in update
-        assert 'gitdeploys' in accumulated and 'gitdeploys' in update
-        return {
-            "servers": accumulated['servers'] + update['servers'],
-            "gitdeploys": accumulated['gitdeploys'] + update['gitdeploys']
-        }
+        server_names = [None] * len(server_ids)
+        for name in server_ids:
+            server_names[server_ids[name]] = name
+        gd_names = [None] * len(gd_ids)
+        for name in gd_ids:
+            gd_names[gd_ids[name]] = name
+
+        # IDs are assigned in first-seen order, so sorting the deduped IDs gives first-seen order
+        result = list()
+        for server_parts, gd_parts, ordered_flag in batches:
+            server_set = set()
+            for ids, start, end in server_parts:
+                server_set.update(ids[start:end])
+            gd_set = set()
+            for level in gd_parts:
+                gd_set.update(level)
+            servers = [server_names[i] for i in sorted(server_set)]
+            gitdeploys = [gd_names[i] for i in sorted(gd_set)]
+            result.append({'servers': servers, 'gitdeploys': gitdeploys, 'ordered_gitdeploy': ordered_flag})
+        return result
 
     @staticmethod
-    def coalesce_batches(batches):
+    def split_stages(batches, stage_sizes):
         '''
-        Combine the big list of batches into a single list.
-
-        Function is passed a list of lists:
-        [
-            [ { "servers": [...], "gitdeploys": [...] }, ... ],     # batches 0-n for group A
-            [ { "servers": [...], "gitdeploys": [...] }, ... ],     # batches 0-n for broup B
-            ...
-        ]
-
-        Each nested list represents the computed batches for an individual group. All nested lists are expected to be
-        the same length.
+        Regroup a flat list of batches into stages of the given sizes
         '''
-        if not batches:
-            return list()
+        assert sum(stage_sizes) == len(batches)
+        stages = list()
+        offset = 0
+        for size in stage_sizes:
+            stages.append(batches[offset:offset+size])
+            offset += size
+        return stages
 
-        return map(
-            lambda batch_aggregate: reduce(
-                lambda acc, upd:
-                {
-                    'servers': acc['servers'] + upd['servers'],
-                    'gitdeploys': acc['gitdeploys'] + upd['gitdeploys'],
-                    'ordered_gitdeploy': acc['ordered_gitdeploy'] and upd['ordered_gitdeploy']
-                }, batch_aggregate
-            ), itertools.izip_longest(*batches, fillvalue={"servers": [], "gitdeploys": [], "ordered_gitdeploy": False}))
+    @staticmethod
+    def adaptive_batch_sizes(count, first_size, growth_factor):
+        '''
+        Geometric sequence of chunk sizes covering count servers: first_size, first_size*growth_factor, ...
+        The last chunk is truncated to whatever is left.
+        '''
+        assert isinstance(count, int) and count >= 0
+        assert isinstance(first_size, int) and first_size >= 1
+        assert isinstance(growth_factor, int) and growth_factor >= 1
+        sizes = list()
+        size = first_size
+        while count > 0:
+            sizes.append(min(size, count))
+            count -= sizes[-1]
+            size *= growth_factor
+        return sizes
 
     @staticmethod
-    def compute_group_batches(divisor, group):
-        '''
-        Compute batches for group.
-        Group is iteritems() result from group dict. group[0] is key (name), group[1] is dict of servers/gitdeploys
-
-        return list of dicts: [ { 'servers': [...], 'gitdeploys': [...] }, ... ]
-        '''
-        assert len(group) == 2
-        assert 'servers' in group[1]
-        assert 'gitdeploys' in group[1]
-
-        servers = group[1]['servers']
-        gitdeploys = group[1]['gitdeploys']
-        server_batches = elita.util.split_seq(servers, divisor)
-        gd_multiplier = len(server_batches)  # gitdeploy_batches multipler
-        ordered = isinstance(gitdeploys[0], list)
-        if ordered:
-            # duplicate all server batches by the length of the gitdeploy list-of-lists
-            server_batches = [x for item in server_batches for x in itertools.repeat(item, len(gitdeploys))]
-            gitdeploy_batches = list(gitdeploys) * gd_multiplier
-            ordered_flags = [True] * (len(gitdeploys) - 1)
-            ordered_flags.append(False)
-            ordered_flags = ordered_flags * gd_multiplier
-        else:
-            gitdeploy_batches = [gitdeploys] * gd_multiplier
-            ordered_flags = [False] * gd_multiplier
-        assert len(gitdeploy_batches) == len(server_batches)
-        batches = [{'servers': sb, 'gitdeploys': gd, 'ordered_gitdeploy': of}
-                   for sb, gd, of in zip(server_batches, gitdeploy_batches, ordered_flags)]
-        return batches
+    def compute_adaptive_stages(first_size, growth_factor, rolling_group_docs, nonrolling_group_docs):
+        '''
+        Compute batches for the adaptive (canary -> exponential) rolling strategy.
 
+        Servers of each rolling group are split into chunks of geometrically increasing size (see adaptive_batch_sizes).
+        Stage N contains chunk N of every rolling group (plus all non-rolling groups for stage 0), computed with the
+        regular batching rules so ordered gitdeploys still produce one batch per gitdeploy sublist.
 
-    @staticmethod
-    def compute_rolling_batches(divisor, rolling_group_docs, nonrolling_group_docs):
-        assert isinstance(divisor, int)
+        return list of stages, each a list of batches: [ [ { 'servers': [...], 'gitdeploys': [...] }, ... ], ... ]
+        '''
         assert elita.util.type_check.is_optional_dict(rolling_group_docs)
         assert not rolling_group_docs or all(map(lambda x: 'servers' in x[1] and 'gitdeploys' in x[1], rolling_group_docs.iteritems()))
-        return BatchCompute.dedupe_batches(
-            BatchCompute.add_nonrolling_groups(
-                BatchCompute.coalesce_batches(
-                    map(lambda x: BatchCompute.compute_group_batches(divisor, x), rolling_group_docs.iteritems() if rolling_group_docs else tuple())
-                ), nonrolling_group_docs
-            )
-        )
+        rolling_group_docs = rolling_group_docs if rolling_group_docs else dict()
+        chunks = dict()
+        for g in rolling_group_docs:
+            servers = rolling_group_docs[g]['servers']
+            chunks[g] = list()
+            offset = 0
+            for size in BatchCompute.adaptive_batch_sizes(len(servers), first_size, growth_factor):
+                chunks[g].append(servers[offset:offset+size])
+                offset += size
+        stage_count = max([len(chunks[g]) for g in chunks] + [1 if nonrolling_group_docs else 0])
+        stages = list()
+        for i in range(stage_count):
+            stage_groups = {g: {'servers': chunks[g][i], 'gitdeploys': rolling_group_docs[g]['gitdeploys']}
+                            for g in chunks if i < len(chunks[g])}
+            stages.append(BatchCompute.compute_rolling_batches(1, stage_groups,
+                                                               nonrolling_group_docs if i == 0 else None))
+        return stages
 
 
 class RollingDeployController:
@@ -214,6 +334,15 @@ class RollingDeployController:
     def get_nonrolling_groups(self, rolling_groups, all_groups):
         return list(set(all_groups) - set(rolling_groups))
 
+    def get_group_docs(self, application, groups):
+        '''
+        Returns (rolling_group_docs, nonrolling_group_docs)
+        '''
+        group_docs = {g: self.datasvc.groupsvc.GetGroup(application, g) for g in groups}
+        rolling_groups = [g for g in groups if group_docs[g]['rolling_deploy']]
+        nonrolling_groups = self.get_nonrolling_groups(rolling_groups, groups)
+        return {g: group_docs[g] for g in rolling_groups}, {g: group_docs[g] for g in nonrolling_groups}
+
     def compute_batches(self, rolling_group_docs, nonrolling_group_docs, rolling_divisor):
         return BatchCompute.compute_rolling_batches(rolling_divisor, rolling_group_docs, nonrolling_group_docs)
 
@@ -238,73 +367,289 @@ class RollingDeployController:
             args['hook_parameters']['batch'] = batches[batch_number]
         self.datasvc.actionsvc.hooks.run_hook(application, name, args)
 
-    def run(self, application, build_name, target, rolling_divisor, rolling_pause, ordered_pause, parallel=True):
+    def compute_stages(self, rolling_group_docs, nonrolling_group_docs, rolling_divisor, strategy=None):
+        '''
+        Returns list of stages (lists of batches). The divisor strategy is a single stage containing every batch
+        '''
+        if strategy and strategy['name'] == 'adaptive':
+            return BatchCompute.compute_adaptive_stages(strategy['canary_size'], strategy['growth_factor'],
+                                                        rolling_group_docs, nonrolling_group_docs)
+        return [self.compute_batches(rolling_group_docs, nonrolling_group_docs, rolling_divisor)]
+
+    def adapt_stage_size(self, size, strategy, duration, previous_duration):
+        '''
+        Adaptive strategy: grow the next stage geometrically if the last one was healthy. If the last stage took more
+        than growth_factor times longer than the one before it (ie, time grew faster than the number of servers) the
+        targets are struggling, so shrink back towards the canary size instead.
+
+        Returns (next_size, slowed_down)
+        '''
+        growth = strategy['growth_factor']
+        if previous_duration is not None and duration > previous_duration * growth:
+            return max(strategy['canary_size'], size // growth), True
+        return size * growth, False
+
+    def run(self, application, build_name, target, rolling_divisor, rolling_pause, ordered_pause, parallel=True,
+            strategy=None, planned_stages=None, checkpoint=None):
         '''
         Run rolling deployment. This should be called iff the deployment is called via groups/environments
+
+        strategy is None (split into rolling_divisor batches) or a dict:
+        { 'name': 'adaptive', 'canary_size': int, 'growth_factor': int }
+        Adaptive deployments start with a canary batch of canary_size servers per rolling group, then grow batch size
+        by growth_factor after each healthy stage. Errors halt the deployment (as with the divisor strategy).
+
+        planned_stages (optional) are precomputed stages from a cached deployment plan, used instead of computing them
+
+        checkpoint (optional) is the checkpoint of a previous run of this deployment (see
+        DeploymentDataService.GetCheckpoint). The checkpointed plan is reused and completed batches/gitdeploys are skipped.
+        Every completed batch is checkpointed as the deployment progresses.
         '''
 
-        groups = target['groups']
-        rolling_groups = [g for g in groups if self.datasvc.groupsvc.GetGroup(application, g)['rolling_deploy']]
-        rolling_group_docs = {g: self.datasvc.groupsvc.GetGroup(application, g) for g in rolling_groups}
-        nonrolling_groups = self.get_nonrolling_groups(rolling_groups, groups)
-        nonrolling_group_docs = {g: self.datasvc.groupsvc.GetGroup(application, g) for g in nonrolling_groups}
+        rolling_group_docs, nonrolling_group_docs = self.get_group_docs(application, target['groups'])
 
         gd_docs = [self.datasvc.gitsvc.GetGitDeploy(application, gd) for gd in target['gitdeploys']]
         gitrepos = [gd['location']['gitrepo']['name'] for gd in gd_docs]
 
-        batches = self.compute_batches(rolling_group_docs, nonrolling_group_docs, rolling_divisor)
+        adaptive = bool(strategy and strategy['name'] == 'adaptive')
+        if checkpoint and checkpoint['plan']:
+            stages = BatchCompute.split_stages(checkpoint['plan']['batches'], checkpoint['plan']['stage_sizes'])
+        elif planned_stages:
+            stages = planned_stages
+        else:
+            stages = self.compute_stages(rolling_group_docs, nonrolling_group_docs, rolling_divisor, strategy)
+        batches = [b for s in stages for b in s]
 
         logging.debug("computed batches: {}".format(batches))
 
-        #run pre hook
-        self.run_hook("AUTO_DEPLOYMENT_START", application, build_name, batches, target=target)
+        if checkpoint:
+            self.datasvc.jobsvc.NewJobData({
+                "RollingDeployment": {
+                    "message": "resuming deployment",
+                    "completed_batches": len([b for b in checkpoint['batches'] if checkpoint['batches'][b].get('complete')]),
+                    "batches": len(batches)
+                }
+            })
+        else:
+            #run pre hook
+            self.run_hook("AUTO_DEPLOYMENT_START", application, build_name, batches, target=target)
 
-        self.datasvc.deploysvc.InitializeDeploymentPlan(application, self.deployment_id, batches, gitrepos)
+            self.datasvc.deploysvc.InitializeDeploymentPlan(application, self.deployment_id, batches, gitrepos)
 
-        self.datasvc.jobsvc.NewJobData({
-            "RollingDeployment": {
-                "batches": len(batches),
-                "batch_data": batches
-            }
-        })
+            self.datasvc.jobsvc.NewJobData({
+                "RollingDeployment": {
+                    "strategy": strategy['name'] if strategy else 'divisor',
+                    "batches": len(batches),
+                    "batch_data": batches
+                }
+            })
+        self.datasvc.deploysvc.CheckpointPlan(application, self.deployment_id, stages)
 
-        for i, b in enumerate(batches):
-            logging.debug("doing DeployController.run: deploy_gds: {}".format(b['gitdeploys']))
+        i = 0
+        stage_number = 0
+        stage_size = strategy['canary_size'] if adaptive else None
+        previous_duration = None
+        while stage_number < len(stages):
+            duration = 0.0
+            skipped = 0
+            for b in stages[stage_number]:
+                # stop scheduling batches as soon as a cancel is requested (raises DeploymentCancelled)
+                self.dc.check_cancelled(application, force=True)
+                gitdeploys = remaining_gitdeploys(checkpoint, i, b['gitdeploys'])
+                if not gitdeploys:
+                    logging.debug("RollingDeployController: batch {} already complete, skipping".format(i))
+                    skipped += 1
+                    i += 1
+                    continue
+
+                logging.debug("doing DeployController.run: deploy_gds: {}".format(gitdeploys))
+
+                #run start hook
+                self.run_hook("AUTO_DEPLOYMENT_BATCH_BEGIN", application, build_name, batches, batch_number=i)
+
+                start = time.time()
+                ok, results = self.dc.run(application, build_name, b['servers'], gitdeploys,
+                                          parallel=parallel, batch_number=i)
+                duration += time.time() - start
+                if not ok:
+                    self.datasvc.jobsvc.NewJobData({"RollingDeployment": "error"})
+                    self.run_hook("AUTO_DEPLOYMENT_FAILED", application, build_name, batches)
+                    return False
+
+                self.datasvc.deploysvc.CheckpointBatch(application, self.deployment_id, i)
+
+                #run batch done hook
+                self.run_hook("AUTO_DEPLOYMENT_BATCH_DONE", application, build_name, batches, batch_number=i)
+
+                deploy_doc = self.datasvc.deploysvc.GetDeployment(application, self.deployment_id)
+                assert deploy_doc
+                if deploy_doc['status'] == 'error':
+                    self.datasvc.jobsvc.NewJobData({"message": "detected failed deployment so aborting further batches"})
+                    self.datasvc.jobsvc.NewJobData({"RollingDeployment": "error"})
+                    self.run_hook("AUTO_DEPLOYMENT_FAILED", application, build_name, batches)
+                    return False
+
+                if i != (len(batches)-1):
+                    pause = ordered_pause if b['ordered_gitdeploy'] else rolling_pause
+                    msg = "pausing for {} seconds between batches ({})".format(pause,
+                                                                               "ordered" if b['ordered_gitdeploy']
+                                                                               else "batch complete")
+                    self.datasvc.jobsvc.NewJobData({"RollingDeployment": msg})
+                    logging.debug("RollingDeployController: {}".format(msg))
+                    self.dc.pause(application, pause)
+                i += 1
+
+            if adaptive:
+                deployed = set([s for b in stages[stage_number] for s in b['servers']])
+                for g in rolling_group_docs:
+                    rolling_group_docs[g] = dict(rolling_group_docs[g])
+                    rolling_group_docs[g]['servers'] = [s for s in rolling_group_docs[g]['servers'] if s not in deployed]
+                if skipped == len(stages[stage_number]):
+                    # completed in a previous run: assume it was healthy
+                    stage_size, slowed_down = stage_size * strategy['growth_factor'], False
+                    previous_duration = None
+                else:
+                    stage_size, slowed_down = self.adapt_stage_size(stage_size, strategy, duration, previous_duration)
+                    previous_duration = duration
+                if slowed_down and stage_number < len(stages)-1:
+                    # replan everything after this stage with the smaller size
+                    remaining = BatchCompute.compute_adaptive_stages(stage_size, strategy['growth_factor'],
+                                                                     rolling_group_docs, None)
+                    stages = stages[:stage_number+1] + remaining
+                    batches = batches[:i] + [b for s in remaining for b in s]
+                    self.datasvc.deploysvc.InitializeDeploymentPlan(application, self.deployment_id, batches,
+                                                                    gitrepos, start_batch=i)
+                    self.datasvc.deploysvc.CheckpointPlan(application, self.deployment_id, stages)
+                    self.datasvc.jobsvc.NewJobData({
+                        "RollingDeployment": {
+                            "message": "stage {} was slow ({:.1f}s); reducing batch size to {}".format(
+                                stage_number, duration, stage_size),
+                            "batches": len(batches),
+                            "batch_data": batches[i:]
+                        }
+                    })
+            stage_number += 1
 
-            #run start hook
-            self.run_hook("AUTO_DEPLOYMENT_BATCH_BEGIN", application, build_name, batches, batch_number=i)
+        #run post hook
+        self.run_hook("AUTO_DEPLOYMENT_COMPLETE", application, build_name, batches, target=target)
+        return True
 
-            ok, results = self.dc.run(application, build_name, b['servers'], b['gitdeploys'],
-                                      parallel=parallel, batch_number=i)
-            if not ok:
-                self.datasvc.jobsvc.NewJobData({"RollingDeployment": "error"})
-                self.run_hook("AUTO_DEPLOYMENT_FAILED", application, build_name, batches)
-                return False
+# per-process state for deployment pool workers (see DeploymentWorkerPool)
+_worker_state = dict()
+
+def _init_deployment_worker(settings, job_id, salt_limiter=None):
+    '''
+    DeploymentWorkerPool initializer. Each worker process creates its mongo client/DataService and salt clients once
+    and reuses them for every phase 1/phase 2 task it runs for the lifetime of the deployment.
+    '''
+    _worker_state['salt_limiter'] = salt_limiter
+    _worker_state['client'], _worker_state['datasvc'] = regen_datasvc(settings, job_id)
+    _worker_state['sc'] = salt_control.SaltController(_worker_state['datasvc'])
+    _worker_state['rc'] = salt_control.RemoteCommands(_worker_state['sc'])
 
-            #run batch done hook
-            self.run_hook("AUTO_DEPLOYMENT_BATCH_DONE", application, build_name, batches, batch_number=i)
+def _get_worker_datasvc(settings, job_id):
+    '''
+    Return warm DataService if running in a pool worker, otherwise create a new one
+    '''
+    if 'datasvc' in _worker_state:
+        return _worker_state['client'], _worker_state['datasvc']
+    return regen_datasvc(settings, job_id)
 
-            deploy_doc = self.datasvc.deploysvc.GetDeployment(application, self.deployment_id)
-            assert deploy_doc
-            if deploy_doc['status'] == 'error':
-                self.datasvc.jobsvc.NewJobData({"message": "detected failed deployment so aborting further batches"})
-                self.datasvc.jobsvc.NewJobData({"RollingDeployment": "error"})
-                self.run_hook("AUTO_DEPLOYMENT_FAILED", application, build_name, batches)
-                return False
+def _get_worker_salt(datasvc):
+    '''
+    Return warm (SaltController, RemoteCommands) if running in a pool worker, otherwise create new ones
+    '''
+    if 'sc' in _worker_state:
+        return _worker_state['sc'], _worker_state['rc']
+    sc = salt_control.SaltController(datasvc)
+    return sc, salt_control.RemoteCommands(sc)
 
-            if i != (len(batches)-1):
-                pause = ordered_pause if b['ordered_gitdeploy'] else rolling_pause
-                msg = "pausing for {} seconds between batches ({})".format(pause,
-                                                                           "ordered" if b['ordered_gitdeploy']
-                                                                           else "batch complete")
-                self.datasvc.jobsvc.NewJobData({"RollingDeployment": msg})
-                logging.debug("RollingDeployController: {}".format(msg))
-                time.sleep(pause)
+class SerialResult:
+    '''
+    Result of a task run synchronously (non-parallel deployments). Same interface as the billiard AsyncResult
+    '''
+    def __init__(self, func, args):
+        self.exc_info = None
+        try:
+            self.value = func(*args)
+        except:
+            self.exc_info = sys.exc_info()
 
-        #run post hook
-        self.run_hook("AUTO_DEPLOYMENT_COMPLETE", application, build_name, batches, target=target)
+    def ready(self):
         return True
 
+    def get(self, timeout=None):
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class DeploymentWorkerPool:
+    '''
+    Bounded pool of long-lived worker processes that runs the phase 1/phase 2 tasks of a deployment (across all rolling
+    batches) instead of forking a new process per gitrepo/gitdeploy per batch.
+
+    If parallel is False, tasks are run synchronously in the calling process.
+    '''
+    __metaclass__ = elita.util.LoggingMetaClass
+
+    def __init__(self, settings, job_id, parallel=True, salt_limiter=None):
+        self.parallel = parallel
+        self.pool = None
+        if parallel:
+            size = int(settings.get('elita.deployment.workers', DEFAULT_DEPLOYMENT_WORKERS))
+            self.pool = billiard.Pool(processes=size, initializer=_init_deployment_worker,
+                                      initargs=(settings, job_id, salt_limiter))
+
+    def submit(self, func, args):
+        return self.pool.apply_async(func, args) if self.parallel else SerialResult(func, args)
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+class CombinedPullResult:
+    '''
+    Phase 2 task for gitdeploys pulled together (combine_states). Each gitdeploy's servers are prepared by its own pool
+    task and the combined pull is submitted (submit_pull(prepared)) once all of them have finished. A prepare whose
+    worker died is reported with prepare_failed(gitdeploy, msg) and passed on as None. Same interface as the billiard
+    AsyncResult
+    '''
+    def __init__(self, prepares, submit_pull, prepare_failed):
+        self.prepares = prepares    # { gitdeploy: AsyncResult }
+        self.submit_pull = submit_pull
+        self.prepare_failed = prepare_failed
+        self.pull = None
+
+    def ready(self):
+        if self.pull is None:
+            if not all([self.prepares[gd].ready() for gd in self.prepares]):
+                return False
+            prepared = dict()
+            for gd in self.prepares:
+                try:
+                    prepared[gd] = self.prepares[gd].get(0)
+                except:
+                    self.prepare_failed(gd, "process died: {}".format(sys.exc_info()[1]))
+                    prepared[gd] = None
+            self.pull = self.submit_pull(prepared)
+        return self.pull.ready()
+
+    def get(self, timeout=None):
+        end = time.time() + timeout if timeout is not None else None
+        while not self.ready() and self.pull is None:
+            if end is not None and time.time() >= end:
+                raise billiard.TimeoutError()
+            time.sleep(PIPELINE_POLL_INTERVAL)
+        return self.pull.get(None if end is None else max(end - time.time(), 0))
+
 def determine_deployabe_servers(all_gd_servers, specified_servers):
     return list(set(all_gd_servers).intersection(set(specified_servers)))
 
@@ -312,12 +657,19 @@ def _threadsafe_process_gitdeploy(gddoc, build_doc, settings, job_id, deployment
     '''
     Threadsafe function for processing a single gitdeploy during a deployment.
     Creates own instance of datasvc, etc.
+
+    Returns True if the gitrepo was processed (committed and pushed, or already up to date), False on error
     '''
+    client, datasvc = _get_worker_datasvc(settings, job_id)
+    try:
+        return _process_gitdeploy(datasvc, gddoc, build_doc, deployment_id)
+    finally:
+        datasvc.deploysvc.FlushProgress()
 
+def _process_gitdeploy(datasvc, gddoc, build_doc, deployment_id):
     package = gddoc['package']
     package_doc = build_doc['packages'][package]
 
-    client, datasvc = regen_datasvc(settings, job_id)
     gdm = gitservice.GitDeployManager(gddoc, datasvc)
     gitrepo_name = gddoc['location']['gitrepo']['name']
 
@@ -332,12 +684,13 @@ def _threadsafe_process_gitdeploy(gddoc, build_doc, settings, job_id, deployment
         exc_msg.insert(0, "ERROR: checkout_default_branch")
         datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                                   step=exc_msg)
-        return
+        return False
 
     logging.debug("_threadsafe_process_gitdeploy: git checkout output: {}".format(str(res)))
 
     if gdm.last_build == build_doc['build_name']:
         datasvc.jobsvc.NewJobData({"ProcessGitdeploys": {gitrepo_name: "already processed"}})
+        _record_commit_hash(datasvc, gdm, gddoc, deployment_id)
         datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                               progress=100,
                                               step='Complete (already processed)')
@@ -355,7 +708,7 @@ def _threadsafe_process_gitdeploy(gddoc, build_doc, settings, job_id, deployment
             exc_msg.insert(0, "ERROR: decompress_to_repo")
             datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                                       step=exc_msg)
-            return
+            return False
 
         datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                               progress=50,
@@ -369,10 +722,11 @@ def _threadsafe_process_gitdeploy(gddoc, build_doc, settings, job_id, deployment
             exc_msg.insert(0, "ERROR: check_repo_status")
             datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                                       step=exc_msg)
-            return
+            return False
         logging.debug("_threadsafe_process_gitdeploy: git status results: {}".format(str(res)))
 
         if "nothing to commit" in res:
+            _record_commit_hash(datasvc, gdm, gddoc, deployment_id)
             datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                               progress=100,
                                               step='Complete (no changes found)')
@@ -389,7 +743,7 @@ def _threadsafe_process_gitdeploy(gddoc, build_doc, settings, job_id, deployment
                 exc_msg.insert(0, "ERROR: add_files_to_repo")
                 datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                                           step=exc_msg)
-                return
+                return False
             logging.debug("_threadsafe_process_gitdeploy: git add result: {}".format(str(res)))
 
             datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
@@ -403,19 +757,10 @@ def _threadsafe_process_gitdeploy(gddoc, build_doc, settings, job_id, deployment
                 exc_msg.insert(0, "ERROR: commit_to_repo")
                 datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                                           step=exc_msg)
-                return
+                return False
             logging.debug("_threadsafe_process_gitdeploy: git commit result: {}".format(str(res)))
 
-            try:
-                commit_hash = gdm.get_latest_commit_hash()
-                datasvc.deploysvc.UpdateDeployment(gddoc['application'], deployment_id,
-                                                   {'commits': {gitrepo_name: str(commit_hash)}})
-                logging.debug("_threadsafe_process_gitdeploy: git commit hash: {}".format(str(commit_hash)))
-            except:
-                exc_msg = str(sys.exc_info()[1]).split('\n')
-                exc_msg.insert(0, "ERROR: get_commit_hash")
-                datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
-                                                          step=exc_msg)
+            _record_commit_hash(datasvc, gdm, gddoc, deployment_id)
 
             datasvc.jobsvc.NewJobData({"ProcessGitdeploys": {gddoc['name']: "checking diff"}})
             try:
@@ -425,7 +770,7 @@ def _threadsafe_process_gitdeploy(gddoc, build_doc, settings, job_id, deployment
                 exc_msg.insert(0, "ERROR: inspect_latest_diff")
                 datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                                           step=exc_msg)
-                return
+                return False
             logging.debug("_threadsafe_process_gitdeploy: inspect diff result: {}".format(str(res)))
 
             # change to a list of dicts without filenames as keys to keep mongo happy
@@ -450,7 +795,7 @@ def _threadsafe_process_gitdeploy(gddoc, build_doc, settings, job_id, deployment
                 exc_msg.insert(0, "ERROR: push_repo")
                 datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                                           step=exc_msg)
-                return
+                return False
             logging.debug("_threadsafe_process_gitdeploy: git push result: {}".format(str(res)))
             datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                               progress=100,
@@ -462,7 +807,56 @@ def _threadsafe_process_gitdeploy(gddoc, build_doc, settings, job_id, deployment
             exc_msg.insert(0, "ERROR: update_repo_last_build")
             datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
                                                       step=exc_msg)
-            return
+            return False
+    return True
+
+def _record_commit_hash(datasvc, gdm, gddoc, deployment_id):
+    '''
+    Record the commit the gitrepo is at (whether or not this deployment committed anything) in the deployment, so
+    phase 2 can skip servers that are already there
+    '''
+    gitrepo_name = gddoc['location']['gitrepo']['name']
+    try:
+        commit_hash = gdm.get_latest_commit_hash()
+        datasvc.deploysvc.UpdateDeployment(gddoc['application'], deployment_id,
+                                           {'commits': {gitrepo_name: str(commit_hash)}})
+        logging.debug("_threadsafe_process_gitdeploy: git commit hash: {}".format(str(commit_hash)))
+    except:
+        exc_msg = str(sys.exc_info()[1]).split('\n')
+        exc_msg.insert(0, "ERROR: get_commit_hash")
+        datasvc.deploysvc.UpdateDeployment_Phase1(gddoc['application'], deployment_id, gitrepo_name,
+                                                  step=exc_msg)
+
+def _split_state_results(results, gitdeploys, state_owners):
+    '''
+    Split returns of a combined state run (several gitdeploy SLS files in one state.sls call) by gitdeploy:
+    { gitdeploy: { server: { 'ret': ... } } }
+
+    States are attributed by state ID (state_owners: { state_id: gitdeploy }). Unknown states and simple (non-state)
+    returns go to every gitdeploy in the call. A gitdeploy with no states in a server's return was not run (an earlier
+    failhard state failed) and gets a failed result.
+    '''
+    split = {gd: dict() for gd in gitdeploys}
+    for server in results:
+        ret = results[server]['ret']
+        if not elita.util.type_check.is_dictlike(ret):
+            for gd in gitdeploys:
+                split[gd][server] = {'ret': ret}
+            continue
+        by_gitdeploy = {gd: dict() for gd in gitdeploys}
+        for state in ret:
+            parts = state.split('_|-')
+            owner = state_owners.get(parts[1]) if len(parts) == 4 else None
+            for gd in ([owner] if owner in by_gitdeploy else gitdeploys):
+                by_gitdeploy[gd][state] = ret[state]
+        for gd in gitdeploys:
+            if not by_gitdeploy[gd]:
+                by_gitdeploy[gd]["cmd_|-gitdeploy_{}_|-not run_|-run".format(gd)] = {
+                    'result': False,
+                    'comment': "not run (an earlier state in the combined state run failed)"
+                }
+            split[gd][server] = {'ret': by_gitdeploy[gd]}
+    return split
 
 def _threadsafe_pull_callback(results, tag, **kwargs):
     '''
@@ -481,6 +875,14 @@ def _threadsafe_pull_callback(results, tag, **kwargs):
     batch_number = kwargs['batch_number']
     gitdeploy = kwargs['gitdeploy']
     try:
+        combined = kwargs.get('combined')
+        if combined:
+            # one state run for several gitdeploys (tag is [ "sls1,sls2,..." ]): report each gitdeploy separately
+            gitdeploys = [combined['sls'][sls] for sls in tag[0].split(',')]
+            split = _split_state_results(results, gitdeploys, combined['states'])
+            for gd in gitdeploys:
+                _threadsafe_pull_callback(split[gd], tag, **dict(kwargs, gitdeploy=gd, combined=None))
+            return
         datasvc.jobsvc.NewJobData({"DeployServers": {"results": results, "tag": tag}})
         for r in results:
             #callback results always have a 'ret' key but underneath it may be a simple string or a big complex object
@@ -513,176 +915,549 @@ def _threadsafe_pull_callback(results, tag, **kwargs):
         datasvc.jobsvc.NewJobData({"_threadsafe_pull_callback EXCEPTION": traceback.format_exception(exc_type, exc_obj, tb)})
         datasvc.deploysvc.FailDeployment(app, deployment_id)
 
-def _threadsafe_pull_gitdeploy(application, gitdeploy_struct, queue, settings, job_id, deployment_id, batch_number):
+def _prepare_pull(datasvc, rc, application, deployment_id, batch_number, gd_name, servers, gd_doc, timeouts,
+                  target_commit, skip_current, connectivity_verified):
     '''
-    Thread-safe way of performing a deployment SLS call for one specific gitdeploy on a group of servers
-    gitdeploy_struct: { "gitdeploy_name": [ list_of_servers_to_deploy_to ] }
+    Get servers ready to pull gitdeploy gd_name: verify salt connectivity (unless already verified), remove stale index
+    locks, discard uncommitted changes, check out the branch and (if skip_current) find servers already at
+    target_commit. Gitdeploys with prepull/postpull actions are never skipped: the actions run in the same state run
+    as the pull (ex: a redeploy to restart services, or a retry after a failed postpull).
+
+    Returns (servers_to_pull, skipped_servers), or None if the deployment has been failed
+    '''
+    datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
+                                              progress=10,
+                                              state="Beginning deployment")
+    if len(servers) == 0:
+        datasvc.jobsvc.NewJobData({"DeployServers": {gd_name: "no servers"}})
+        return [], []
+
+    branch = gd_doc['location']['default_branch']
+    path = gd_doc['location']['path']
+
+    #verify that we have salt connectivity to the target (unless the deployment preflight did already). Do
+    #three consecutive test.pings (ping timeout each); if all target servers don't respond by the last attempt,
+    #fail deployment
+    i = 1
+    while not connectivity_verified:
+        datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
+                                                  progress=15,
+                                                  state="Verifying salt connectivity (try: {})".format(i))
+        res = rc.ping(servers, timeout=timeouts['ping'])
+        if all([s in res for s in servers]):
+            logging.debug("_threadsafe_process_gitdeploy: verify salt: all servers returned (try: {})".format(i))
+            break
+        else:
+            missing_servers = list(set(servers) - set(res.keys()))
+            logging.debug("_threadsafe_process_gitdeploy: verify salt: error: servers missing: {} (try {})".format(missing_servers, i))
+        if i >= 3:
+            datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, missing_servers, batch_number,
+                                                  progress=15,
+                                                  state="ERROR: no salt connectivity!".format(i))
+            datasvc.deploysvc.FailDeployment(application, deployment_id)
+            logging.error("No salt connectivity to servers: {} (after {} tries)".format(missing_servers, i))
+            return None
+        i += 1
+
+    #delete stale git index lock if it exists
+    datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
+                                              progress=25,
+                                              state="Removing git index lock if it exists")
+    res = rc.rm_file_if_exists(servers, "{}/.git/index.lock".format(path))
+    logging.debug("_threadsafe_process_gitdeploy: delete git index lock results: {}".format(str(res)))
+
+    #clear uncommitted changes on targets
+    datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
+                                              progress=33,
+                                              state="Clearing uncommitted changes")
+
+    res = rc.discard_git_changes(servers, path)
+    logging.debug("_threadsafe_process_gitdeploy: discard git changes result: {}".format(str(res)))
+    res = rc.checkout_branch(servers, path, branch)
+    logging.debug("_threadsafe_process_gitdeploy: git checkout result: {}".format(str(res)))
+
+    #skip servers that are already at the target commit (ex: redeploys, retries), unless there are actions to run
+    skipped = list()
+    has_actions = any([gd_doc['actions'][action] for action in ('prepull', 'postpull')])
+    if target_commit and skip_current and has_actions:
+        logging.debug("_prepare_pull: {} has prepull/postpull actions; not skipping current servers".format(gd_name))
+    elif target_commit and skip_current:
+        datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
+                                                  progress=40,
+                                                  state="Checking deployed commit")
+        try:
+            heads = rc.get_head_commits(servers, path)
+            skipped = [s for s in servers if heads.get(s) == target_commit]
+        except:
+            # not fatal: pull everything
+            logging.debug("_threadsafe_pull_gitdeploy: could not determine deployed commits: {}"
+                          .format(sys.exc_info()[1]))
+        if skipped:
+            datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, skipped, batch_number,
+                                                      progress=100,
+                                                      state="Complete (already at {})".format(target_commit[:8]))
+            datasvc.gitsvc.UpdateServerCommits(application, gd_name, skipped, target_commit)
+            datasvc.jobsvc.NewJobData({"DeployServers": {gd_name: "already current", "servers": skipped}})
+    return [s for s in servers if s not in skipped], skipped
+
+def _threadsafe_prepare_pull(application, gd_name, servers, settings, job_id, deployment_id, batch_number,
+                             timeouts, target_commit=None, skip_current=True, connectivity_verified=False):
+    '''
+    Thread-safe way of preparing one gitdeploy's servers for a pull (see _prepare_pull). Used for gitdeploys pulled
+    together in one combined task, so their prepares run in parallel pool tasks rather than one after another
+
+    Returns (servers_to_pull, skipped_servers), or None on failure (deployment will have been failed)
     '''
-    # Wrap in a big try/except so we can log any failures in phase2 progress and fail the deployment
     try:
         assert settings
         assert job_id
-        assert gitdeploy_struct
-        client, datasvc = regen_datasvc(settings, job_id)
-        gd_name = gitdeploy_struct.keys()[0]
-        servers = gitdeploy_struct[gd_name]
+        client, datasvc = _get_worker_datasvc(settings, job_id)
     except:
         exc_msg = str(sys.exc_info()[1]).split('\n')
-        logging.error("************* _threadsafe_pull_gitdeploy: preamble: {} *********************".format(exc_msg))
-        return
+        logging.error("************* _threadsafe_prepare_pull: preamble: {} *********************".format(exc_msg))
+        return None
     try:
-        assert application
-        assert queue
-        assert deployment_id
-        assert all([elita.util.type_check.is_string(gd) for gd in gitdeploy_struct])
-        assert all([elita.util.type_check.is_seq(gitdeploy_struct[gd]) for gd in gitdeploy_struct])
-        assert isinstance(batch_number, int) and batch_number >= 0
-        sc = salt_control.SaltController(datasvc)
-        rc = salt_control.RemoteCommands(sc)
-        assert len(gitdeploy_struct) == 1
-
+        assert application and gd_name and deployment_id
+        assert elita.util.type_check.is_seq(servers)
+        sc, rc = _get_worker_salt(datasvc)
+        gd_doc = datasvc.gitsvc.GetGitDeploy(application, gd_name)
+        return _prepare_pull(datasvc, rc, application, deployment_id, batch_number, gd_name, servers, gd_doc, timeouts,
+                             target_commit, skip_current, connectivity_verified)
+    except:
+        exc_type, exc_obj, tb = sys.exc_info()
+        exc_msg = "ERROR: Exception in _threadsafe_prepare_pull: {}".format(traceback.format_exception(exc_type, exc_obj,
+                                                                                                      tb))
         datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
-                                                  progress=10,
-                                                  state="Beginning deployment")
-
-        #until salt Helium is released, we can only execute an SLS *file* as opposed to a single module call
-        sls_map = {sc.get_gitdeploy_entry_name(application, gd_name): servers}
-        if len(servers) == 0:
-            datasvc.jobsvc.NewJobData({"DeployServers": {gd_name: "no servers"}})
-            return True
+                                                  state=exc_msg)
+        datasvc.deploysvc.FailDeployment(application, deployment_id)
+        return None
+    finally:
+        datasvc.deploysvc.FlushProgress()
 
-        gd_doc = datasvc.gitsvc.GetGitDeploy(application, gd_name)
-        branch = gd_doc['location']['default_branch']
-        path = gd_doc['location']['path']
+def _state_ids(gd_name, gd_doc):
+    '''
+    State IDs declared by a gitdeploy's SLS file: the pull plus its prepull/postpull actions (see
+    SaltController.render_gitdeploy_sls)
+    '''
+    ids = ['gitdeploy_{}'.format(gd_name)]
+    for action in ('prepull', 'postpull'):
+        ids += [state_id.replace(gitservice.EMBEDDED_YAML_DOT_REPLACEMENT, '.')
+                for state_id in gd_doc['actions'][action] or dict()]
+    return ids
 
-        #verify that we have salt connectivity to the target. Do three consecutive test.pings with 10 second timeouts
-        #if all target servers don't respond by the last attempt, fail deployment
-        i = 1
-        while True:
-            datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
-                                                      progress=15,
-                                                      state="Verifying salt connectivity (try: {})".format(i))
-            res = rc.ping(servers)
-            if all([s in res for s in servers]):
-                logging.debug("_threadsafe_process_gitdeploy: verify salt: all servers returned (try: {})".format(i))
+def _combinable_groups(gd_docs):
+    '''
+    Split gitdeploys into groups that can share a state run. Salt rejects a state run in which two SLS files declare
+    the same state ID (ex: a "restart" postpull action in two gitdeploys), so gitdeploys with colliding IDs are put in
+    separate groups. Returns a list of sorted tuples of gitdeploy names
+    '''
+    groups = list()     # [ ([gitdeploys], set(state_ids)) ]
+    for gd in sorted(gd_docs):
+        ids = set(_state_ids(gd, gd_docs[gd]))
+        for gitdeploys, used in groups:
+            if not ids & used:
+                gitdeploys.append(gd)
+                used.update(ids)
                 break
-            else:
-                missing_servers = list(set(servers) - set(res.keys()))
-                logging.debug("_threadsafe_process_gitdeploy: verify salt: error: servers missing: {} (try {})".format(missing_servers, i))
-            if i >= 3:
-                datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, missing_servers, batch_number,
-                                                      progress=15,
-                                                      state="ERROR: no salt connectivity!".format(i))
-                datasvc.deploysvc.FailDeployment(application, deployment_id)
-                logging.error("No salt connectivity to servers: {} (after {} tries)".format(missing_servers, i))
-                return False
-            i += 1
-
-        #delete stale git index lock if it exists
-        datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
-                                                  progress=25,
-                                                  state="Removing git index lock if it exists")
-        res = rc.rm_file_if_exists(servers, "{}/.git/index.lock".format(path))
-        logging.debug("_threadsafe_process_gitdeploy: delete git index lock results: {}".format(str(res)))
-
-        #clear uncommitted changes on targets
-        datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
-                                                  progress=33,
-                                                  state="Clearing uncommitted changes")
+        else:
+            groups.append(([gd], ids))
+    return [tuple(gitdeploys) for gitdeploys, used in groups]
 
-        res = rc.discard_git_changes(servers, path)
-        logging.debug("_threadsafe_process_gitdeploy: discard git changes result: {}".format(str(res)))
-        res = rc.checkout_branch(servers, path, branch)
-        logging.debug("_threadsafe_process_gitdeploy: git checkout result: {}".format(str(res)))
+def _state_owners(gd_docs):
+    '''
+    Map state IDs in gitdeploy SLS files to their gitdeploy: { state_id: gitdeploy }. The gitdeploys must not declare
+    the same state IDs (see _combinable_groups)
+    '''
+    owners = dict()
+    for gd in gd_docs:
+        for state_id in _state_ids(gd, gd_docs[gd]):
+            assert state_id not in owners, "state ID {} in both {} and {}".format(state_id, owners[state_id], gd)
+            owners[state_id] = gd
+    return owners
+
+def _run_pull_states(datasvc, sc, rc, application, deployment_id, batch_number, servers_by_gitdeploy, gd_docs,
+                     salt_concurrency, timeouts):
+    '''
+    Issue the state calls that pull gitdeploys on their servers. Each server gets one state.sls call covering all of
+    its gitdeploys (SLS names comma-separated, in sorted gitdeploy order; ordered gitdeploys are always in separate
+    batches so never share a call), so servers with the same set of gitdeploys share a salt job.
 
-        datasvc.jobsvc.NewJobData({"DeployServers": {gd_name: "deploying", "servers": servers}})
-        logging.debug("_threadsafe_pull_gitdeploy: sls_map: {}".format(sls_map))
+    All server groups (and their max_minions chunks) go to salt at once in one run_slses_async call; the deployment's
+    SaltJobLimiter caps how many of those jobs/minions are in flight.
 
-        datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
-                                                  progress=50,
-                                                  state="Issuing state commands (git pull, etc)")
-        res = rc.run_slses_async(_threadsafe_pull_callback, sls_map, args={'datasvc': datasvc, 'application': application,
-                                                                           'deployment_id': deployment_id,
-                                                                           'batch_number': batch_number,
-                                                                           'gitdeploy': gd_name})
-        logging.debug("_threadsafe_pull_gitdeploy: results: {}".format(res))
-
-        errors = dict()
-        successes = dict()
+    Returns per-gitdeploy results: { gitdeploy: [ { server: { 'ret': ... } } ] }
+    '''
+    gitdeploys_by_server = dict()
+    for gd in sorted(servers_by_gitdeploy):
+        for s in servers_by_gitdeploy[gd]:
+            gitdeploys_by_server.setdefault(s, list()).append(gd)
+    server_groups = dict()
+    for s in gitdeploys_by_server:
+        server_groups.setdefault(tuple(gitdeploys_by_server[s]), list()).append(s)
+    sls_names = {gd: sc.get_gitdeploy_entry_name(application, gd) for gd in servers_by_gitdeploy}
+    sls_map = {sls_names[gitdeploys[0]] if len(gitdeploys) == 1 else ','.join([sls_names[gd] for gd in gitdeploys]):
+               sorted(server_groups[gitdeploys]) for gitdeploys in server_groups}
+    combined = {
+        'sls': {sls_names[gd]: gd for gd in sls_names},
+        'states': _state_owners(gd_docs)
+    } if len(servers_by_gitdeploy) > 1 else None
+
+    # respect deployment-wide caps on concurrent salt jobs/minions: jobs are at most max_minions servers and each
+    # holds limiter slots while it runs. Non-parallel deployments have no shared limiter, so use a local one
+    salt_concurrency = salt_concurrency if salt_concurrency else dict()
+    max_minions = salt_concurrency.get('max_minions', 0)
+    limiter = _worker_state.get('salt_limiter')
+    if limiter is None and (salt_concurrency.get('max_jobs') or max_minions):
+        limiter = salt_control.SaltJobLimiter(salt_concurrency.get('max_jobs', 0), max_minions)
+    res = rc.run_slses_async(_threadsafe_pull_callback, sls_map,
+                             args={'datasvc': datasvc, 'application': application, 'deployment_id': deployment_id,
+                                   'batch_number': batch_number, 'gitdeploy': sorted(servers_by_gitdeploy)[0],
+                                   'combined': combined},
+                             batch=salt_concurrency.get('batch'), timeout=timeouts['state'], max_minions=max_minions,
+                             limiter=limiter)
+    if not combined:
+        return {gd: res for gd in servers_by_gitdeploy}
+
+    # attribute each return to the gitdeploys of the server it came from
+    results = {gd: list() for gd in servers_by_gitdeploy}
+    for r in res:
+        by_group = dict()
+        for server in r:
+            if server not in gitdeploys_by_server:
+                logging.debug("_run_pull_states: ignoring return from untargeted server {}".format(server))
+                continue
+            by_group.setdefault(tuple(gitdeploys_by_server[server]), dict())[server] = r[server]
+        for gitdeploys in by_group:
+            split = _split_state_results(by_group[gitdeploys], gitdeploys, combined['states'])
+            for gd in gitdeploys:
+                results[gd].append(split[gd])
+    return results
+
+def _summarize_pull(datasvc, application, deployment_id, batch_number, gd_name, servers, skipped, res,
+                    target_commit):
+    '''
+    Record phase 2 progress/commits for one gitdeploy from its state results and return its deploy results
+    '''
+    errors = dict()
+    successes = dict()
+    for r in res:
+        for host in r:
+            for cmd in r[host]['ret']:
+                if "gitdeploy" in cmd:
+                    if "result" in r[host]['ret'][cmd]:
+                        if not r[host]['ret'][cmd]["result"]:
+                            errors[host] = r[host]['ret'][cmd]["changes"] if "changes" in r[host]['ret'][cmd] else r[host]['ret'][cmd]
+                        else:
+                            if host not in successes:
+                                successes[host] = dict()
+                            module, state, command, subcommand = str(cmd).split('|')
+                            if state not in successes[host]:
+                                successes[host][state] = dict()
+                            successes[host][state][command] = {
+                                "stdout": r[host]['ret'][cmd]["changes"]["stdout"],
+                                "stderr": r[host]['ret'][cmd]["changes"]["stderr"],
+                                "retcode": r[host]['ret'][cmd]["changes"]["retcode"],
+                            }
+    if len(errors) > 0:
+        for e in errors:
+            datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, [e], batch_number,
+                                              state="ERROR: {}".format(errors[e]))
+        logging.debug("_threadsafe_pull_gitdeploy: SLS error servers: {}".format(errors.keys()))
+        logging.debug("_threadsafe_pull_gitdeploy: SLS error responses: {}".format(errors))
+
+    if len(successes) > 0:
+        datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, successes.keys(), batch_number,
+                                                  progress=100, state="Complete")
+        # a server is only current once its whole state run (including prepull/postpull actions) succeeded
+        failed = set()
         for r in res:
             for host in r:
-                for cmd in r[host]['ret']:
-                    if "gitdeploy" in cmd:
-                        if "result" in r[host]['ret'][cmd]:
-                            if not r[host]['ret'][cmd]["result"]:
-                                errors[host] = r[host]['ret'][cmd]["changes"] if "changes" in r[host]['ret'][cmd] else r[host]['ret'][cmd]
-                            else:
-                                if host not in successes:
-                                    successes[host] = dict()
-                                module, state, command, subcommand = str(cmd).split('|')
-                                if state not in successes[host]:
-                                    successes[host][state] = dict()
-                                successes[host][state][command] = {
-                                    "stdout": r[host]['ret'][cmd]["changes"]["stdout"],
-                                    "stderr": r[host]['ret'][cmd]["changes"]["stderr"],
-                                    "retcode": r[host]['ret'][cmd]["changes"]["retcode"],
-                                }
-        if len(errors) > 0:
-            for e in errors:
-                datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, [e], batch_number,
-                                                  state="ERROR: {}".format(errors[e]))
-            logging.debug("_threadsafe_pull_gitdeploy: SLS error servers: {}".format(errors.keys()))
-            logging.debug("_threadsafe_pull_gitdeploy: SLS error responses: {}".format(errors))
-
-        if len(successes) > 0:
-            datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, successes.keys(), batch_number,
-                                                      progress=100, state="Complete")
-
-        missing = list(set([host for r in res for host in r]).difference(set(servers)))
-        if missing:
-            datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, missing, batch_number,
-                                                      state="ERROR: no results (timed out waiting for salt?)")
-            logging.debug("_threadsafe_pull_gitdeploy: error: empty results for: {}; possible salt timeout".format(missing))
-            datasvc.jobsvc.NewJobData({"_threadsafe_pull_gitdeploy": "empty results for {}".format(missing)})
-            datasvc.deploysvc.FailDeployment(application, deployment_id)
-
-        deploy_results = {
-            gd_name: {
-                "raw_results": res,
-                "errors": len(errors) > 0,
-                "error_results": errors,
-                "successes": len(successes) > 0,
-                "success_results": successes
-            }
-        }
+                ret = r[host]['ret']
+                if not elita.util.type_check.is_dictlike(ret) or \
+                        any([elita.util.type_check.is_dictlike(ret[s]) and 'result' in ret[s] and not ret[s]['result']
+                             for s in ret]):
+                    failed.add(host)
+        current = [host for host in successes if host not in failed]
+        if target_commit and current:
+            datasvc.gitsvc.UpdateServerCommits(application, gd_name, current, target_commit)
+
+    missing = list(set([host for r in res for host in r]).difference(set(servers)))
+    if missing:
+        datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, missing, batch_number,
+                                                  state="ERROR: no results (timed out waiting for salt?)")
+        logging.debug("_threadsafe_pull_gitdeploy: error: empty results for: {}; possible salt timeout".format(missing))
+        datasvc.jobsvc.NewJobData({"_threadsafe_pull_gitdeploy": "empty results for {}".format(missing)})
+        datasvc.deploysvc.FailDeployment(application, deployment_id)
 
-        queue.put_nowait(deploy_results)
+    return {
+        "raw_results": res,
+        "errors": len(errors) > 0,
+        "error_results": errors,
+        "successes": len(successes) > 0,
+        "success_results": successes,
+        "skipped": skipped
+    }
+
+def _threadsafe_pull_gitdeploy(application, gitdeploy_struct, settings, job_id, deployment_id, batch_number,
+                               salt_concurrency=None, timeouts=None, target_commit=None, skip_current=True,
+                               connectivity_verified=False, prepared=None):
+    '''
+    Thread-safe way of performing the deployment SLS calls for one or more gitdeploys on groups of servers
+    gitdeploy_struct: { "gitdeploy_name": [ list_of_servers_to_deploy_to ], ... }
+    With several gitdeploys, each server gets a single state run for all of its gitdeploys (see _run_pull_states)
+    and results are attributed back to each gitdeploy.
+    salt_concurrency: { 'max_jobs': int, 'max_minions': int, 'batch': str } (see salt_control.get_salt_concurrency)
+    timeouts: { 'task': int, 'state': int, 'ping': int } (see get_timeouts; defaults to the ini timeouts)
+    target_commit: commit the gitrepo is at for this build (from phase 1), if known ({ gitdeploy_name: commit } for
+    several gitdeploys). If skip_current is True, servers already at target_commit (per one batched git rev-parse)
+    are not pulled
+    connectivity_verified: salt connectivity to servers was already verified (see DeployController.preflight)
+    prepared: results of _threadsafe_prepare_pull if the servers were already prepared by separate pool tasks
+    ({ gitdeploy_name: (servers_to_pull, skipped_servers) | None })
+
+    Returns deploy results per gitdeploy (a gitdeploy whose servers couldn't be prepared gets an error result and the
+    rest are still pulled), or None on failure (deployment will have been failed)
+    '''
+    # Wrap in a big try/except so we can log any failures in phase2 progress and fail the deployment
+    try:
+        assert settings
+        assert job_id
+        assert gitdeploy_struct
+        client, datasvc = _get_worker_datasvc(settings, job_id)
+    except:
+        exc_msg = str(sys.exc_info()[1]).split('\n')
+        logging.error("************* _threadsafe_pull_gitdeploy: preamble: {} *********************".format(exc_msg))
+        return
+    try:
+        assert application
+        assert deployment_id
+        assert all([elita.util.type_check.is_string(gd) for gd in gitdeploy_struct])
+        assert all([elita.util.type_check.is_seq(gitdeploy_struct[gd]) for gd in gitdeploy_struct])
+        assert isinstance(batch_number, int) and batch_number >= 0
+        sc, rc = _get_worker_salt(datasvc)
+        timeouts = timeouts if timeouts else get_timeouts(settings)
+        target_commits = target_commit if elita.util.type_check.is_dictlike(target_commit) else \
+            {gd: target_commit for gd in gitdeploy_struct}
+
+        deploy_results = dict()
+        to_pull = dict()    # { gitdeploy: (servers, skipped) }
+        gd_docs = dict()
+        for gd_name in gitdeploy_struct:
+            servers = gitdeploy_struct[gd_name]
+            if prepared is not None:
+                prepared_servers = prepared.get(gd_name)
+            else:
+                gd_docs[gd_name] = datasvc.gitsvc.GetGitDeploy(application, gd_name)
+                prepared_servers = _prepare_pull(datasvc, rc, application, deployment_id, batch_number, gd_name,
+                                                 servers, gd_docs[gd_name], timeouts, target_commits.get(gd_name),
+                                                 skip_current, connectivity_verified)
+            if prepared_servers is None:
+                # this gitdeploy's servers can't be pulled (deployment has been failed); pull the others anyway
+                deploy_results[gd_name] = {
+                    "raw_results": [],
+                    "errors": True,
+                    "error_results": {s: "not pulled (see phase 2 progress)" for s in servers},
+                    "successes": False,
+                    "success_results": {},
+                    "skipped": []
+                }
+                continue
+            servers, skipped = prepared_servers
+            if not servers:
+                deploy_results[gd_name] = {
+                    "raw_results": [],
+                    "errors": False,
+                    "error_results": {},
+                    "successes": False,
+                    "success_results": {},
+                    "skipped": skipped
+                }
+                continue
+            to_pull[gd_name] = (servers, skipped)
+            datasvc.jobsvc.NewJobData({"DeployServers": {gd_name: "deploying", "servers": servers}})
+            datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
+                                                      progress=50,
+                                                      state="Issuing state commands (git pull, etc)")
+
+        if to_pull:
+            for gd_name in to_pull:
+                if gd_name not in gd_docs:
+                    gd_docs[gd_name] = datasvc.gitsvc.GetGitDeploy(application, gd_name)
+            res = _run_pull_states(datasvc, sc, rc, application, deployment_id, batch_number,
+                                   {gd: to_pull[gd][0] for gd in to_pull}, {gd: gd_docs[gd] for gd in to_pull},
+                                   salt_concurrency, timeouts)
+            logging.debug("_threadsafe_pull_gitdeploy: results: {}".format(res))
+            for gd_name in to_pull:
+                deploy_results[gd_name] = _summarize_pull(datasvc, application, deployment_id, batch_number, gd_name,
+                                                          to_pull[gd_name][0], to_pull[gd_name][1], res[gd_name],
+                                                          target_commits.get(gd_name))
 
         datasvc.jobsvc.NewJobData({
             "DeployServers": deploy_results
         })
 
         logging.debug("_threadsafe_pull_gitdeploy: finished ({})".format(gitdeploy_struct))
+        return deploy_results
 
     except:
         exc_type, exc_obj, tb = sys.exc_info()
         exc_msg = "ERROR: Exception in _threadsafe_pull_gitdeploy: {}".format(traceback.format_exception(exc_type, exc_obj, tb))
-        datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, servers, batch_number,
-                                                  state=exc_msg)
+        for gd_name in gitdeploy_struct:
+            datasvc.deploysvc.UpdateDeployment_Phase2(application, deployment_id, gd_name, gitdeploy_struct[gd_name],
+                                                      batch_number, state=exc_msg)
         datasvc.deploysvc.FailDeployment(application, deployment_id)
+    finally:
+        datasvc.deploysvc.FlushProgress()
 
 
 class DeployController:
     '''
     Class that runs deploys. Only knows about server/gitdeploy pairs, so is used for both manual-style deployments
     and group/environment deployments.
+
+    Phase 1/phase 2 tasks run on a DeploymentWorkerPool that is created on first use and reused for subsequent runs
+    (rolling batches). Call close() when the deployment is finished.
+
+    Phase 1 is only done once per gitrepo per build: subsequent runs (rolling batches) go straight to phase 2 for
+    gitdeploys whose gitrepo has already been prepared.
     '''
 
     __metaclass__ = elita.util.LoggingMetaClass
 
-    def __init__(self, datasvc, deployment_id):
+    def __init__(self, datasvc, deployment_id, salt_concurrency=None, timeouts=None, skip_current=True):
         self.deployment_id = deployment_id
+        self.skip_current = skip_current
         self.datasvc = datasvc
+        self.salt_concurrency = salt_control.get_salt_concurrency(datasvc.settings, salt_concurrency)
+        self.pool = None
+        self.timeouts = get_timeouts(datasvc.settings, timeouts)
+        self.task_timeout = self.timeouts['task']
+        self.prepared_gitrepos = dict()     # { build_name: set(gitrepos that completed phase 1) }
+        self.last_cancel_check = None
+        self.rc = None
+        self.reachable = dict()     # { server: time of last successful preflight ping }
+        self.ping_cache_ttl = int(datasvc.settings.get('elita.deployment.ping_cache_ttl', DEFAULT_PING_CACHE_TTL))
+        self.combine_states = str(datasvc.settings.get('elita.deployment.combine_states',
+                                                       DEFAULT_COMBINE_STATES)).lower() in ('true', 'yes', '1')
+
+    def gitdeploy_timeouts(self, gddoc):
+        '''
+        Deployment timeouts with any per-gitdeploy overrides (gitdeploy option 'timeouts') applied
+        '''
+        overrides = gddoc.get('options', dict()).get('timeouts')
+        return dict(self.timeouts, **{t: int(overrides[t]) for t in TIMEOUTS if overrides.get(t)}) \
+            if overrides else self.timeouts
+
+    def check_cancelled(self, app_name, force=False):
+        '''
+        Raise DeploymentCancelled if a cancel has been requested for this deployment. Unless force is True, the
+        deployment document is read at most once every CANCEL_POLL_INTERVAL seconds
+        '''
+        now = time.time()
+        if not force and self.last_cancel_check is not None and now - self.last_cancel_check < CANCEL_POLL_INTERVAL:
+            return
+        self.last_cancel_check = now
+        requested = self.datasvc.deploysvc.GetCancelRequest(app_name, self.deployment_id)
+        if requested:
+            logging.debug("DeployController: cancel requested at {}".format(requested))
+            raise DeploymentCancelled(requested)
+
+    def get_remote_commands(self):
+        if self.rc is None:
+            sc, self.rc = _get_worker_salt(self.datasvc)
+        return self.rc
+
+    def preflight(self, app_name, servers_by_gitdeploy, batch_number, ping_timeout):
+        '''
+        Verify salt connectivity to all servers about to be deployed to: the union of the servers of all gitdeploys is
+        pinged at once (up to PREFLIGHT_ATTEMPTS times, retrying only the missing servers). Servers that responded
+        within the last elita.deployment.ping_cache_ttl seconds aren't pinged again.
+
+        Unreachable servers are reported once (per gitdeploy in the progress field) and the deployment is failed.
+        Returns True if all servers are reachable
+        '''
+        now = time.time()
+        servers = set([s for gd in servers_by_gitdeploy for s in servers_by_gitdeploy[gd]])
+        missing = sorted([s for s in servers if now - self.reachable.get(s, -self.ping_cache_ttl) > self.ping_cache_ttl])
+        attempt = 0
+        while missing and attempt < PREFLIGHT_ATTEMPTS:
+            attempt += 1
+            logging.debug("DeployController: preflight: pinging {} servers (try: {})".format(len(missing), attempt))
+            res = self.get_remote_commands().ping(missing, timeout=ping_timeout)
+            now = time.time()
+            for s in missing:
+                if s in res:
+                    self.reachable[s] = now
+            missing = [s for s in missing if s not in res]
+        if not missing:
+            return True
+        logging.error("No salt connectivity to servers: {} (after {} tries)".format(missing, attempt))
+        self.datasvc.jobsvc.NewJobData({'status': 'error', 'message': 'no salt connectivity', 'servers': missing})
+        for gd in servers_by_gitdeploy:
+            unreachable = [s for s in servers_by_gitdeploy[gd] if s in missing]
+            if unreachable:
+                self.datasvc.deploysvc.UpdateDeployment_Phase2(app_name, self.deployment_id, gd, unreachable,
+                                                               batch_number, progress=15,
+                                                               state="ERROR: no salt connectivity!")
+        self.datasvc.deploysvc.FailDeployment(app_name, self.deployment_id)
+        return False
+
+    def pause(self, app_name, seconds):
+        '''
+        Sleep for seconds (ex: between rolling batches), checking for a cancel request while waiting
+        '''
+        end = time.time() + seconds
+        remaining = seconds
+        while remaining > 0:
+            time.sleep(min(remaining, CANCEL_POLL_INTERVAL))
+            self.check_cancelled(app_name, force=True)
+            remaining = end - time.time()
+
+    def restore_checkpoint(self, build_name, checkpoint):
+        '''
+        Mark gitrepos that already completed phase 1 for build_name (per the deployment checkpoint) as prepared
+        '''
+        prepared = self.prepared_gitrepos.setdefault(build_name, set())
+        prepared.update([gr for gr in checkpoint['gitrepos'] if checkpoint['gitrepos'][gr] == build_name])
+
+    def get_pool(self, parallel):
+        if self.pool is None or self.pool.parallel != parallel:
+            self.close()
+            limiter = salt_control.SaltJobLimiter(self.salt_concurrency['max_jobs'],
+                                                  self.salt_concurrency['max_minions']) if parallel else None
+            self.pool = DeploymentWorkerPool(self.datasvc.settings, self.datasvc.job_id, parallel=parallel,
+                                             salt_limiter=limiter)
+        return self.pool
+
+    def close(self, terminate=False):
+        '''
+        Shut down worker pool (if any)
+        '''
+        if self.pool:
+            if terminate:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool = None
+
+    def get_task_result(self, result):
+        '''
+        Wait for a pool task. Returns (ok, value, error_msg); error_msg is set iff the task timed out or the worker died
+        '''
+        try:
+            return True, result.get(self.task_timeout), None
+        except billiard.TimeoutError:
+            return False, None, "timeout waiting for child process"
+        except:
+            exc_msg = str(sys.exc_info()[1])
+            return False, None, "process died: {}".format(exc_msg)
+
+    def phase1_error(self, app_name, gitrepo, msg):
+        logging.error("ERROR: _threadsafe_process_gitdeploy: {} ({})!".format(msg, gitrepo))
+        self.datasvc.jobsvc.NewJobData({'status': 'error',
+                                        'message': '{} (process_gitdeploy: {}'.format(msg, gitrepo)})
+        self.datasvc.deploysvc.UpdateDeployment_Phase1(app_name, self.deployment_id, gitrepo,
+                                                       step="ERROR: {}".format(msg))
 
     def run(self, app_name, build_name, servers, gitdeploys, parallel=True, batch_number=0):
         '''
@@ -706,104 +1481,167 @@ class DeployController:
 
         build_doc = self.datasvc.buildsvc.GetBuild(app_name, build_name)
         gitdeploy_docs = {gd: self.datasvc.gitsvc.GetGitDeploy(app_name, gd) for gd in gitdeploys}
+        servers_by_gitdeploy = {gd: determine_deployabe_servers(gitdeploy_docs[gd]['servers'], servers) for gd in gitdeploy_docs}
+        pool = self.get_pool(parallel)
 
-        queue = billiard.Queue()
-        procs = list()
-
-        #we need to get a list of gitdeploys with unique gitrepos, so build a reverse mapping
-        gitrepo_gitdeploy_mapping = {gitdeploy_docs[gd]['location']['gitrepo']['name']: gd for gd in gitdeploys}
-
-        self.datasvc.deploysvc.StartDeployment_Phase(app_name, self.deployment_id, 1)
+        #phase 1 is per gitrepo, phase 2 is per gitdeploy, so build a mapping of gitrepo -> [ gitdeploys ]
+        gitrepo_gitdeploy_mapping = dict()
+        for gd in gitdeploys:
+            gitrepo_gitdeploy_mapping.setdefault(gitdeploy_docs[gd]['location']['gitrepo']['name'], list()).append(gd)
+
+        gitdeploy_timeouts = {gd: self.gitdeploy_timeouts(gitdeploy_docs[gd]) for gd in gitdeploys}
+
+        def start_pulls(gitrepos):
+            # commits recorded by phase 1 (in this or a previous batch/run), so pulls can skip servers already at them
+            commits = self.datasvc.deploysvc.GetCommits(app_name, self.deployment_id)
+            target_commits = {gd: commits.get(gr) for gr in gitrepos for gd in gitrepo_gitdeploy_mapping[gr]}
+            # phase 2 tasks are keyed by tuple of gitdeploys: with combine_states, gitdeploys whose pulls start
+            # together share one task (and one state run per server) unless their state IDs collide. Their servers
+            # are prepared by separate pool tasks first (see CombinedPullResult)
+            keys = _combinable_groups({gd: gitdeploy_docs[gd] for gd in target_commits}) if self.combine_states else \
+                [(gd,) for gd in target_commits]
+            for key in keys:
+                if not key:
+                    continue
+                timeouts = {t: max([gitdeploy_timeouts[gd][t] for gd in key]) for t in TIMEOUTS}
+                target_commit = target_commits[key[0]] if len(key) == 1 else {gd: target_commits[gd] for gd in key}
+                gitdeploy_struct = {gd: servers_by_gitdeploy[gd] for gd in key}
+                if len(key) == 1:
+                    phase2_tasks[key] = submit_pull(gitdeploy_struct, timeouts, target_commit, None)
+                    continue
+                prepares = {gd: pool.submit(_threadsafe_prepare_pull, (app_name, gd, servers_by_gitdeploy[gd],
+                                                                       self.datasvc.settings, self.datasvc.job_id,
+                                                                       self.deployment_id, batch_number,
+                                                                       gitdeploy_timeouts[gd], target_commits[gd],
+                                                                       self.skip_current, True))
+                            for gd in key}
+                phase2_tasks[key] = CombinedPullResult(prepares,
+                                                       functools.partial(submit_pull, gitdeploy_struct, timeouts,
+                                                                         target_commit),
+                                                       prepare_failed)
+
+        def submit_pull(gitdeploy_struct, timeouts, target_commit, prepared):
+            return pool.submit(_threadsafe_pull_gitdeploy, (app_name, gitdeploy_struct, self.datasvc.settings,
+                                                            self.datasvc.job_id, self.deployment_id, batch_number,
+                                                            self.salt_concurrency, timeouts, target_commit,
+                                                            self.skip_current, True, prepared))
+
+        def prepare_failed(gd, msg):
+            logging.error("_threadsafe_prepare_pull: {} ({})!".format(msg, gd))
+            self.datasvc.deploysvc.UpdateDeployment_Phase2(app_name, self.deployment_id, gd, servers_by_gitdeploy[gd],
+                                                           batch_number, state="ERROR: {}".format(msg))
+            self.datasvc.deploysvc.FailDeployment(app_name, self.deployment_id)
+
+        def task_timeout(gitdeploys):
+            # wait as long as the most patient of the outstanding gitdeploys
+            return max([gitdeploy_timeouts[gd]['task'] for gd in gitdeploys])
+
+        def check_cancelled():
+            try:
+                self.check_cancelled(app_name)
+            except DeploymentCancelled:
+                for gr in phase1_tasks:
+                    self.datasvc.deploysvc.UpdateDeployment_Phase1(app_name, self.deployment_id, gr, step="CANCELLED")
+                for gd in [gd for key in phase2_tasks for gd in key]:
+                    self.datasvc.deploysvc.UpdateDeployment_Phase2(app_name, self.deployment_id, gd,
+                                                                   servers_by_gitdeploy[gd], batch_number,
+                                                                   state="CANCELLED")
+                self.datasvc.deploysvc.FlushProgress(app_name, self.deployment_id)
+                raise
+
+        # Phases are pipelined: as soon as a gitrepo has been committed and pushed (phase 1), the pulls for the
+        # gitdeploys that use it (phase 2) are started, without waiting for the other gitrepos. Gitrepos already
+        # prepared by a previous batch skip phase 1 entirely.
+        # Salt connectivity to every server in the batch is verified once, while phase 1 runs, rather than by each
+        # phase 2 task.
+        prepared = self.prepared_gitrepos.setdefault(build_name, set())
+        phase1_tasks = dict()
+        phase2_tasks = dict()
+        if set(gitrepo_gitdeploy_mapping.keys()) - prepared:
+            self.datasvc.deploysvc.StartDeployment_Phase(app_name, self.deployment_id, 1)
         for gr in gitrepo_gitdeploy_mapping:
-            gd = gitrepo_gitdeploy_mapping[gr]
-            gddoc = gitdeploy_docs[gd]
-            if parallel:
-                p = billiard.Process(target=_threadsafe_process_gitdeploy, name=gd,
-                                     args=(gddoc, build_doc, self.datasvc.settings,
-                                     self.datasvc.job_id, self.deployment_id))
-                p.start()
-                procs.append(p)
-
-            else:
-                _threadsafe_process_gitdeploy(gddoc, build_doc, self.datasvc.settings,
-                                              self.datasvc.job_id, self.deployment_id)
-
-        if parallel:
-            error = False
-            for p in procs:
-                p.join(150)
-                if p.is_alive():
-                    p.terminate()
-                    logging.error("ERROR: _threadsafe_process_gitdeploy: timeout waiting for child process ({})!".
-                                  format(p.name))
-                    self.datasvc.jobsvc.NewJobData({'status': 'error',
-                                                    'message': 'timeout waiting for child process (process_gitdeploy: {}'.format(p.name)})
-                    self.datasvc.deploysvc.UpdateDeployment_Phase1(app_name, self.deployment_id, p.name,
-                                                          step="ERROR: timed out waiting for child process")
+            if gr not in prepared:
+                gddoc = gitdeploy_docs[gitrepo_gitdeploy_mapping[gr][0]]
+                phase1_tasks[gr] = pool.submit(_threadsafe_process_gitdeploy, (gddoc, build_doc,
+                                                                               self.datasvc.settings,
+                                                                               self.datasvc.job_id, self.deployment_id))
+
+        error = not self.preflight(app_name, servers_by_gitdeploy, batch_number,
+                                   max([gitdeploy_timeouts[gd]['ping'] for gd in gitdeploys]))
+        if not error:
+            start_pulls([gr for gr in gitrepo_gitdeploy_mapping if gr in prepared])
+
+        last_progress = time.time()
+        while phase1_tasks:
+            done = [gr for gr in phase1_tasks if phase1_tasks[gr].ready()]
+            ready = list()
+            for gr in done:
+                ok, value, msg = self.get_task_result(phase1_tasks.pop(gr))
+                if ok and not value:
+                    ok, msg = False, "error processing gitrepo (see phase 1 progress)"
+                if not ok:
+                    self.phase1_error(app_name, gr, msg)
                     error = True
-                if p.exitcode < 0 or p.exitcode > 0:
-                    msg = "process killed by signal {}!".format(abs(p.exitcode)) if p.exitcode < 0 \
-                        else "process died with exit code {}".format(p.exitcode)
-                    logging.error("_threadsafe_process_gitdeploy: {}".format(msg))
-                    self.datasvc.jobsvc.NewJobData({'status': 'error',
-                                                    'message': '{} (process_gitdeploy: {}'.format(msg, p.name)})
-                    self.datasvc.deploysvc.UpdateDeployment_Phase1(app_name, self.deployment_id, p.name,
-                                                                   step="ERROR: {}".format(msg))
+                last_progress = time.time()
+                if error:
+                    continue    # let the remaining gitrepos finish but don't start any more pulls
+                prepared.add(gr)
+                self.datasvc.deploysvc.CheckpointGitRepo(app_name, self.deployment_id, gr, build_name)
+                ready.append(gr)
+            if ready and not error:
+                start_pulls(ready)
+            if phase1_tasks and not done:
+                check_cancelled()
+                if time.time() - last_progress > task_timeout([gd for gr in phase1_tasks
+                                                               for gd in gitrepo_gitdeploy_mapping[gr]]):
+                    for gr in phase1_tasks:
+                        self.phase1_error(app_name, gr, "timeout waiting for child process")
                     error = True
-            if error:
-                self.datasvc.deploysvc.FailDeployment(app_name, self.deployment_id)
-                return False, None
-
-        servers_by_gitdeploy = {gd: determine_deployabe_servers(gitdeploy_docs[gd]['servers'], servers) for gd in gitdeploy_docs}
+                    break
+                else:
+                    time.sleep(PIPELINE_POLL_INTERVAL)
 
-        queue = billiard.Queue()
-        procs = list()
-        self.datasvc.deploysvc.StartDeployment_Phase(app_name, self.deployment_id, 2)
-        for gd in servers_by_gitdeploy:
-            if parallel:
-                p = billiard.Process(target=_threadsafe_pull_gitdeploy, name=gd,
-                                            args=(app_name, {gd: servers_by_gitdeploy[gd]}, queue, self.datasvc.settings,
-                                                  self.datasvc.job_id, self.deployment_id, batch_number))
-                p.start()
-                procs.append(p)
-            else:
-                _threadsafe_pull_gitdeploy(app_name, {gd: servers_by_gitdeploy[gd]}, queue, self.datasvc.settings,
-                                           self.datasvc.job_id, self.deployment_id, batch_number)
+        if not error:
+            self.datasvc.deploysvc.StartDeployment_Phase(app_name, self.deployment_id, 2)
 
-        # pull from queue prior to joining to avoid deadlock
+        # always collect phase 2 pulls that were already started, even if some other gitrepo failed
         results = list()
-        i = 0
-        while i < len(procs):
-            results.append(queue.get(150))
-            i += 1
-
-        if parallel:
-            error = False
-            for p in procs:
-                p.join(150)
-                if p.is_alive():
-                    p.terminate()
-                    logging.error("_threadsafe_pull_gitdeploy: timeout waiting for child process ({})!".
-                                  format(p.name))
-                    self.datasvc.jobsvc.NewJobData({'status': 'error',
-                                                    'message': 'timeout waiting for child process (pull_gitdeploy: {}'.format(p.name)})
-                    self.datasvc.deploysvc.UpdateDeployment_Phase2(app_name, self.deployment_id, p.name,
-                                                                   servers_by_gitdeploy[p.name], batch_number,
-                                                                   state="ERROR: timeout waiting for child process")
-                    error = True
-                if p.exitcode < 0 or p.exitcode > 0:
-                    msg = "process killed by signal {}!".format(abs(p.exitcode)) if p.exitcode < 0 \
-                        else "process died with exit code {}".format(p.exitcode)
-                    logging.error("_threadsafe_pull_gitdeploy: {}".format(msg))
+        last_progress = time.time()
+        while phase2_tasks:
+            done = [key for key in phase2_tasks if phase2_tasks[key].ready()]
+            timed_out = list()
+            if phase2_tasks and not done:
+                check_cancelled()
+                if time.time() - last_progress > task_timeout([gd for key in phase2_tasks for gd in key]):
+                    timed_out = phase2_tasks.keys()
+                else:
+                    time.sleep(PIPELINE_POLL_INTERVAL)
+            for key in done + timed_out:
+                if key in timed_out:
+                    phase2_tasks.pop(key)
+                    ok, value, msg = False, None, "timeout waiting for child process"
+                else:
+                    ok, value, msg = self.get_task_result(phase2_tasks.pop(key))
+                last_progress = time.time()
+                if not ok:
+                    logging.error("_threadsafe_pull_gitdeploy: {} ({})!".format(msg, ', '.join(key)))
                     self.datasvc.jobsvc.NewJobData({'status': 'error',
-                                                    'message': '{} (pull_gitdeploy: {}'.format(msg, p.name)})
-                    self.datasvc.deploysvc.UpdateDeployment_Phase2(app_name, self.deployment_id, p.name,
-                                                                   servers_by_gitdeploy[p.name], batch_number,
-                                                                   state="ERROR: {}".format(msg))
+                                                    'message': '{} (pull_gitdeploy: {}'.format(msg, ', '.join(key))})
+                    for gd in key:
+                        self.datasvc.deploysvc.UpdateDeployment_Phase2(app_name, self.deployment_id, gd,
+                                                                       servers_by_gitdeploy[gd], batch_number,
+                                                                       state="ERROR: {}".format(msg))
                     error = True
-            if error:
-                self.datasvc.deploysvc.FailDeployment(app_name, self.deployment_id)
-                return False, None
+                elif value:
+                    results.append(value)
+                    completed = [g for g in value if not value[g]['errors']]
+                    if completed:
+                        self.datasvc.deploysvc.CheckpointGitDeploys(app_name, self.deployment_id, batch_number,
+                                                                    completed)
+        if error:
+            self.datasvc.deploysvc.FailDeployment(app_name, self.deployment_id)
+            self.close(terminate=True)
+            return False, None
 
         if not results:
             return False, results
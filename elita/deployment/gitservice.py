@@ -71,6 +71,15 @@ def create_gitdeploy(datasvc, gitdeploy):
     gdm.add_sls()
     return "done"
 
+def regenerate_gitdeploy_sls(datasvc, application=None):
+    '''
+    Regenerate SLS files for all gitdeploys of application (or of every application). Unchanged files aren't rewritten
+    '''
+    sc = salt_control.SaltController(datasvc)
+    apps = [application] if application else datasvc.appsvc.GetApplications()
+    gitdeploys = [datasvc.gitsvc.GetGitDeploy(app, gd) for app in apps for gd in datasvc.gitsvc.GetGitDeploys(app)]
+    return sc.regenerate_gitdeploy_yaml(gitdeploys)
+
 def remove_gitdeploy(datasvc, gitdeploy):
     gdm = GitDeployManager(gitdeploy, datasvc)
     gdm.rm_sls()
@@ -104,6 +113,8 @@ def deinitialize_gitdeploy(datasvc, gitdeploy, server_list):
         if s in existing_servers:
             existing_servers.remove(s)
     datasvc.gitsvc.UpdateGitDeploy(gitdeploy['application'], gitdeploy['name'], {'servers': existing_servers})
+    if server_list:
+        datasvc.gitsvc.UpdateServerCommits(gitdeploy['application'], gitdeploy['name'], server_list, None)
     return res
 
 def remove_and_deinitialize_gitdeploy(datasvc, gitdeploy):
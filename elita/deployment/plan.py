@@ -0,0 +1,131 @@
+__author__ = 'bkeroack'
+
+import logging
+
+import elita.util
+import elita.util.type_check
+import deploy
+
+
+class DeploymentPlanner:
+    '''
+    Computes what a deployment would do without doing any of it: the batches (servers/gitdeploys) it would run, which
+    gitrepos would change and how (from the build package manifests) and an estimated duration from recent deployments.
+
+    Only reads data (package manifests are recorded in the build documents at upload), so it's cheap enough to call
+    before every deployment. Plans can be cached with DeploymentDataService.SavePlan and executed later by ID.
+    '''
+    __metaclass__ = elita.util.LoggingMetaClass
+
+    def __init__(self, datasvc):
+        '''
+        @type datasvc: models.DataService
+        '''
+        self.datasvc = datasvc
+
+    def compute_stages(self, application, target, rolling_divisor, strategy):
+        '''
+        Same batches that RollingDeployController/DeployController would run. Manual deployments are a single batch
+        '''
+        if not target['groups']:
+            return [[{'servers': target['servers'], 'gitdeploys': target['gitdeploys'], 'ordered_gitdeploy': False}]]
+        rdc = deploy.RollingDeployController(self.datasvc, None, None)
+        rolling_group_docs, nonrolling_group_docs = rdc.get_group_docs(application, target['groups'])
+        return rdc.compute_stages(rolling_group_docs, nonrolling_group_docs, rolling_divisor, strategy)
+
+    @staticmethod
+    def diff_manifests(old, new):
+        '''
+        Compare two package manifests ([ path, signature ] lists). Returns dict of added/modified/removed paths
+        '''
+        old = dict((p, sig) for p, sig in old)
+        new = dict((p, sig) for p, sig in new)
+        return {
+            'added': sorted([p for p in new if p not in old]),
+            'modified': sorted([p for p in new if p in old and new[p] != old[p]]),
+            'removed': sorted([p for p in old if p not in new])
+        }
+
+    def get_gitrepo_changes(self, application, build_name, gitdeploys):
+        '''
+        For each gitrepo used by gitdeploys, determine whether deploying build_name will change it and the expected
+        changed files (None if there's no manifest to compare against, ex: the previous build has been deleted)
+        '''
+        builds = self.datasvc.buildsvc.GetBuilds(application)
+        gitrepos = dict()
+        for gd in gitdeploys:
+            gddoc = self.datasvc.gitsvc.GetGitDeploy(application, gd)
+            gr = gddoc['location']['gitrepo']['name']
+            if gr in gitrepos:
+                gitrepos[gr]['gitdeploys'].append(gd)
+                continue
+            last_build = gddoc['location']['gitrepo'].get('last_build')
+            gitrepos[gr] = {
+                'gitdeploys': [gd],
+                'package': gddoc['package'],
+                'last_build': last_build,
+                'changed': last_build != build_name,
+                'changed_files': None
+            }
+            if last_build == build_name:
+                gitrepos[gr]['changed_files'] = {'added': [], 'modified': [], 'removed': []}
+                continue
+            new = self.datasvc.buildsvc.GetPackageManifest(application, build_name, gddoc['package'])
+            old = self.datasvc.buildsvc.GetPackageManifest(application, last_build, gddoc['package']) \
+                if last_build and last_build in builds else None
+            if new is not None and old is not None:
+                gitrepos[gr]['changed_files'] = self.diff_manifests(old, new)
+                gitrepos[gr]['changed'] = any(gitrepos[gr]['changed_files'].values())
+        return gitrepos
+
+    def estimate_duration(self, application, batches, rolling_pause, ordered_pause):
+        '''
+        Estimated seconds for the whole deployment: median seconds per batch of recent deployments times the number
+        of batches, plus pauses. Returns None if there are no completed deployments to go by
+        '''
+        timings = self.datasvc.deploysvc.GetBatchTimings(application)
+        if not timings:
+            return None
+        timings = sorted(timings)
+        per_batch = timings[len(timings)/2]
+        pauses = sum([ordered_pause if b['ordered_gitdeploy'] else rolling_pause for b in batches[:-1]])
+        return round(per_batch * len(batches) + pauses, 1)
+
+    def plan(self, application, build_name, target, options):
+        '''
+        Compute deployment plan.
+
+        target: { 'servers': [...], 'gitdeploys': [...], 'environments': [...] | None, 'groups': [...] | None }
+        options: deployment options (rolling_divisor, rolling_pause, ordered_pause and optionally rolling_strategy,
+        salt_concurrency) as passed to NewDeployment
+        '''
+        assert application and build_name and target and options
+        assert elita.util.type_check.is_string(application)
+        assert elita.util.type_check.is_string(build_name)
+        assert elita.util.type_check.is_dictlike(target)
+        assert elita.util.type_check.is_dictlike(options)
+        assert all([k in target for k in ('servers', 'gitdeploys', 'environments', 'groups')])
+
+        strategy = options.get('rolling_strategy')
+        stages = self.compute_stages(application, target, options['rolling_divisor'], strategy)
+        batches = [b for s in stages for b in s]
+        logging.debug("DeploymentPlanner: {} batches in {} stages".format(len(batches), len(stages)))
+        return {
+            'application': application,
+            'build_name': build_name,
+            'target': target,
+            'options': options,
+            'strategy': strategy['name'] if strategy else 'divisor',
+            'stage_sizes': [len(s) for s in stages],
+            'batches': batches,
+            'gitrepos': self.get_gitrepo_changes(application, build_name, target['gitdeploys']),
+            'estimated_duration_in_seconds': self.estimate_duration(application, batches, options['rolling_pause'],
+                                                                    options['ordered_pause'])
+        }
+
+    @staticmethod
+    def get_stages(plan):
+        '''
+        Rebuild list of stages (lists of batches) from a plan
+        '''
+        return deploy.BatchCompute.split_stages(plan['batches'], plan['stage_sizes'])
@@ -1,21 +1,24 @@
 import salt.client
 import salt.config
 from salt.exceptions import SaltClientError
-import lockfile
 import os
 import os.path
-import random
-import shutil
-import string
+import contextlib
+import fcntl
+import hashlib
+import tempfile
+import uuid
 import yaml
 import logging
-import copy
+import re
+import shutil
+import billiard
+import Queue
+import sys
+import threading
+import time
 import elita.deployment.gitservice
-
-try:
-    from yaml import CLoader as Loader, CDumper as Dumper
-except ImportError:
-    from yaml import Loader, Dumper
+import elita.deployment.salt_sim
 
 import elita.util
 import elita.util.type_check
@@ -29,6 +32,124 @@ class OSTypes:
     Windows = 0
     Unix_like = 1
 
+SALT_BATCH_REGEX = re.compile(r'^[1-9][0-9]*%?$')   # salt batch size: absolute number or percentage
+DEFAULT_GRAINS_TTL = 3600   # seconds cached minion grains are trusted (elita.salt.grains_ttl)
+# grains cached in server documents (grains.items returns far more than we need)
+CACHED_GRAINS = ('os', 'os_family', 'osrelease', 'kernel', 'kernelrelease', 'cpuarch', 'num_cpus', 'mem_total',
+                 'fqdn', 'host', 'saltversion')
+# salt command output stored in job data is capped at this many bytes of strings (elita.salt.results_max_size)
+DEFAULT_RESULTS_MAX_SIZE = 65536
+# content-addressed staging area for push_files, under the elita sls dir (salt://<slsdir>/staged/<sha256>)
+STAGING_DIR = 'staged'
+STAGING_REFS_DIR = '.refs'  # per-hash reference directories (staged/.refs/<sha256>/<uuid>)
+DEFAULT_STAGING_TTL = 3600  # seconds unreferenced staged files are kept for reuse (elita.salt.staging_ttl)
+# SLS and staging lock files, kept outside the salt file tree so they are never served (elita.salt.lock_dir)
+DEFAULT_LOCK_DIR = os.path.join(tempfile.gettempdir(), 'elita_salt_locks')
+DEFAULT_MAX_STREAMS = 16    # threads reading salt returns per salt_commands_async call (elita.salt.max_streams)
+DEFAULT_POLL_INTERVAL = 1.0  # seconds between job cache polls when collecting salt jobs (elita.salt.poll_interval)
+SALT_ERROR_PATTERN = re.compile(r'error|exception|traceback|fatal', re.IGNORECASE)
+
+def server_type_from_grains(grains):
+    '''
+    Server type ("windows"/"unix") as stored in the server document's server_type field
+    '''
+    return "windows" if grains.get('os') == "Windows" else "unix"
+
+def sanitize_results(results, max_size=DEFAULT_RESULTS_MAX_SIZE):
+    '''
+    Single pass over salt command results that builds a copy safe to store in mongo ('.' in keys replaced with '_'),
+    looks for errors in string values and caps the total size of stored strings at max_size bytes. Once the budget is
+    used up, strings are truncated (error detection still sees the whole string).
+
+    Returns (sanitized_results, detected_in | None, truncated)
+    '''
+    state = {'remaining': max_size, 'detected_in': None, 'truncated': False}
+
+    def walk(obj):
+        if elita.util.type_check.is_dictlike(obj):
+            return {(k.replace('.', '_') if elita.util.type_check.is_string(k) and '.' in k else k): walk(v)
+                    for k, v in obj.iteritems()}
+        if isinstance(obj, (list, tuple)):
+            return [walk(i) for i in obj]
+        if elita.util.type_check.is_string(obj):
+            if state['detected_in'] is None and SALT_ERROR_PATTERN.search(obj):
+                state['detected_in'] = obj
+            if len(obj) > state['remaining']:
+                state['truncated'] = True
+                kept = obj[:max(state['remaining'], 0)]
+                state['remaining'] = 0
+                return "{}...[truncated {} bytes]".format(kept, len(obj) - len(kept))
+            state['remaining'] -= len(obj)
+        return obj
+
+    sanitized = walk(results)
+    return sanitized, state['detected_in'], state['truncated']
+
+def new_salt_client(settings):
+    '''
+    Salt client for the configured backend (elita.salt.backend): "local" (salt.client.LocalClient, the default) or
+    "simulated" (in-process minion simulator, see salt_sim.SimulatedLocalClient)
+    '''
+    backend = settings.get('elita.salt.backend', 'local')
+    if backend == 'simulated':
+        return elita.deployment.salt_sim.SimulatedLocalClient.from_settings(settings)
+    assert backend == 'local'
+    return salt.client.LocalClient()
+
+def get_salt_concurrency(settings, overrides=None):
+    '''
+    Resolve phase 2 salt concurrency options. Defaults come from the ini (elita.salt.max_jobs, elita.salt.max_minions,
+    elita.salt.batch) and can be overridden per deployment. Zero/None means unlimited/no batching.
+
+    Returns { 'max_jobs': int, 'max_minions': int, 'batch': str | None }
+    '''
+    overrides = overrides if overrides else dict()
+    concurrency = {
+        'max_jobs': int(settings.get('elita.salt.max_jobs', 0)),
+        'max_minions': int(settings.get('elita.salt.max_minions', 0)),
+        'batch': settings.get('elita.salt.batch', None) or None
+    }
+    for k in concurrency:
+        if k in overrides and overrides[k] is not None:
+            concurrency[k] = overrides[k]
+    assert concurrency['max_jobs'] >= 0 and concurrency['max_minions'] >= 0
+    assert concurrency['batch'] is None or SALT_BATCH_REGEX.match(str(concurrency['batch']))
+    return concurrency
+
+class SaltJobLimiter:
+    '''
+    Deployment-wide cap on concurrent salt jobs and on minions targeted by in-flight jobs, shared by all deployment
+    worker processes (so it must be created before they are forked). Zero means unlimited.
+
+    Minions are counted under a condition variable and a job's minions are claimed all at once (waiting until that many
+    are free), so callers can't each hold part of the slots and wait on each other.
+    '''
+    def __init__(self, max_jobs=0, max_minions=0):
+        assert isinstance(max_jobs, int) and isinstance(max_minions, int)
+        self.max_jobs = max_jobs
+        self.max_minions = max_minions
+        self.jobs = billiard.BoundedSemaphore(max_jobs) if max_jobs > 0 else None
+        self.minions = billiard.Value('i', 0, lock=False) if max_minions > 0 else None   # minions in use
+        self.minions_freed = billiard.Condition()
+
+    def acquire(self, minion_count):
+        assert self.minions is None or minion_count <= self.max_minions
+        if self.jobs:
+            self.jobs.acquire()
+        if self.minions is not None:
+            with self.minions_freed:
+                while self.minions.value + minion_count > self.max_minions:
+                    self.minions_freed.wait()
+                self.minions.value += minion_count
+
+    def release(self, minion_count):
+        if self.minions is not None:
+            with self.minions_freed:
+                self.minions.value -= minion_count
+                self.minions_freed.notify_all()
+        if self.jobs:
+            self.jobs.release()
+
 class RemoteCommands:
     __metaclass__ = elita.util.LoggingMetaClass
 
@@ -40,10 +161,39 @@ class RemoteCommands:
         assert isinstance(sc, SaltController)
         self.sc = sc
 
+    def get_inventory(self, server_list, refresh=False):
+        '''
+        Get cached grains for servers: { server: { 'server_type': str, 'grains': dict } }
+
+        Grains are read from the server documents. Servers whose grains are missing or older than
+        elita.salt.grains_ttl seconds (or all of them if refresh is True) are refreshed with one bulk grains.items
+        call and written back. Servers that don't answer are left out.
+        '''
+        assert elita.util.type_check.is_seq(server_list)
+        datasvc = self.sc.datasvc
+        ttl = int(self.sc.settings.get('elita.salt.grains_ttl', DEFAULT_GRAINS_TTL))
+        inventory = dict() if refresh else datasvc.serversvc.GetServerInventory(server_list, ttl)
+        stale = [s for s in server_list if s not in inventory]
+        if stale:
+            logging.debug("get_inventory: refreshing grains for {} servers".format(len(stale)))
+            grains = self.sc.get_grains(stale)
+            fresh = {s: {k: grains[s][k] for k in CACHED_GRAINS if k in grains[s]} for s in grains
+                     if elita.util.type_check.is_dictlike(grains[s])}
+            known = set(datasvc.serversvc.GetServers())
+            datasvc.serversvc.UpdateServerGrains({s: fresh[s] for s in fresh if s in known})
+            inventory.update({s: {'server_type': server_type_from_grains(fresh[s]), 'grains': fresh[s]} for s in fresh})
+        return inventory
+
     def get_os(self, server):
-        resp = self.sc.salt_command(server, 'grains.item', ["os"])
-        logging.debug("get_os: resp: {}".format(resp))
-        return OSTypes.Windows if resp[server]['os'] == "Windows" else OSTypes.Unix_like
+        '''
+        Returns OSTypes value for server, or None if it didn't return grains (ex: unresponsive minion)
+        '''
+        inventory = self.get_inventory([server])
+        logging.debug("get_os: inventory: {}".format(inventory))
+        if server not in inventory:
+            logging.warning("get_os: no grains for {} (minion not responding?); OS unknown".format(server))
+            return None
+        return OSTypes.Windows if inventory[server]['server_type'] == "windows" else OSTypes.Unix_like
 
     def get_os_text(self, server):
         ost = self.get_os(server)
@@ -57,28 +207,47 @@ class RemoteCommands:
     def group_remote_servers_by_os(self, server_list):
         '''
         Determine which servers are Windows and which are Unix-like, so we know where to push keys, etc to.
+
+        Raises FatalSaltError if any server's OS can't be determined (no grains), rather than leaving it out of both
+        groups where callers would silently skip it.
         '''
-        unix_servers = list()
-        win_servers = list()
-        for s in server_list:
-            ost = self.get_os(s)
-            if ost == OSTypes.Windows:
-                win_servers.append(s)
-            elif ost == OSTypes.Unix_like:
-                unix_servers.append(s)
+        inventory = self.get_inventory(server_list)
+        unknown = [s for s in server_list if s not in inventory]
+        if unknown:
+            logging.error("group_remote_servers_by_os: could not determine OS of servers: {}".format(unknown))
+            raise FatalSaltError("could not determine OS of servers: {}".format(unknown))
         return {
-            'unix': unix_servers,
-            'windows': win_servers
+            'unix': [s for s in server_list if s in inventory and inventory[s]['server_type'] != "windows"],
+            'windows': [s for s in server_list if s in inventory and inventory[s]['server_type'] == "windows"]
         }
 
     def get_remote_home(self, server_list):
         '''
-        Get shell expansion of ~ on remote servers (home of user salt-minion is running as)
+        Get shell expansion of ~ on remote servers (home of user salt-minion is running as): { server: home }
+
+        Homes are cached in the server documents (cleared whenever the server is updated). Servers that aren't cached
+        are resolved with one salt call per OS group.
 
         @type server_list: list(str)
         '''
         assert server_list
         assert elita.util.type_check.is_seq(server_list)
+        serversvc = self.sc.datasvc.serversvc
+        homes = serversvc.GetRemoteHomes(server_list)
+        missing = [s for s in server_list if s not in homes]
+        if missing:
+            resolved = self.resolve_remote_home(missing)
+            known = set(serversvc.GetServers())
+            cacheable = {s: resolved[s] for s in resolved if s in known and resolved[s]}
+            if cacheable:
+                serversvc.SetRemoteHomes(cacheable)
+            homes.update(resolved)
+        return {s: homes[s] for s in server_list if s in homes}
+
+    def resolve_remote_home(self, server_list):
+        '''
+        Ask servers for their home directory (uncached): { server: home }
+        '''
         servers_by_os = self.group_remote_servers_by_os(server_list)
         res_win = self.sc.salt_command(servers_by_os['windows'], 'cmd.run', ['$env:userprofile'],
                                         opts={'shell': 'powershell'}) if len(servers_by_os['windows']) > 0 else {}
@@ -87,6 +256,26 @@ class RemoteCommands:
         assert len(set(res_unix.keys()).intersection(set(res_win.keys()))) == 0     # no common keys
         return dict(res_unix, **res_win)
 
+    def expand_home(self, server_list, path):
+        '''
+        Bulk resolver: expand '~' in path for every server in server_list. Returns { server: expanded_path }
+        '''
+        if '~' not in path:
+            return {s: path for s in server_list}
+        home_dirs = self.get_remote_home(server_list)
+        return {s: path.replace('~', home_dirs[s]) for s in server_list}
+
+    def group_by_expanded_paths(self, server_list, paths):
+        '''
+        Group servers by the expansions of paths on them, so each group can be targeted with a single salt call
+        (normally there's only one group). Returns { tuple(expanded_paths): [ servers ] }
+        '''
+        expanded = [self.expand_home(server_list, p) for p in paths]
+        groups = dict()
+        for s in server_list:
+            groups.setdefault(tuple([e[s] for e in expanded]), list()).append(s)
+        return groups
+
     def get_home_expanded_path(self, server_list, path_list):
         '''
         Given a list of servers and a list of paths with '~' in them, return absolute paths
@@ -118,39 +307,115 @@ class RemoteCommands:
     def delete_directory(self, server_list, path):
         assert isinstance(server_list, list)
         res = list()
-        win_s = list()
-        unix_s = list()
-        for s in server_list:
-            ost = self.get_os(s)
-            if ost == OSTypes.Windows:
-                win_s.append(s)
-            elif os == OSTypes.Unix_like:
-                unix_s.append(s)
+        servers_by_os = self.group_remote_servers_by_os(server_list)
+        win_s = servers_by_os['windows']
+        unix_s = servers_by_os['unix']
         if len(win_s) > 0:
             res.append(self.delete_directory_win(win_s, path))
         if len(unix_s) > 0:
             res.append(self.delete_directory_unix(unix_s, path))
         return res
 
-    def _get_salt_uri(self, local_path):
-        '''
-        For pushing local files to remote servers, need to copy it to a random location in salt tree
-        so we can push via cp.get_file. This file should be deleted after that call returns.
+    def _staging_dir(self):
+        staging = os.path.join(self.sc.sls_dir, STAGING_DIR)
+        if not os.path.isdir(staging):
+            try:
+                os.makedirs(staging)
+            except OSError:     # created concurrently by another worker
+                if not os.path.isdir(staging):
+                    raise
+        return staging
+
+    def stage_files(self, local_paths):
         '''
+        For pushing local files to remote servers via cp.get_file they must be in the salt tree. Files are staged
+        under their SHA-256, so a file already staged by a concurrent or recent push is reused (and its mtime
+        refreshed) rather than copied again, and minions skip the download if their copy already matches. The source
+        is hashed first and only copied (temp file + rename) if nothing is staged under that hash yet.
 
-        r_postfix = ''.join(random.sample(string.letters + string.digits, 20))
-        root = self.sc.sls_dir
-        newname = os.path.basename(local_path) + r_postfix
-        new_fullpath = "{}/{}".format(root, newname)
-        shutil.copy(local_path, new_fullpath)
-        return 'salt://{}/{}'.format(self.sc.settings['elita.salt.slsdir'], newname), new_fullpath
+        Each staged file gets a reference held by the caller, which must call release_staged_files when the push is
+        done. Returns { local_path: (salt_uri, reference) }
+        '''
+        staging = self._staging_dir()
+        staged = dict()
+        for local_path in local_paths:
+            digest = hashlib.sha256()
+            with open(local_path, 'rb') as src:
+                for chunk in iter(lambda: src.read(65536), ''):
+                    digest.update(chunk)
+            name = digest.hexdigest()
+            staged_path = os.path.join(staging, name)
+            refs_dir = os.path.join(staging, STAGING_REFS_DIR, name)
+            ref = os.path.join(refs_dir, uuid.uuid4().hex)
+            with self.sc.sls_lock(staging):
+                if os.path.isfile(staged_path):
+                    logging.debug("stage_files: reusing staged {} for {}".format(name, local_path))
+                    os.utime(staged_path, None)     # staging_ttl counts from last use
+                else:
+                    temp_path = os.path.join(staging, ".tmp.{}".format(uuid.uuid4().hex))
+                    try:
+                        shutil.copyfile(local_path, temp_path)
+                        os.rename(temp_path, staged_path)
+                    except:
+                        if os.path.isfile(temp_path):
+                            os.unlink(temp_path)
+                        raise
+                if not os.path.isdir(refs_dir):
+                    os.makedirs(refs_dir)
+                open(ref, 'w').close()
+            staged[local_path] = ('salt://{}/{}/{}'.format(self.sc.settings['elita.salt.slsdir'], STAGING_DIR, name),
+                                  ref)
+        return staged
+
+    def _remove_if_unused(self, staging, name, ttl, now):
+        '''
+        Delete staged file name (and its references directory) if it has no references and wasn't used in the last
+        ttl seconds. Caller must hold the staging lock
+        '''
+        refs_dir = os.path.join(staging, STAGING_REFS_DIR, name)
+        if os.path.isdir(refs_dir) and os.listdir(refs_dir):
+            return
+        path = os.path.join(staging, name)
+        if os.path.isfile(path):
+            if now - os.path.getmtime(path) < ttl:
+                return
+            logging.debug("release_staged_files: removing unreferenced {}".format(name))
+            os.unlink(path)
+        if os.path.isdir(refs_dir):
+            os.rmdir(refs_dir)
+
+    def release_staged_files(self, refs):
+        '''
+        Drop references taken by stage_files. Only the files whose references were dropped are checked: they are
+        deleted once unreferenced and unused for elita.salt.staging_ttl seconds. Files left behind by the TTL are
+        swept from the whole staging dir at most once per TTL period
+        '''
+        staging = self._staging_dir()
+        ttl = int(self.sc.settings.get('elita.salt.staging_ttl', DEFAULT_STAGING_TTL))
+        with self.sc.sls_lock(staging):
+            released = set()
+            for ref in refs:
+                if os.path.isfile(ref):
+                    os.unlink(ref)
+                released.add(os.path.basename(os.path.dirname(ref)))
+            now = time.time()
+            for name in released:
+                self._remove_if_unused(staging, name, ttl, now)
+            swept = os.path.join(staging, '.swept')
+            if ttl > 0 and (not os.path.isfile(swept) or now - os.path.getmtime(swept) >= ttl):
+                for name in os.listdir(staging):
+                    if name[0] != '.' and '.' not in name and name not in released:
+                        self._remove_if_unused(staging, name, ttl, now)
+                open(swept, 'w').close()
+                os.utime(swept, None)
 
     def push_files(self, target, local_remote_path_mapping, mode=None):
         '''
         Push a list of files to corresponding remote paths. Make sure each remote path exists first.
         Do all pushes in a single salt call (faster).
 
-        Note that these must be files, not directories.
+        Note that these must be files, not directories. Existing remote files are overwritten (and not downloaded again
+        if unchanged); a directory at a remote path is removed first.
 
         local_remote_path_mapping = { 'local_path': 'remote_path' }
         '''
@@ -161,73 +426,72 @@ class RemoteCommands:
         assert all([p[-1] != '/' and local_remote_path_mapping[p][-1] != '/' for p in local_remote_path_mapping])
         assert elita.util.type_check.is_optional_str(mode)
 
-        calls = list()
-        params = list()
-        temp_files = list()
-
-        #delete remote path first
-        logging.debug("removing any existing remote_path")
+        #delete any directory in the way; files are left so minions can skip downloading unchanged content
         for local_path in local_remote_path_mapping:
-            self.rm_dir_if_exists(target, local_remote_path_mapping[local_path])
+            self.rm_subdir_if_exists(target, local_remote_path_mapping[local_path])
 
-        for local_path in local_remote_path_mapping:
-            if 'salt://' in local_path:
-                salt_uri = local_path
-            else:
-                salt_uri, tf = self._get_salt_uri(local_path)
-                temp_files.append(tf)
-            remote_path = local_remote_path_mapping[local_path]
-            expanded_path = self.get_home_expanded_path(target, [remote_path])[target[0]] if '~' in remote_path else remote_path
-            calls.append('cp.get_file')
-            if mode:
-                calls.append('file.set_mode')
-            params.append([salt_uri, expanded_path])
-            if mode:
-                params.append([expanded_path, mode])
-            logging.debug("push_files: remote_path: {}".format(expanded_path))
-
-        rets = self.sc.salt_command(target, calls, params, opts={'makedirs': True})
-        for tf in temp_files:
-            os.unlink(tf)
+        local_paths = local_remote_path_mapping.keys()
+        staged = self.stage_files([lp for lp in local_paths if 'salt://' not in lp])
+        try:
+            salt_uris = [lp if 'salt://' in lp else staged[lp][0] for lp in local_paths]
+
+            # one call per distinct set of '~' expansions (normally just one for all of target)
+            rets = dict()
+            remote_paths = [local_remote_path_mapping[lp] for lp in local_paths]
+            for expanded_paths, servers in self.group_by_expanded_paths(target, remote_paths).items():
+                calls = list()
+                params = list()
+                for salt_uri, expanded_path in zip(salt_uris, expanded_paths):
+                    calls.append('cp.get_file')
+                    if mode:
+                        calls.append('file.set_mode')
+                    params.append([salt_uri, expanded_path])
+                    if mode:
+                        params.append([expanded_path, mode])
+                    logging.debug("push_files: remote_path: {}".format(expanded_path))
+                rets.update(self.sc.salt_command(servers, calls, params, opts={'makedirs': True}))
+        finally:
+            self.release_staged_files([staged[lp][1] for lp in staged])
         return rets
 
-    def rm_file_if_exists(self, target, path):
+    def _rm_if_exists(self, target, path, unix_cmd, win_cmd):
         '''
-        Remove target directory if it exists
+        Run an idempotent removal command on all servers in target: one salt call per OS group (per distinct expanded
+        path, if '~' expands differently on some servers). Returns per-server results: { server: output }
         '''
         assert target and path
         assert elita.util.type_check.is_seq(target)
         assert elita.util.type_check.is_string(path)
-        for server in target:
-            expanded_path = self.get_home_expanded_path([server], [path])[server] if '~' in path else path
-            file_exists = self.sc.salt_command([server], "file.file_exists", [expanded_path])
-            if server in file_exists and file_exists[server]:
-                self.sc.salt_command([server], "file.remove", [expanded_path])
+        servers_by_os = self.group_remote_servers_by_os(target)     # raises FatalSaltError on unknown OS
+        results = dict()
+        for ost, cmd, opts in (('unix', unix_cmd, None), ('windows', win_cmd, {'shell': 'powershell'})):
+            if not servers_by_os[ost]:
+                continue
+            for paths, servers in self.group_by_expanded_paths(servers_by_os[ost], [path]).items():
+                results.update(self.sc.salt_command(servers, 'cmd.run', [cmd.format(path=paths[0])], opts=opts))
+        return results
+
+    def rm_file_if_exists(self, target, path):
+        '''
+        Remove file at path on all servers in target if it exists
+        '''
+        return self._rm_if_exists(target, path, "if [ -f '{path}' ] || [ -L '{path}' ]; then rm -f '{path}'; fi",
+                                  "if (Test-Path -PathType Leaf '{path}') {{ Remove-Item -Force '{path}' }}")
+
+    def rm_subdir_if_exists(self, target, path):
+        '''
+        Remove path on all servers in target only if it is a directory
+        '''
+        return self._rm_if_exists(target, path, "if [ -d '{path}' ] && [ ! -L '{path}' ]; then rm -rf '{path}'; fi",
+                                  "if (Test-Path -PathType Container '{path}') {{ Remove-Item -Recurse -Force '{path}' }}")
 
     def rm_dir_if_exists(self, target, path):
         '''
-        Remove target directory if it exists
+        Remove directory (or file) at path on all servers in target if it exists
         '''
-        assert target and path
-        assert elita.util.type_check.is_seq(target)
-        assert elita.util.type_check.is_string(path)
-        servers_by_os = self.group_remote_servers_by_os(target)
-        for server in target:
-            expanded_path = self.get_home_expanded_path([server], [path])[server] if '~' in path else path
-            file_exists = self.sc.salt_command([server], "file.file_exists", [expanded_path])
-            if file_exists[server]:
-                self.sc.salt_command([server], "file.remove", [expanded_path])
-                break
-            dir_exists = self.sc.salt_command([server], "file.directory_exists", [expanded_path])
-            if dir_exists[server]:
-                #have to delete recursively, and no built-in salt module supports that
-                if server in servers_by_os['unix']:
-                    self.sc.salt_command([server], 'cmd.run', ['rm -rf {}'.format(expanded_path)])
-                elif server in servers_by_os['windows']:
-                    self.sc.salt_command([server], 'cmd.run', ['Remove-Item -Recurse -Force {}'.format(expanded_path)],
-                                         opts={'shell': 'powershell'})
-                else:
-                    raise FatalSaltError
+        #have to delete recursively, and no built-in salt module supports that
+        return self._rm_if_exists(target, path, "rm -rf '{path}'",
+                                  "if (Test-Path '{path}') {{ Remove-Item -Recurse -Force '{path}' }}")
 
     def run_powershell_script(self, server_list, script_path):
         return self.sc.salt_command(server_list, 'cmd.run', [script_path], opts={'shell': 'powershell'})
@@ -236,17 +500,19 @@ class RemoteCommands:
         return self.sc.salt_command(server_list, 'cmd.run', [cmd])
 
     def touch(self, server_list, remote_path):
-        #hack: assuming all servers in server_list have the same ~ path expansion
-        expanded_path = self.get_home_expanded_path(server_list, [remote_path])[server_list[0]] if '~' in remote_path else remote_path
-        return self.sc.salt_command(server_list, 'file.touch', [expanded_path])
+        res = dict()
+        for paths, servers in self.group_by_expanded_paths(server_list, [remote_path]).items():
+            res.update(self.sc.salt_command(servers, 'file.touch', [paths[0]]))
+        return res
 
     def ping(self, server_list, timeout=10):
         return self.sc.salt_command(server_list, 'test.ping', arg=[], timeout=timeout)
 
     def append_to_file(self, server_list, remote_path, text_block):
-        #hack: assuming all servers in server_list have the same ~ path expansion
-        expanded_path = self.get_home_expanded_path(server_list, [remote_path])[server_list[0]] if '~' in remote_path else remote_path
-        return self.sc.salt_command(server_list, 'file.append', [expanded_path, text_block])
+        res = dict()
+        for paths, servers in self.group_by_expanded_paths(server_list, [remote_path]).items():
+            res.update(self.sc.salt_command(servers, 'file.append', [paths[0], text_block]))
+        return res
 
     def clone_repo(self, server_list, repo_uri, dest):
         assert server_list and repo_uri and dest
@@ -256,14 +522,21 @@ class RemoteCommands:
         logging.debug("clone_repo: deleting remote destination if necessary")
         self.rm_dir_if_exists(server_list, dest)
         cwd, dest_dir = os.path.split(dest)
-        return self.sc.salt_command(server_list, 'cmd.run',
-                                    ['git clone {uri} {dest}'.format(uri=repo_uri, dest=dest_dir)],
-                                    opts={'cwd': cwd}, timeout=1200)
+        return self.sc.fire_and_collect(server_list, 'cmd.run',
+                                        ['git clone {uri} {dest}'.format(uri=repo_uri, dest=dest_dir)],
+                                        opts={'cwd': cwd}, timeout=1200)
 
     def checkout_branch(self, server_list, location, branch_name):
         return self.sc.salt_command(server_list, 'cmd.run', ['git checkout {}'.format(branch_name)],
                                     opts={'cwd': location})
 
+    def get_head_commits(self, server_list, location):
+        '''
+        Get the commit checked out in the git repo at location on each server (one salt call): { server: commit_hash }
+        '''
+        res = self.sc.salt_command(server_list, 'cmd.run', ['git rev-parse HEAD'], opts={'cwd': location})
+        return {s: res[s].strip() for s in res if elita.util.type_check.is_string(res[s])}
+
     def discard_git_changes(self, server_list, location):
         return self.sc.salt_command(server_list, 'cmd.run', ['git checkout -f'],
                                     opts={'cwd': location})
@@ -297,18 +570,25 @@ class RemoteCommands:
     #                                 opts={'cwd': location}, timeout=30)
 
     def highstate(self, server_list):
-        return self.sc.salt_command(server_list, 'state.highstate', [], timeout=300)
+        return self.sc.fire_and_collect(server_list, 'state.highstate', [], timeout=300)
 
     def run_sls(self, server_list, sls_name):
-        return self.sc.salt_command(server_list, 'state.sls', [sls_name], timeout=300)
+        return self.sc.fire_and_collect(server_list, 'state.sls', [sls_name], timeout=300)
 
-    def run_slses_async(self, callback, sls_map, args=None):
+    def run_slses_async(self, callback, sls_map, args=None, batch=None, timeout=600, max_minions=0, limiter=None):
         '''
         sls_map: { 'sls_name': [ list_of_servers ] }
-        Runs all listed SLSes asynchronously
+        Runs all listed SLSes asynchronously. If batch is given (ex: 10 or '25%') salt batch mode is used.
+        If max_minions is given, each server list is split into salt jobs of at most that many servers. All jobs are
+        issued at once; with a limiter (SaltJobLimiter) each one waits for its own slots (see salt_commands_async)
         '''
-        cmd_group = [{'command': 'state.sls', 'arguments': [s], 'servers': sls_map[s]} for s in sls_map]
-        return self.sc.salt_commands_async(callback, args, cmd_group, timeout=600, opts={'concurrent': True})
+        cmd_group = list()
+        for s in sorted(sls_map):
+            size = max_minions if max_minions else max(len(sls_map[s]), 1)
+            cmd_group += [{'command': 'state.sls', 'arguments': [s], 'servers': sls_map[s][i:i+size]}
+                          for i in range(0, len(sls_map[s]), size)]
+        return self.sc.salt_commands_async(callback, args, cmd_group, timeout=timeout, opts={'concurrent': True},
+                                           batch=batch, limiter=limiter)
 
 class SaltController:
     __metaclass__ = elita.util.LoggingMetaClass
@@ -318,7 +598,7 @@ class SaltController:
         @type datasvc: elita.models.DataService
         '''
         self.settings = datasvc.settings
-        self.salt_client = salt.client.LocalClient()
+        self.salt_client = new_salt_client(self.settings)
         self.datasvc = datasvc
         self.file_roots = None
         self.pillar_roots = None
@@ -329,56 +609,217 @@ class SaltController:
         except SaltClientError:
             logging.debug("WARNING: SaltClientError")
 
-    def salt_commands_async(self, callback, args, cmd_group, opts=None, timeout=120):
-        rets = list()
-        for c in cmd_group:
-            rets.append((c, self.salt_client.cmd_iter(c['servers'], c['command'], c['arguments'], kwarg=opts,
-                                      timeout=timeout, expr_form='list')))
+    def salt_commands_async(self, callback, args, cmd_group, opts=None, timeout=120, batch=None, limiter=None):
+        '''
+        Run command groups concurrently and call callback(result, arguments, **args) as each minion returns,
+        whichever group it belongs to. Return streams are read by a fixed pool of threads (limiter.max_jobs if set,
+        otherwise elita.salt.max_streams) that take groups in turn; each thread creates its own LocalClient (a client's
+        event subscription can't be shared between threads) when it first gets to run a command and reuses it for its
+        later groups. Returns are fed into a queue and callbacks are always called from the calling thread. Exceptions
+        from any stream are re-raised once all streams finish.
+
+        If limiter (SaltJobLimiter) is given, each group holds a job slot and its minions while its command runs, so
+        groups start as slots become free (group server lists must not exceed the limiter's max_minions)
+        '''
+        def stream(c, client):
+            if batch:
+                # batch mode returns { minion: ret }; wrap to match cmd_iter output ({ minion: { 'ret': ret } })
+                return ({m: {'ret': r[m]} for m in r} for r in
+                        client.cmd_batch(c['servers'], c['command'], c['arguments'], kwarg=opts, expr_form='list',
+                                         batch=str(batch), timeout=timeout))
+            return client.cmd_iter(c['servers'], c['command'], c['arguments'], kwarg=opts, timeout=timeout,
+                                   expr_form='list')
+
+        @contextlib.contextmanager
+        def slots(c):
+            if limiter:
+                limiter.acquire(len(c['servers']))
+            try:
+                yield
+            finally:
+                if limiter:
+                    limiter.release(len(c['servers']))
+
         results = list()
-        for retc in rets:
-            for r in retc[1]:
-                callback(r, retc[0]['arguments'], **args)
+        if len(cmd_group) == 1:
+            with slots(cmd_group[0]):
+                for r in stream(cmd_group[0], self.salt_client):
+                    callback(r, cmd_group[0]['arguments'], **args)
+                    results.append(r)
+            return results
+
+        # plain threads rather than gevent greenlets: gevent is only used by the gunicorn web workers, and celery
+        # deployment workers aren't monkeypatched, so salt's blocking event reads would stall every greenlet
+        pending = Queue.Queue()
+        for c in cmd_group:
+            pending.put(c)
+        returns = Queue.Queue()
+        done = object()
+
+        def consume(worker):
+            client = None
+            while True:
+                try:
+                    c = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    with slots(c):
+                        if client is None:
+                            # the simulator has no per-thread connection state and can be shared
+                            client = self.salt_client if worker == 0 or \
+                                isinstance(self.salt_client, elita.deployment.salt_sim.SimulatedLocalClient) else \
+                                new_salt_client(self.settings)
+                        for r in stream(c, client):
+                            returns.put((c, r, None))
+                except:
+                    returns.put((c, None, sys.exc_info()))
+                finally:
+                    returns.put((c, done, None))
+
+        max_streams = limiter.max_jobs if limiter and limiter.max_jobs else \
+            int(self.settings.get('elita.salt.max_streams', DEFAULT_MAX_STREAMS))
+        for i in range(min(len(cmd_group), max_streams)):
+            t = threading.Thread(target=consume, args=(i,))
+            t.daemon = True
+            t.start()
+
+        remaining = len(cmd_group)
+        error = None
+        while remaining:
+            c, r, exc_info = returns.get()
+            if r is done:
+                remaining -= 1
+            elif exc_info:
+                logging.error("salt_commands_async: {} {} failed: {}".format(c['command'], c['arguments'],
+                                                                               exc_info[1]))
+                error = error or exc_info
+            else:
+                callback(r, c['arguments'], **args)
                 results.append(r)
+        if error:
+            raise error[0], error[1], error[2]
         return results
 
     def salt_command(self, target, cmd, arg, opts=None, timeout=20):
         results = self.salt_client.cmd(target, cmd, arg, kwarg=opts, timeout=timeout, expr_form='list')
-        results_sanitized = copy.deepcopy(results)
-        elita.util.change_dict_keys(results_sanitized, '.', '_')    # remove '.' in keys for mongo
+        max_size = int(self.settings.get('elita.salt.results_max_size', DEFAULT_RESULTS_MAX_SIZE))
+        results_sanitized, detected_in, truncated = sanitize_results(results, max_size)
+        if truncated:
+            logging.debug("salt_command: {} results truncated to {} bytes for storage".format(cmd, max_size))
         # try to detect if there was an error or exception in any results
-        for path in elita.util.paths_from_nested_dict(results):
-            if elita.util.type_check.is_string(path[-1]):
-                if not all([word.lower() not in path[-1].lower() for word in ('error', 'exception', 'traceback', 'fatal')]):
-                    self.datasvc.jobsvc.NewJobData({'error': 'error detected in salt command results',
-                                                    'detected_in': path[-1],
-                                                    'all_results': results_sanitized,
-                                                    'target': target,
-                                                    'cmd': cmd,
-                                                    'arg': arg})
-                    raise FatalSaltError
+        if detected_in is not None:
+            self.datasvc.jobsvc.NewJobData({'error': 'error detected in salt command results',
+                                            'detected_in': detected_in[:max_size],
+                                            'all_results': results_sanitized,
+                                            'target': target,
+                                            'cmd': cmd,
+                                            'arg': arg})
+            raise FatalSaltError
         self.datasvc.jobsvc.NewJobData({'salt_command': {'target': target, 'cmd': cmd, 'arg': arg,
                                                          'results': results_sanitized}})
         return results
 
+    def submit_job(self, target, cmd, arg, opts=None, timeout=20):
+        '''
+        Publish a salt job without waiting for returns. The JID is recorded on the elita job (salt_jobs) so returns
+        can be collected later with collect_jobs, possibly alongside many other salt jobs.
+
+        Returns { 'jid': str, 'minions': [ expected minions ], 'cmd', 'arg', 'timeout', 'submitted': time }
+        '''
+        pub = self.salt_client.run_job(target, cmd, arg, expr_form='list', kwarg=opts, timeout=timeout)
+        if not pub or not pub.get('jid'):
+            self.datasvc.jobsvc.NewJobData({'error': 'salt job could not be published', 'target': target,
+                                            'cmd': cmd, 'arg': arg})
+            raise FatalSaltError
+        logging.debug("submit_job: {} published as {} ({} minions)".format(cmd, pub['jid'], len(pub['minions'])))
+        self.datasvc.jobsvc.AddSaltJob(pub['jid'], cmd, pub['minions'], timeout)
+        return {'jid': pub['jid'], 'minions': pub['minions'], 'cmd': cmd, 'arg': arg, 'timeout': timeout,
+                'submitted': time.time()}
+
+    def collect_jobs(self, salt_jobs, callback=None):
+        '''
+        Poll the salt job cache for the returns of salt jobs started with submit_job until every expected minion has
+        returned or the job's timeout has passed. New returns are written to job data as they arrive (and passed to
+        callback(jid, { minion: ret }) if given). Errors are detected like salt_command, after all jobs finish.
+
+        Returns { jid: { minion: ret } }
+        '''
+        assert elita.util.type_check.is_seq(salt_jobs)
+        poll_interval = float(self.settings.get('elita.salt.poll_interval', DEFAULT_POLL_INTERVAL))
+        max_size = int(self.settings.get('elita.salt.results_max_size', DEFAULT_RESULTS_MAX_SIZE))
+        pending = {j['jid']: j for j in salt_jobs}
+        results = {j['jid']: dict() for j in salt_jobs}
+        errors = dict()
+        while pending:
+            for jid in pending.keys():
+                job = pending[jid]
+                returns = self.salt_client.get_cache_returns(jid)
+                new = {m: returns[m]['ret'] for m in returns if m not in results[jid]}
+                if new:
+                    results[jid].update(new)
+                    sanitized, detected_in, truncated = sanitize_results(new, max_size)
+                    if detected_in is not None and jid not in errors:
+                        errors[jid] = detected_in[:max_size]
+                    self.datasvc.jobsvc.NewJobData({'salt_job_returns': {'jid': jid, 'cmd': job['cmd'],
+                                                                         'results': sanitized}})
+                    if callback:
+                        callback(jid, new)
+                complete = all([m in results[jid] for m in job['minions']])
+                if complete or time.time() - job['submitted'] >= job['timeout']:
+                    logging.debug("collect_jobs: {} {} ({}/{} returned)".format(
+                        jid, "complete" if complete else "timed out", len(results[jid]), len(job['minions'])))
+                    self.datasvc.jobsvc.UpdateSaltJob(jid, len(results[jid]), "complete" if complete else "timeout")
+                    del pending[jid]
+            if pending:
+                time.sleep(poll_interval)
+        for j in salt_jobs:
+            if j['jid'] in errors:
+                self.datasvc.jobsvc.NewJobData({'error': 'error detected in salt command results',
+                                                'detected_in': errors[j['jid']],
+                                                'jid': j['jid'],
+                                                'cmd': j['cmd'],
+                                                'arg': j['arg']})
+                raise FatalSaltError
+        return results
+
+    def fire_and_collect(self, target, cmd, arg, opts=None, timeout=20):
+        '''
+        Like salt_command but published as a recorded salt job and collected from the job cache, with returns written
+        to job data incrementally. For long-running commands.
+        '''
+        job = self.submit_job(target, cmd, arg, opts=opts, timeout=timeout)
+        return self.collect_jobs([job])[job['jid']]
+
     def run_command(self, target, cmd, shell, timeout=120):
         return self.salt_command(target, 'cmd.run', [cmd], opts={"shell": shell}, timeout=timeout)
 
     def load_salt_info(self):
-        master_config = salt.config.master_config(os.environ.get('SALT_MASTER_CONFIG', '/etc/salt/master'))
+        if isinstance(self.salt_client, elita.deployment.salt_sim.SimulatedLocalClient):
+            master_config = self.salt_client.master_config()
+        else:
+            master_config = salt.config.master_config(os.environ.get('SALT_MASTER_CONFIG', '/etc/salt/master'))
         self.file_roots = master_config['file_roots']
         for e in self.file_roots:
             for d in self.file_roots[e]:
                 if not os.path.isdir(d):
-                    os.mkdir(d)
+                    os.makedirs(d)
         self.pillar_roots = master_config['pillar_roots']
         for e in self.pillar_roots:
             for d in self.pillar_roots[e]:
                 if not os.path.isdir(d):
-                    os.mkdir(d)
+                    os.makedirs(d)
         self.sls_dir = "{}/{}".format(self.file_roots['base'][0], self.settings['elita.salt.slsdir'])
         if not os.path.isdir(self.sls_dir):
             os.mkdir(self.sls_dir)
 
+    def get_grains(self, server_list, timeout=20):
+        '''
+        All grains for servers in one call: { server: { grain: value } }. Not checked for error strings (unlike
+        salt_command) since grain values are arbitrary
+        '''
+        return self.salt_client.cmd(server_list, 'grains.items', [], timeout=timeout, expr_form='list')
+
     def verify_connectivity(self, server, timeout=10):
         return len(self.salt_client.cmd(server, 'test.ping', timeout=timeout)) != 0
 
@@ -394,43 +835,78 @@ class SaltController:
          return "{}.{}.{}".format(self.settings['elita.salt.slsdir'], app, gd_name)
 
 
+    @contextlib.contextmanager
+    def sls_lock(self, filename):
+        '''
+        Exclusive fcntl lock for a file in the salt tree (blocks in the kernel rather than polling). Lock files live in
+        elita.salt.lock_dir, named by a hash of the locked path, so nothing extra appears in the tree salt serves
+        '''
+        lock_dir = self.settings.get('elita.salt.lock_dir', DEFAULT_LOCK_DIR)
+        if not os.path.isdir(lock_dir):
+            try:
+                os.makedirs(lock_dir)
+            except OSError:     # created concurrently by another worker
+                if not os.path.isdir(lock_dir):
+                    raise
+        lock_path = os.path.join(lock_dir, "{}.lock".format(hashlib.sha1(os.path.abspath(filename)).hexdigest()))
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write_sls(self, filename, content):
+        '''
+        Write content to filename atomically (temp file + rename, so salt never reads a partial file) unless the file
+        already has exactly this content (by SHA-256). Returns True if the file was written
+        '''
+        digest = hashlib.sha256(content).hexdigest()
+        with self.sls_lock(filename):
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as f:
+                    if hashlib.sha256(f.read()).hexdigest() == digest:
+                        logging.debug("write_sls: {} unchanged".format(filename))
+                        return False
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                             prefix=".{}.".format(os.path.basename(filename)))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.chmod(temp_path, 0644)
+                os.rename(temp_path, filename)
+            except:
+                os.unlink(temp_path)
+                raise
+        return True
+
     def rm_gitdeploy_yaml(self, gitdeploy):
         name = gitdeploy['name']
         app = gitdeploy['application']
         filename = self.get_gd_file_name(app, name)
         logging.debug("rm_gitdeploy_yaml: gitdeploy: {}/{}".format(app, name))
         logging.debug("rm_gitdeploy_yaml: filename: {}".format(filename))
-        if not os.path.isfile(filename):
-            logging.debug("rm_gitdeploy_yaml: WARNING: file not found!")
-            return
-        lock = lockfile.FileLock(filename)
-        logging.debug("rm_gitdeploy_yaml: acquiring lock on {}".format(filename))
-        lock.acquire(timeout=60)
-        os.unlink(filename)
-        lock.release()
-
-    def new_gitdeploy_yaml(self, gitdeploy):
-        '''Adds new gitdeploy to existing YAML file or creates new YAML file.'''
+        with self.sls_lock(filename):
+            if not os.path.isfile(filename):
+                logging.debug("rm_gitdeploy_yaml: WARNING: file not found!")
+                return
+            os.unlink(filename)
+
+    @staticmethod
+    def render_gitdeploy_sls(gitdeploy):
+        '''
+        Render the SLS for a gitdeploy (pull plus prepull/postpull actions) from the gitdeploy doc alone. Output is
+        deterministic (sorted keys) so it can be compared by hash. Doesn't modify gitdeploy
+        '''
         name = gitdeploy['name']
-        app = gitdeploy['application']
-        filename = self.get_gd_file_name(app, name)
-        logging.debug("add_gitdeploy_to_yaml: acquiring lock on {}".format(filename))
-        lock = lockfile.FileLock(filename)
-        lock.acquire(timeout=60)  # throws exception if timeout
-        if os.path.isfile(filename):
-            logging.debug("add_gitdeploy_to_yaml: existing yaml sls")
-            with open(filename, 'r') as f:
-                existing = yaml.load(f, Loader=Loader)
-            if not existing:    # if empty file this will be None
-                existing = dict()
-        else:
-            logging.debug("add_gitdeploy_to_yaml: yaml sls does not exist")
-            existing = dict()
+        sls = dict()
         slsname = 'gitdeploy_{}'.format(name)
         favor = "theirs" if gitdeploy['options']['favor'] in ('theirs', 'remote') else 'ours'
         ignore_whitespace_op = "-Xignore-all-space" if gitdeploy['options']['ignore-whitespace'] == 'true' else ""
         dir = gitdeploy['location']['path']
-        existing[slsname] = {
+        sls[slsname] = {
             'cmd.run': [
                 {
                     'name': 'git pull -s recursive -X{favor} -Xpatience {ignorews}'
@@ -447,22 +923,34 @@ class SaltController:
                 }
             ]
         }
-        prepull = gitdeploy['actions']['prepull']
-        if prepull is not None:
-            elita.util.change_dict_keys(prepull, elita.deployment.gitservice.EMBEDDED_YAML_DOT_REPLACEMENT, '.')
-            for k in prepull:
-                top_key = prepull[k].keys()[0]
-                prepull[k][top_key].append({'order': 0})
-                existing[k] = prepull[k]
-        postpull = gitdeploy['actions']['postpull']
-        if postpull is not None:
-            elita.util.change_dict_keys(postpull, elita.deployment.gitservice.EMBEDDED_YAML_DOT_REPLACEMENT, '.')
-            for k in postpull:
-                top_key = postpull[k].keys()[0]
-                postpull[k][top_key].append({'order': 'last'})
-                existing[k] = postpull[k]
-        with open(filename, 'w') as f:
-            f.write(yaml.safe_dump(existing, default_flow_style=False))
-        lock.release()
+        for action, order in (('prepull', 0), ('postpull', 'last')):
+            states = gitdeploy['actions'][action]
+            if states is not None:
+                states = elita.util.replace_dict_keys(states, elita.deployment.gitservice.EMBEDDED_YAML_DOT_REPLACEMENT,
+                                                      '.')
+                for k in states:
+                    top_key = states[k].keys()[0]
+                    states[k][top_key].append({'order': order})
+                    sls[k] = states[k]
+        return yaml.safe_dump(sls, default_flow_style=False)
+
+    def new_gitdeploy_yaml(self, gitdeploy):
+        '''
+        Write the SLS file for gitdeploy, rendered from the gitdeploy doc (replacing any previous content). Unchanged
+        files aren't rewritten. Returns True if the file was written
+        '''
+        filename = self.get_gd_file_name(gitdeploy['application'], gitdeploy['name'])
+        return self.write_sls(filename, self.render_gitdeploy_sls(gitdeploy))
+
+    def regenerate_gitdeploy_yaml(self, gitdeploys):
+        '''
+        Bulk (re)generate SLS files for a list of gitdeploy docs. Returns { 'written': [...], 'unchanged': [...] }
+        (application/name strings)
+        '''
+        res = {'written': list(), 'unchanged': list()}
+        for gd in gitdeploys:
+            written = self.new_gitdeploy_yaml(gd)
+            res['written' if written else 'unchanged'].append("{}/{}".format(gd['application'], gd['name']))
+        return res
 
 
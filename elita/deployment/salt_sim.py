@@ -0,0 +1,192 @@
+import fnmatch
+import os
+import random
+import tempfile
+import threading
+import time
+
+import elita.util
+import elita.util.type_check
+
+__author__ = 'bkeroack'
+
+DEFAULT_MINIONS = 1000
+
+def parse_latency(value):
+    '''
+    Latency setting in milliseconds, either a fixed value ("200") or a range ("50-500"). Returns (min, max) in seconds
+    '''
+    if isinstance(value, (int, float)):
+        return value / 1000.0, value / 1000.0
+    parts = [float(p) / 1000.0 for p in str(value).split('-', 1)]
+    return parts[0], parts[-1]
+
+
+class SimulatedLocalClient:
+    '''
+    In-process stand-in for salt.client.LocalClient (elita.salt.backend=simulated) for load testing and tests without
+    a salt master. Emulates a fleet of minions that answer cmd, cmd_iter, cmd_batch and run_job (collected with
+    get_cache_returns) calls after a random latency.
+
+    minions: number of minions matched by glob targets. List targets are answered by every named minion, so servers
+        can be given any names.
+    latency: (min, max) seconds per minion return
+    failure_rate: fraction of returns that fail (state results with result False, "ERROR" strings otherwise). Pings
+        and grains never fail.
+    unresponsive_rate: fraction of minions that never return (chosen per minion, so it's stable across calls)
+    windows_rate: fraction of minions reporting Windows grains
+    payloads: { salt_function: value | callable(minion, args) } to override the simulated returns
+    '''
+    # logspam
+    #__metaclass__ = elita.util.LoggingMetaClass
+
+    def __init__(self, minions=DEFAULT_MINIONS, latency=(0.0, 0.0), failure_rate=0.0, unresponsive_rate=0.0,
+                 windows_rate=0.0, payloads=None, seed=None, file_root=None):
+        assert isinstance(minions, int) and minions >= 0
+        assert len(latency) == 2 and 0 <= latency[0] <= latency[1]
+        assert all([0.0 <= r <= 1.0 for r in (failure_rate, unresponsive_rate, windows_rate)])
+        assert elita.util.type_check.is_optional_dict(payloads)
+        self.minions = minions
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.unresponsive_rate = unresponsive_rate
+        self.windows_rate = windows_rate
+        self.payloads = payloads if payloads else dict()
+        self.seed = seed if seed is not None else random.randint(0, 2**31)
+        self.file_root = file_root if file_root else os.path.join(tempfile.gettempdir(), 'elita_salt_sim')
+        self.random = random.Random(self.seed)
+        self.lock = threading.Lock()
+        self.jobs = dict()  # { jid: (start_time, returns) } for run_job/get_cache_returns
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(minions=int(settings.get('elita.salt.simulator.minions', DEFAULT_MINIONS)),
+                   latency=parse_latency(settings.get('elita.salt.simulator.latency_ms', 0)),
+                   failure_rate=float(settings.get('elita.salt.simulator.failure_rate', 0.0)),
+                   unresponsive_rate=float(settings.get('elita.salt.simulator.unresponsive_rate', 0.0)),
+                   windows_rate=float(settings.get('elita.salt.simulator.windows_rate', 0.0)),
+                   seed=int(settings['elita.salt.simulator.seed']) if 'elita.salt.simulator.seed' in settings
+                   else None,
+                   file_root=settings.get('elita.salt.simulator.file_root'))
+
+    def master_config(self):
+        '''
+        The parts of the salt master config used by SaltController
+        '''
+        return {
+            'file_roots': {'base': [os.path.join(self.file_root, 'salt')]},
+            'pillar_roots': {'base': [os.path.join(self.file_root, 'pillar')]}
+        }
+
+    def minion_names(self):
+        return ["sim-{:05d}".format(i) for i in range(self.minions)]
+
+    def _minion_random(self, minion, prop):
+        # per-minion properties must not depend on call order
+        return random.Random("{}:{}:{}".format(self.seed, minion, prop)).random()
+
+    def _matches(self, tgt, expr_form):
+        if expr_form == 'list':
+            return list(tgt) if isinstance(tgt, (list, tuple)) else tgt.split(',')
+        return fnmatch.filter(self.minion_names(), tgt)
+
+    def grains(self, minion):
+        windows = self._minion_random(minion, 'windows') < self.windows_rate
+        return {
+            'id': minion,
+            'host': minion,
+            'fqdn': "{}.sim.local".format(minion),
+            'os': 'Windows' if windows else 'Ubuntu',
+            'os_family': 'Windows' if windows else 'Debian',
+            'kernel': 'Windows' if windows else 'Linux',
+            'cpuarch': 'AMD64' if windows else 'x86_64',
+            'num_cpus': 4,
+            'mem_total': 8192,
+            'saltversion': '2014.1.0'
+        }
+
+    def _execute(self, minion, fun, arg, failed):
+        if fun in self.payloads:
+            payload = self.payloads[fun]
+            return payload(minion, arg) if callable(payload) else payload
+        if fun == 'test.ping':
+            return True
+        if fun == 'grains.items':
+            return self.grains(minion)
+        if fun in ('state.sls', 'state.highstate'):
+            state = "cmd_|-simulated_|-{}_|-run".format(arg[0] if arg else 'highstate')
+            return {state: {'result': not failed, 'comment': 'Simulated failure' if failed else 'Simulated state',
+                            'changes': {'stdout': '', 'stderr': 'simulated' if failed else ''}, '__run_num__': 0}}
+        if failed:
+            return "ERROR: simulated failure"
+        if fun == 'cmd.run':
+            return ""
+        return True
+
+    def _returns(self, tgt, fun, arg, timeout, expr_form):
+        '''
+        Simulated returns for one call: sorted list of (latency, minion, ret) and whether any minion didn't return
+        '''
+        returns = list()
+        targets = self._matches(tgt, expr_form)
+        with self.lock:
+            for minion in targets:
+                if self._minion_random(minion, 'unresponsive') < self.unresponsive_rate:
+                    continue
+                latency = self.random.uniform(*self.latency)
+                if timeout is not None and latency > timeout:
+                    continue
+                if isinstance(fun, (list, tuple)):    # compound command: { function: ret }
+                    ret = {f: self._execute(minion, f, a, self.random.random() < self.failure_rate and
+                                            f not in ('test.ping', 'grains.items'))
+                           for f, a in zip(fun, arg)}
+                else:
+                    ret = self._execute(minion, fun, arg, self.random.random() < self.failure_rate and
+                                        fun not in ('test.ping', 'grains.items'))
+                returns.append((latency, minion, ret))
+        return sorted(returns, key=lambda r: r[0]), len(returns) < len(targets)
+
+    def run_job(self, tgt, fun, arg=(), expr_form='glob', ret='', timeout=None, kwarg=None, **kwargs):
+        '''
+        Publish without waiting. Returns pub data ({ 'jid': str, 'minions': [ targeted minions ] }) like salt
+        '''
+        returns, _ = self._returns(tgt, fun, arg, None, expr_form)
+        with self.lock:
+            jid = "{}{:06d}".format(time.strftime('%Y%m%d%H%M%S'), len(self.jobs))
+            self.jobs[jid] = (time.time(), returns)
+        return {'jid': jid, 'minions': self._matches(tgt, expr_form)}
+
+    def get_cache_returns(self, jid):
+        '''
+        Returns that have "arrived" so far for a job started by run_job: { minion: { 'ret': ret } }
+        '''
+        start, returns = self.jobs[jid]
+        now = time.time()
+        return {m: {'ret': r} for latency, m, r in returns if start + latency <= now}
+
+    def _stream(self, tgt, fun, arg, timeout, expr_form):
+        start = time.time()
+        returns, missing = self._returns(tgt, fun, arg, timeout, expr_form)
+        for latency, minion, ret in returns:
+            delay = start + latency - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            yield minion, ret
+        if missing and timeout:     # salt waits out the timeout for minions that never answer
+            delay = start + timeout - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def cmd(self, tgt, fun, arg=(), timeout=None, expr_form='glob', ret='', kwarg=None, **kwargs):
+        return {m: r for m, r in self._stream(tgt, fun, arg, timeout, expr_form)}
+
+    def cmd_iter(self, tgt, fun, arg=(), timeout=None, expr_form='glob', ret='', kwarg=None, **kwargs):
+        for m, r in self._stream(tgt, fun, arg, timeout, expr_form):
+            yield {m: {'ret': r}}
+
+    def cmd_batch(self, tgt, fun, arg=(), expr_form='glob', ret='', kwarg=None, batch='10%', **kwargs):
+        minions = self._matches(tgt, expr_form)
+        size = max(int(len(minions) * float(batch[:-1]) / 100), 1) if batch.endswith('%') else int(batch)
+        for i in range(0, len(minions), size):
+            for m, r in self._stream(minions[i:i+size], fun, arg, kwargs.get('timeout', 60), 'list'):
+                yield {m: r}
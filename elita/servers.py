@@ -24,9 +24,9 @@ class ServerSetup:
         self.datasvc = datasvc
 
     def set_server_type(self, rc, name):
-        os_type = rc.get_os_text(name)
-        self.datasvc.serversvc.UpdateServer(name, {'server_type': os_type})
-        return os_type
+        # refreshes the cached grains (and server_type) in the server document
+        inventory = rc.get_inventory([name], refresh=True)
+        return inventory[name]['server_type'] if name in inventory else "unknown"
 
     def set_server_status(self, rc, name):
         if rc.sc.verify_connectivity(name):
@@ -42,6 +42,20 @@ def change_dict_keys(obj, char, rep):
                         del obj[k]
 
 
+def replace_dict_keys(obj, char, rep):
+    '''
+    Like change_dict_keys but returns a sanitized copy in a single pass instead of modifying obj in place. Only the
+    containers (dicts/lists/tuples) are rebuilt; leaf values are shared with obj, so this is much cheaper than
+    deepcopy() followed by change_dict_keys() for large nested objects (salt output, etc).
+    '''
+    if type_check.is_dictlike(obj):
+        return {(k.replace(char, rep) if type_check.is_string(k) and char in k else k): replace_dict_keys(v, char, rep)
+                for k, v in obj.iteritems()}
+    elif isinstance(obj, (list, tuple)):
+        return [replace_dict_keys(i, char, rep) for i in obj]
+    return obj
+
+
 def split_seq(seq, n):
     '''split iterable into n number of equal-length (approx) chunks'''
     newseq = []
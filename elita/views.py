@@ -19,6 +19,8 @@ import servers
 import elita.deployment.gitservice
 import elita_exceptions
 import elita.deployment.deploy
+import elita.deployment.plan
+import elita.deployment.salt_control
 import elita.util
 
 #logging.basicConfig(level=logging.DEBUG)
@@ -112,8 +114,8 @@ class GenericView:
             doc['created_datetime'] = doc['created_datetime'].isoformat(' ')
         return doc
 
-    def run_async(self, name, job_type, data, callable, args):
-        jid = action.run_async(self.datasvc, name, job_type, data, callable, args)
+    def run_async(self, name, job_type, data, callable, args, application=None):
+        jid = action.run_async(self.datasvc, name, job_type, data, callable, args, application=application)
         return {
             'task': name,
             'job_id': jid,
@@ -568,7 +570,7 @@ class BuildView(GenericView):
             'package_map': self.package_map
         }
         args = dict(base_args.items() + arg.items())
-        msg = self.run_async('store_build', 'async', args, func, args)
+        msg = self.run_async('store_build', 'build', args, func, args, application=self.app_name)
         return self.return_action_status({
             "build_stored": {
                 "application": self.app_name,
@@ -707,6 +709,7 @@ class ServerView(GenericView):
         return {
             'server_name': self.context.name,
             'server_type': self.context.server_type,
+            'grains': self.context.grains if hasattr(self.context, 'grains') else None,
             'status': self.context.status,
             'created_datetime': self.get_created_datetime_text(),
             'environment': self.context.environment,
@@ -755,28 +758,10 @@ class DeploymentContainerView(GenericView):
                                                                  with_details=details)
         }
 
-    @validate_parameters(required_params=['build_name'])
-    def POST(self):
-        # yeah so this is a big ugly method...
-        # we support two different 'styles' of deployment (manual/group) so this has to handle both and do all possible
-        # input validation before returning. Prob should consider breaking this logic out into two separate endpoints.
-        app = self.context.parent
-        build_name = self.req.params['build_name']
-        if build_name not in self.datasvc.buildsvc.GetBuilds(app):
-            return self.Error(400, "unknown build '{}'".format(build_name))
-        build_doc = self.datasvc.buildsvc.GetBuild(app, build_name)
-        build_obj = dataservice.models.Build(build_doc)
-        if not build_obj.stored:
-            return self.Error(400, "no stored data for build: {} (stored == false)".format(build_name))
-        try:
-            body = self.req.json_body
-        except:
-            return self.Error(400, "invalid target object (problem deserializing, bad JSON?)")
-
-        target = {
-            "servers": list(),
-            "gitdeploys": list()
-        }
+    def get_deployment_options(self):
+        '''
+        Parse and validate deployment options from the URL parameters. Returns (options, error_response)
+        '''
         integer_params = {  # defaults
             "rolling_divisor": 2,
             "rolling_pause": 0,
@@ -787,27 +772,91 @@ class DeploymentContainerView(GenericView):
                 if p in self.req.params:
                     integer_params[p] = int(self.req.params[p])
             except ValueError:
-                return self.Error(400, "invalid {}".format(p))
+                return None, self.Error(400, "invalid {}".format(p))
             if integer_params[p] < (1 if p == "rolling_divisor" else 0):
-                return self.Error(400, "invalid {}: {}".format(p, integer_params[p]))
+                return None, self.Error(400, "invalid {}: {}".format(p, integer_params[p]))
 
-        rolling_divisor = integer_params['rolling_divisor']
-        rolling_pause = integer_params['rolling_pause']
-        ordered_pause = integer_params['ordered_pause']
+        # optional per-deployment salt concurrency overrides (defaults come from the ini)
+        salt_concurrency = dict()
+        for p in ('salt_max_jobs', 'salt_max_minions'):
+            if p in self.req.params:
+                try:
+                    salt_concurrency[p[5:]] = int(self.req.params[p])
+                except ValueError:
+                    return None, self.Error(400, "invalid {}".format(p))
+                if salt_concurrency[p[5:]] < 0:
+                    return None, self.Error(400, "invalid {}: {}".format(p, salt_concurrency[p[5:]]))
+        if 'salt_batch' in self.req.params:
+            if not elita.deployment.salt_control.SALT_BATCH_REGEX.match(self.req.params['salt_batch']):
+                return None, self.Error(400, "invalid salt_batch (must be a positive integer or percentage)")
+            salt_concurrency['batch'] = self.req.params['salt_batch']
+
+        rolling_strategy = self.req.params['rolling_strategy'] if 'rolling_strategy' in self.req.params else 'divisor'
+        if rolling_strategy not in elita.deployment.deploy.ROLLING_STRATEGIES:
+            return None, self.Error(400, "invalid rolling_strategy (must be one of: {})"
+                                    .format(elita.deployment.deploy.ROLLING_STRATEGIES))
+        strategy = None
+        if rolling_strategy == 'adaptive':
+            strategy = {
+                'name': rolling_strategy,
+                'canary_size': elita.deployment.deploy.DEFAULT_CANARY_SIZE,
+                'growth_factor': elita.deployment.deploy.DEFAULT_GROWTH_FACTOR
+            }
+            for p in ('canary_size', 'growth_factor'):
+                if p in self.req.params:
+                    try:
+                        strategy[p] = int(self.req.params[p])
+                    except ValueError:
+                        return None, self.Error(400, "invalid {}".format(p))
+                if strategy[p] < (1 if p == 'canary_size' else 2):
+                    return None, self.Error(400, "invalid {}: {}".format(p, strategy[p]))
+
+        # optional per-deployment timeouts in seconds (defaults come from the ini, gitdeploys may override them)
+        timeouts = dict()
+        for t in elita.deployment.deploy.TIMEOUTS:
+            p = '{}_timeout'.format(t)
+            if p in self.req.params:
+                try:
+                    timeouts[t] = int(self.req.params[p])
+                except ValueError:
+                    return None, self.Error(400, "invalid {}".format(p))
+                if timeouts[t] < 1:
+                    return None, self.Error(400, "invalid {}: {}".format(p, timeouts[t]))
+
+        options = dict(integer_params)
+        if 'skip_current' in self.req.params:
+            options['skip_current'] = self.req.params['skip_current'] in AFFIRMATIVE_SYNONYMS
+        if salt_concurrency:
+            options['salt_concurrency'] = salt_concurrency
+        if timeouts:
+            options['timeouts'] = timeouts
+        if strategy:
+            options['rolling_strategy'] = strategy
+        return options, None
+
+    def get_deployment_target(self, app, build_obj, build_name, body):
+        '''
+        Calculate servers/gitdeploys to deploy to from the JSON body (either environments/groups or servers/gitdeploys)
+        and validate them. Returns (target, error_response)
+        '''
+        target = {
+            "servers": list(),
+            "gitdeploys": list()
+        }
 
         if "environments" in body and "groups" in body:
 
             for c in ('environments', 'groups'):
                 if not isinstance(body[c], list):
-                    return self.Error(400, "{} must be a list".format(c))
+                    return None, self.Error(400, "{} must be a list".format(c))
 
             envs = self.datasvc.serversvc.GetEnvironments()
             if not self.check_against_existing(envs.keys(), body['environments']):
-                return self.Error(400, "unknown environments: {}".format(self.get_unknown(envs.keys(), body['environments'])))
+                return None, self.Error(400, "unknown environments: {}".format(self.get_unknown(envs.keys(), body['environments'])))
 
             existing_groups = self.datasvc.groupsvc.GetGroups(app)
             if not self.check_against_existing(existing_groups, body['groups']):
-                return self.Error(400, "unknown groups: {}".format(self.get_unknown(existing_groups, body['groups'])))
+                return None, self.Error(400, "unknown groups: {}".format(self.get_unknown(existing_groups, body['groups'])))
 
             #flat list of all servers in environments
             servers_in_environments = set([s for s in [envs[e] for e in envs] for s in s])
@@ -830,23 +879,23 @@ class DeploymentContainerView(GenericView):
 
             for k in target:
                 if target[k] < 1:
-                    return self.Error(400, "no matching {} for environments ({}) and groups ({})"
-                                      .format(k, body['environments'], body['groups']))
+                    return None, self.Error(400, "no matching {} for environments ({}) and groups ({})"
+                                            .format(k, body['environments'], body['groups']))
 
         if "servers" in body and "gitdeploys" in body:
 
             for c in ('servers', 'gitdeploys'):
                 if not isinstance(body[c], list):
-                    return self.Error(400, "{} must be a list".format(c))
+                    return None, self.Error(400, "{} must be a list".format(c))
 
             existing_servers = self.datasvc.serversvc.GetServers()
             if not self.check_against_existing(existing_servers, body['servers']):
-                return self.Error(400, "unknown servers: {}".format(self.get_unknown(existing_servers, body['servers'])))
+                return None, self.Error(400, "unknown servers: {}".format(self.get_unknown(existing_servers, body['servers'])))
 
             existing_gitdeploys = self.datasvc.gitsvc.GetGitDeploys(app)
             if not self.check_against_existing(existing_gitdeploys, body['gitdeploys']):
-                return self.Error(400, "unknown gitdeploys: {}".format(self.get_unknown(existing_gitdeploys,
-                                                                                   body['gitdeploys'])))
+                return None, self.Error(400, "unknown gitdeploys: {}".format(self.get_unknown(existing_gitdeploys,
+                                                                                         body['gitdeploys'])))
             for s in body['servers']:
                 target['servers'].append(s)
             for gd in body['gitdeploys']:
@@ -861,52 +910,115 @@ class DeploymentContainerView(GenericView):
                 if not init_servers.issuperset(req_servers):
                     uninit_gd[gd] = list(req_servers - init_servers)
             if len(uninit_gd) > 0:
-                return self.Error(400, {"message": "gitdeploy not initialized on servers", "servers": uninit_gd})
+                return None, self.Error(400, {"message": "gitdeploy not initialized on servers", "servers": uninit_gd})
 
         if len(target['servers']) == 0:
-            return self.Error(400, "no servers specified for deployment (are you sure the gitdeploys are initialized?)")
+            return None, self.Error(400, "no servers specified for deployment (are you sure the gitdeploys are initialized?)")
 
         # do a final check to make sure all required packages are present in the build
         gddocs = [self.datasvc.gitsvc.GetGitDeploy(app, gd) for gd in target['gitdeploys']]
         for gd in gddocs:
             if gd['package'] not in build_obj.packages:
-                return self.Error(400, "package {} not found in build {} (required by gitdeploy {})"
-                                  .format(gd['package'], build_name, gd['name']))
+                return None, self.Error(400, "package {} not found in build {} (required by gitdeploy {})"
+                                        .format(gd['package'], build_name, gd['name']))
 
         environments = body['environments'] if 'environments' in body else None
         groups = body['groups'] if 'groups' in body else None
-        dpo = self.datasvc.deploysvc.NewDeployment(app, build_name, environments, groups, target['servers'],
-                                                   target['gitdeploys'], self.get_username(), integer_params)
-        d_id = dpo['NewDeployment']['id']
         target['environments'] = environments if isinstance(environments, list) else None
         target['groups'] = groups if isinstance(groups, list) else None
+        return target, None
+
+    def start_deployment(self, app, build_name, target, options, planned_stages=None, plan_id=None):
+        '''
+        Create deployment object and start the deployment job
+        '''
+        dpo = self.datasvc.deploysvc.NewDeployment(app, build_name, target['environments'], target['groups'],
+                                                   target['servers'], target['gitdeploys'], self.get_username(),
+                                                   dict(options, plan_id=plan_id) if plan_id else options)
+        d_id = dpo['NewDeployment']['id']
         args = {
             'application': app,
             'build_name': build_name,
             'target': target,
-            'rolling_divisor': rolling_divisor,
-            'rolling_pause': rolling_pause,
-            'ordered_pause': ordered_pause,
-            'deployment_id': d_id
+            'rolling_divisor': options['rolling_divisor'],
+            'rolling_pause': options['rolling_pause'],
+            'ordered_pause': options['ordered_pause'],
+            'deployment_id': d_id,
+            'salt_concurrency': options.get('salt_concurrency', dict()),
+            'rolling_strategy': options.get('rolling_strategy'),
+            'planned_stages': planned_stages,
+            'timeouts': options.get('timeouts'),
+            'skip_current': options.get('skip_current', True)
         }
         msg = self.run_async('deploy_{}_{}'.format(app,  build_name), "deployment", args,
-                             elita.deployment.deploy.run_deploy, args)
+                             elita.deployment.deploy.run_deploy, args, application=app)
         self.datasvc.deploysvc.UpdateDeployment(app, d_id, {'status': 'running', 'job_id': msg['job_id']})
         return self.status_ok({
             'deployment': {
-                'deployment_id': dpo['NewDeployment']['id'],
+                'deployment_id': d_id,
                 'application': app,
                 'build': build_name,
-                'environments': environments,
-                'groups': groups,
-                'rolling_divisor': rolling_divisor,
-                'rolling_pause': rolling_pause,
+                'environments': target['environments'],
+                'groups': target['groups'],
+                'rolling_divisor': options['rolling_divisor'],
+                'rolling_pause': options['rolling_pause'],
+                'rolling_strategy': options.get('rolling_strategy', {'name': 'divisor'}),
+                'plan_id': plan_id,
                 'servers': target['servers'],
                 'gitdeploys': target['gitdeploys'],
                 'message': msg
             }
         })
 
+    @validate_parameters(required_params=['build_name'])
+    def POST(self):
+        # we support two different 'styles' of deployment (manual/group), so target calculation/validation is broken
+        # out into get_deployment_target. With plan=true nothing is started: the computed plan is cached and returned,
+        # and can be executed later with plan_id.
+        app = self.context.parent
+        build_name = self.req.params['build_name']
+        if build_name not in self.datasvc.buildsvc.GetBuilds(app):
+            return self.Error(400, "unknown build '{}'".format(build_name))
+        build_doc = self.datasvc.buildsvc.GetBuild(app, build_name)
+        build_obj = dataservice.models.Build(build_doc)
+        if not build_obj.stored:
+            return self.Error(400, "no stored data for build: {} (stored == false)".format(build_name))
+
+        if 'plan_id' in self.req.params:
+            plan_id = self.req.params['plan_id']
+            plan = self.datasvc.deploysvc.GetPlan(app, plan_id)
+            if not plan:
+                return self.Error(400, "unknown or expired plan_id: {}".format(plan_id))
+            if plan['build_name'] != build_name:
+                return self.Error(400, "plan {} is for build {}".format(plan_id, plan['build_name']))
+            target = plan['target']
+            unknown_servers = self.get_unknown(self.datasvc.serversvc.GetServers(), target['servers'])
+            unknown_gitdeploys = self.get_unknown(self.datasvc.gitsvc.GetGitDeploys(app), target['gitdeploys'])
+            if unknown_servers or unknown_gitdeploys:
+                return self.Error(400, {"message": "plan is stale (servers/gitdeploys no longer exist)",
+                                        "servers": unknown_servers, "gitdeploys": unknown_gitdeploys})
+            planned_stages = elita.deployment.plan.DeploymentPlanner.get_stages(plan) if target['groups'] else None
+            return self.start_deployment(app, build_name, target, plan['options'], planned_stages=planned_stages,
+                                         plan_id=plan_id)
+
+        options, err = self.get_deployment_options()
+        if err:
+            return err
+        try:
+            body = self.req.json_body
+        except:
+            return self.Error(400, "invalid target object (problem deserializing, bad JSON?)")
+        target, err = self.get_deployment_target(app, build_obj, build_name, body)
+        if err:
+            return err
+
+        if 'plan' in self.req.params and self.req.params['plan'] in AFFIRMATIVE_SYNONYMS:
+            plan = elita.deployment.plan.DeploymentPlanner(self.datasvc).plan(app, build_name, target, options)
+            plan['plan_id'] = self.datasvc.deploysvc.SavePlan(app, plan)
+            return self.status_ok({'plan': plan})
+
+        return self.start_deployment(app, build_name, target, options)
+
 
 class DeploymentView(GenericView):
     def __init__(self, context, request):
@@ -932,6 +1044,82 @@ class DeploymentView(GenericView):
             }
         }
 
+    def resume(self):
+        app = self.context.application
+        deployment = self.datasvc.deploysvc.GetDeployment(app, self.context.name)
+        if deployment['status'] == 'complete':
+            return self.Error(400, "deployment is already complete")
+        force = 'force' in self.req.params and self.req.params['force'] in AFFIRMATIVE_SYNONYMS
+        if deployment['status'] in ('running', 'cancelling') and not force:
+            return self.Error(400, "deployment is still running (use force=true if the job died)")
+        if deployment['build_name'] not in self.datasvc.buildsvc.GetBuilds(app):
+            return self.Error(400, "build {} no longer exists".format(deployment['build_name']))
+        if deployment['status'] in ('running', 'cancelling') and deployment.get('job_id'):
+            # the original job may still be queued or running: stop it so two jobs never run the same deployment
+            action.cancel_job(self.datasvc, deployment['job_id'],
+                              "superseded by forced resume of deployment {}".format(self.context.name))
+        options = deployment['options'] if deployment['options'] else dict()
+        target = {
+            'servers': deployment['servers'],
+            'gitdeploys': deployment['gitdeploys'],
+            'environments': deployment['environments'],
+            'groups': deployment['groups']
+        }
+        args = {
+            'application': app,
+            'build_name': deployment['build_name'],
+            'target': target,
+            'rolling_divisor': options.get('rolling_divisor', 2),
+            'rolling_pause': options.get('rolling_pause', 0),
+            'ordered_pause': options.get('ordered_pause', 0),
+            'deployment_id': self.context.name,
+            'salt_concurrency': options.get('salt_concurrency', dict()),
+            'rolling_strategy': options.get('rolling_strategy'),
+            'resume': True,
+            'timeouts': options.get('timeouts'),
+            'skip_current': options.get('skip_current', True)
+        }
+        # clear any previous cancel request so the resumed job doesn't stop immediately
+        self.datasvc.deploysvc.UpdateDeployment(app, self.context.name, {'cancel_requested_datetime': None})
+        msg = self.run_async('deploy_{}_{}'.format(app, deployment['build_name']), "deployment", args,
+                             elita.deployment.deploy.run_deploy, args, application=app)
+        self.datasvc.deploysvc.UpdateDeployment(app, self.context.name, {'status': 'running', 'job_id': msg['job_id']})
+        checkpoint = self.datasvc.deploysvc.GetCheckpoint(app, self.context.name)
+        return self.status_ok({
+            'resumed_deployment': {
+                'deployment_id': self.context.name,
+                'application': app,
+                'build': deployment['build_name'],
+                'completed_batches': sorted([b for b in checkpoint['batches'] if checkpoint['batches'][b].get('complete')]),
+                'prepared_gitrepos': checkpoint['gitrepos'].keys(),
+                'message': msg
+            }
+        })
+
+    def cancel(self):
+        app = self.context.application
+        deployment = self.datasvc.deploysvc.GetDeployment(app, self.context.name)
+        if deployment['status'] not in ('running', 'cancelling'):
+            return self.Error(400, "deployment is not running (status: {})".format(deployment['status']))
+        self.datasvc.deploysvc.RequestCancel(app, self.context.name)
+        return self.status_ok({
+            'cancelled_deployment': {
+                'deployment_id': self.context.name,
+                'application': app,
+                'build': deployment['build_name'],
+                'job_id': deployment['job_id'],
+                'message': "cancel requested; no further batches will be started and in-flight work will be "
+                           "terminated (status will change to 'cancelled')"
+            }
+        })
+
+    def POST(self):
+        if 'resume' in self.req.params and self.req.params['resume'] in AFFIRMATIVE_SYNONYMS:
+            return self.resume()
+        if 'cancel' in self.req.params and self.req.params['cancel'] in AFFIRMATIVE_SYNONYMS:
+            return self.cancel()
+        return self.Error(400, "no operation requested (resume, cancel)")
+
 
 class KeyPairContainerView(GenericView):
     def __init__(self, context, request):
@@ -1260,10 +1448,20 @@ class GitDeployContainerView(GenericView):
             return self.Error(500, {"NewGitDeploy": res})
         gd = self.datasvc.gitsvc.GetGitDeploy(app, name)
         args = {'gitdeploy': gd}
-        msg = self.run_async("create_gitdeploy", "async", {'gitdeploy': gd['name']},
-                             elita.deployment.gitservice.create_gitdeploy, args)
+        msg = self.run_async("create_gitdeploy", "gitdeploy", {'gitdeploy': gd['name']},
+                             elita.deployment.gitservice.create_gitdeploy, args, application=app)
         return self.status_ok({'create_gitdeploy': {'name': name, 'message': msg}})
 
+    @validate_parameters(required_params=['regenerate_sls'])
+    def POST(self):
+        if self.req.params['regenerate_sls'] not in AFFIRMATIVE_SYNONYMS:
+            return self.Error(400, "no operation requested (regenerate_sls)")
+        app = self.context.parent
+        msg = self.run_async("regenerate_gitdeploy_sls", "gitdeploy", {'application': app},
+                             elita.deployment.gitservice.regenerate_gitdeploy_sls, {'application': app},
+                             application=app)
+        return self.status_ok({'regenerate_sls': {'application': app, 'message': msg}})
+
 
 class GitDeployView(GenericView):
     def __init__(self, context, request):
@@ -1309,8 +1507,9 @@ class GitDeployView(GenericView):
             'application': self.context.application,
             'servers': self.servers
         }
-        msg = self.run_async('initialize_gitdeploy_servers', "async", job_data,
-                             elita.deployment.gitservice.initialize_gitdeploy, args)
+        msg = self.run_async('initialize_gitdeploy_servers', "gitdeploy", job_data,
+                             elita.deployment.gitservice.initialize_gitdeploy, args,
+                             application=self.context.application)
         return self.status_ok({
             'initialize_gitdeploy': {
                 'application': self.context.application,
@@ -1333,8 +1532,9 @@ class GitDeployView(GenericView):
             'application': self.context.application,
             'servers': self.servers
         }
-        msg = self.run_async('deinitialize_gitdeploy_servers', "async", job_data,
-                             elita.deployment.gitservice.deinitialize_gitdeploy, args)
+        msg = self.run_async('deinitialize_gitdeploy_servers', "gitdeploy", job_data,
+                             elita.deployment.gitservice.deinitialize_gitdeploy, args,
+                             application=self.context.application)
         return self.status_ok({
             'deinitialize_gitdeploy': {
                 'application': self.context.application,
@@ -1366,8 +1566,9 @@ class GitDeployView(GenericView):
         gd = self.datasvc.gitsvc.GetGitDeploy(self.context.application, self.context.name)
         return {
             'modified_gitdeploy': self.sanitize_doc_created_datetime(gd),
-            'message': self.run_async("create_gitdeploy", "async", {'gitdeploy': gd['name']},
-                             elita.deployment.gitservice.create_gitdeploy, {'gitdeploy': gd})
+            'message': self.run_async("create_gitdeploy", "gitdeploy", {'gitdeploy': gd['name']},
+                             elita.deployment.gitservice.create_gitdeploy, {'gitdeploy': gd},
+                             application=self.context.application)
         }
 
     def DELETE(self):
@@ -1386,8 +1587,9 @@ class GitDeployView(GenericView):
                 self.datasvc.appsvc.DeleteGroup(self.context.application, g)
             groups_deleted = True
 
-        msg = self.run_async('remove_deinitialize_gitdeploy', "async", {'gitdeploy': gddoc['name']},
-                             elita.deployment.gitservice.remove_and_deinitialize_gitdeploy, args)
+        msg = self.run_async('remove_deinitialize_gitdeploy', "gitdeploy", {'gitdeploy': gddoc['name']},
+                             elita.deployment.gitservice.remove_and_deinitialize_gitdeploy, args,
+                             application=gddoc['application'])
         status_msg = {
             'delete_deinitialize_gitdeploy': {
                 'application': gddoc['application'],
@@ -1660,14 +1862,22 @@ class JobView(GenericView):
             'job_id': str(self.context.job_id),
             'name': self.context.name,
             'job_type': self.context.job_type,
+            'application': self.context.application,
             'data': self.context.data,
             'created_datetime': self.get_created_datetime_text(),
             'status': self.context.status,
         }
+        if self.context.started_datetime is not None:
+            ret['started_datetime'] = self.context.started_datetime.isoformat(' ')
+            ret['wait_in_seconds'] = self.context.wait_in_seconds
         if self.context.completed_datetime is not None:
             ret['completed_datetime'] = self.context.completed_datetime.isoformat(' ')
         if self.context.duration_in_seconds is not None:
             ret['duration_in_seconds'] = self.context.duration_in_seconds
+        if self.context.salt_jobs:
+            ret['salt_jobs'] = {jid: {k: v.isoformat(' ') if k == 'submitted_datetime' else v
+                                      for k, v in self.context.salt_jobs[jid].iteritems() if k != 'minions'}
+                                for jid in self.context.salt_jobs}
         if 'results' in self.req.params:
             if self.req.params['results'] in AFFIRMATIVE_SYNONYMS:
                 ret['results'] = self.datasvc.jobsvc.GetJobData(self.context.job_id)
@@ -1677,10 +1887,54 @@ class JobContainerView(GenericView):
     def __init__(self, context, request):
         GenericView.__init__(self, context, request)
 
-    @validate_parameters(required_params=['active'])
+    @validate_parameters(optional_params=['active', 'status', 'job_type', 'application', 'offset', 'limit', 'summary',
+                                          'counters', 'queues'])
     def GET(self):
-        active = self.req.params['active'] in AFFIRMATIVE_SYNONYMS
-        return {"jobs": {"active": active, "job_ids": self.datasvc.jobsvc.GetJobs(active=active)}}
+        active = 'active' in self.req.params and self.req.params['active'] in AFFIRMATIVE_SYNONYMS
+        summary = 'summary' in self.req.params and self.req.params['summary'] in AFFIRMATIVE_SYNONYMS
+        counters = 'counters' in self.req.params and self.req.params['counters'] in AFFIRMATIVE_SYNONYMS
+        queues = 'queues' in self.req.params and self.req.params['queues'] in AFFIRMATIVE_SYNONYMS
+        status = self.req.params['status'].split(',') if 'status' in self.req.params else None
+        if status:
+            unknown = self.get_unknown(dataservice.JOB_STATUSES, status)
+            if unknown:
+                return self.Error(400, "unknown status: {}".format(unknown))
+        job_type = self.req.params['job_type'] if 'job_type' in self.req.params else None
+        application = self.req.params['application'] if 'application' in self.req.params else None
+        integer_params = {  # defaults
+            "offset": 0,
+            "limit": dataservice.DEFAULT_JOB_LIST_LIMIT
+        }
+        for p in integer_params.keys():
+            try:
+                if p in self.req.params:
+                    integer_params[p] = int(self.req.params[p])
+            except ValueError:
+                return self.Error(400, "invalid {}".format(p))
+            if integer_params[p] < 0:
+                return self.Error(400, "invalid {}: {}".format(p, integer_params[p]))
+        jobs = self.datasvc.jobsvc.GetJobs(active=active, status=status, job_type=job_type, application=application,
+                                           skip=integer_params['offset'], limit=integer_params['limit'],
+                                           summary=summary)
+        response = {
+            "active": active,
+            "offset": integer_params['offset'],
+            "limit": integer_params['limit'],
+            "total": self.datasvc.jobsvc.GetJobCount(active=active, status=status, job_type=job_type,
+                                                     application=application),
+            "job_ids": [j['job_id'] for j in jobs] if summary else jobs
+        }
+        if counters:
+            response['counters'] = self.datasvc.jobsvc.GetJobCounters()
+        if queues:
+            response['queues'] = self.datasvc.jobsvc.GetQueueStats()
+        if summary:
+            for j in jobs:
+                for k in ('created_datetime', 'started_datetime', 'completed_datetime'):
+                    if k in j and j[k] is not None:
+                        j[k] = j[k].isoformat(' ')
+            response['summaries'] = jobs
+        return {"jobs": response}
 
 
 class UserView(GenericView):
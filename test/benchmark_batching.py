@@ -0,0 +1,212 @@
+#benchmark for deployment batch planning (not collected by py.test)
+#usage: python benchmark_batching.py [servers] [groups] [divisor]
+
+import sys
+import time
+import random
+import itertools
+
+import elita.util
+import elita.util.type_check
+from elita.deployment.deploy import BatchCompute
+
+
+class LegacyBatchCompute:
+    '''
+        Given a list of application groups that require rolling deployment and an (optional) list that do not,
+        compute the optimal batches of server/gitdeploy pairs. All non-rolling groups are added to the first batch.
+        Splitting algorithm is tolerant of outrageously large rolling_divisors.
+
+        Original implementation (before index arrays), kept as the reference for output equivalence and timings.
+    '''
+
+    @staticmethod
+    def add_nonrolling_groups(batches, nonrolling_docs):
+        '''
+        Add servers and gitdeploys from nonrolling groups to the first batch
+        Not written in a functional style because that was totally unreadable
+        '''
+        if nonrolling_docs and len(nonrolling_docs) > 0:
+            assert all(map(lambda x: 'servers' in x and 'gitdeploys' in x, batches)) or not batches
+            assert all(map(lambda x: 'servers' in x[1] and 'gitdeploys' in x[1], nonrolling_docs.iteritems()))
+            non_rolling_batches = list()
+            for g in nonrolling_docs:
+                servers = nonrolling_docs[g]['servers']
+                gitdeploys = nonrolling_docs[g]['gitdeploys']
+                ordered = isinstance(nonrolling_docs[g]['gitdeploys'][0], list)
+                if ordered:
+                    for i, gdb in enumerate(nonrolling_docs[g]['gitdeploys']):
+                        if i > len(non_rolling_batches)-1:
+                            non_rolling_batches.append({'gitdeploys': gdb, 'servers': servers})
+                        else:
+                            non_rolling_batches[i]['servers'] = list(set(servers + non_rolling_batches[i]['servers']))
+                            non_rolling_batches[i]['gitdeploys'] = list(set(gdb + non_rolling_batches[i]['gitdeploys']))
+                        if i == len(nonrolling_docs[g]['gitdeploys'])-1:
+                            non_rolling_batches[i]['ordered_gitdeploy'] = False
+                        else:
+                            non_rolling_batches[i]['ordered_gitdeploy'] = True
+                else:
+                    non_rolling_batches.append({'gitdeploys': gitdeploys, 'servers': servers, 'ordered_gitdeploy': False})
+            for i, nrb in enumerate(non_rolling_batches):
+                if i > len(batches)-1:
+                    batches.append(nrb)
+                else:
+                    batches[i]['servers'] = list(set(nrb['servers'] + batches[i]['servers']))
+                    batches[i]['gitdeploys'] = list(set(nrb['gitdeploys'] + batches[i]['gitdeploys']))
+                    batches[i]['ordered_gitdeploy'] = nrb['ordered_gitdeploy']
+        return batches
+
+    @staticmethod
+    def dedupe_batches(batches):
+        '''
+        Dedupe servers and gitdeploys list in the combined batches list:
+        [
+            { "servers": [ "server1", "server1", ...], "gitdeploys": [ "gd1", "gd1", ...] },  #batch 0 (all groups)
+            { "servers": [ "server1", "server1", ...], "gitdeploys": [ "gd1", "gd1", ...] },  #batch 1 (all groups)
+            ...
+        ]
+        '''
+        assert len(batches) > 0
+        assert all(map(lambda x: 'servers' in x and 'gitdeploys' in x, batches))
+        return map(lambda x: {"servers": list(set(x['servers'])),
+                              "gitdeploys": list(set(elita.util.flatten_list(x['gitdeploys']))),
+                              "ordered_gitdeploy": x['ordered_gitdeploy']}, batches)
+
+    @staticmethod
+    def reduce_group_batches(accumulated, update):
+        assert 'servers' in accumulated and 'servers' in update
+        assert 'gitdeploys' in accumulated and 'gitdeploys' in update
+        return {
+            "servers": accumulated['servers'] + update['servers'],
+            "gitdeploys": accumulated['gitdeploys'] + update['gitdeploys']
+        }
+
+    @staticmethod
+    def coalesce_batches(batches):
+        '''
+        Combine the big list of batches into a single list.
+
+        Function is passed a list of lists:
+        [
+            [ { "servers": [...], "gitdeploys": [...] }, ... ],     # batches 0-n for group A
+            [ { "servers": [...], "gitdeploys": [...] }, ... ],     # batches 0-n for broup B
+            ...
+        ]
+
+        Each nested list represents the computed batches for an individual group. All nested lists are expected to be
+        the same length.
+        '''
+        if not batches:
+            return list()
+
+        return map(
+            lambda batch_aggregate: reduce(
+                lambda acc, upd:
+                {
+                    'servers': acc['servers'] + upd['servers'],
+                    'gitdeploys': acc['gitdeploys'] + upd['gitdeploys'],
+                    'ordered_gitdeploy': acc['ordered_gitdeploy'] and upd['ordered_gitdeploy']
+                }, batch_aggregate
+            ), itertools.izip_longest(*batches, fillvalue={"servers": [], "gitdeploys": [], "ordered_gitdeploy": False}))
+
+    @staticmethod
+    def compute_group_batches(divisor, group):
+        '''
+        Compute batches for group.
+        Group is iteritems() result from group dict. group[0] is key (name), group[1] is dict of servers/gitdeploys
+
+        return list of dicts: [ { 'servers': [...], 'gitdeploys': [...] }, ... ]
+        '''
+        assert len(group) == 2
+        assert 'servers' in group[1]
+        assert 'gitdeploys' in group[1]
+
+        servers = group[1]['servers']
+        gitdeploys = group[1]['gitdeploys']
+        server_batches = elita.util.split_seq(servers, divisor)
+        gd_multiplier = len(server_batches)  # gitdeploy_batches multipler
+        ordered = isinstance(gitdeploys[0], list)
+        if ordered:
+            # duplicate all server batches by the length of the gitdeploy list-of-lists
+            server_batches = [x for item in server_batches for x in itertools.repeat(item, len(gitdeploys))]
+            gitdeploy_batches = list(gitdeploys) * gd_multiplier
+            ordered_flags = [True] * (len(gitdeploys) - 1)
+            ordered_flags.append(False)
+            ordered_flags = ordered_flags * gd_multiplier
+        else:
+            gitdeploy_batches = [gitdeploys] * gd_multiplier
+            ordered_flags = [False] * gd_multiplier
+        assert len(gitdeploy_batches) == len(server_batches)
+        batches = [{'servers': sb, 'gitdeploys': gd, 'ordered_gitdeploy': of}
+                   for sb, gd, of in zip(server_batches, gitdeploy_batches, ordered_flags)]
+        return batches
+
+
+    @staticmethod
+    def compute_rolling_batches(divisor, rolling_group_docs, nonrolling_group_docs):
+        assert isinstance(divisor, int)
+        assert elita.util.type_check.is_optional_dict(rolling_group_docs)
+        assert not rolling_group_docs or all(map(lambda x: 'servers' in x[1] and 'gitdeploys' in x[1], rolling_group_docs.iteritems()))
+        return LegacyBatchCompute.dedupe_batches(
+            LegacyBatchCompute.add_nonrolling_groups(
+                LegacyBatchCompute.coalesce_batches(
+                    map(lambda x: LegacyBatchCompute.compute_group_batches(divisor, x), rolling_group_docs.iteritems() if rolling_group_docs else tuple())
+                ), nonrolling_group_docs
+            )
+        )
+
+
+def generate_groups(server_count, group_count, gitdeploy_count=20, ordered_ratio=0.25, nonrolling_ratio=0.2, seed=0):
+    '''
+    Random fleet: servers spread over groups (some servers in more than one group), a mix of ordered/unordered and
+    rolling/non-rolling groups. Returns (rolling_group_docs, nonrolling_group_docs)
+    '''
+    rnd = random.Random(seed)
+    servers = ["server{}".format(i) for i in range(server_count)]
+    gitdeploys = ["gd{}".format(i) for i in range(gitdeploy_count)]
+    rolling = dict()
+    nonrolling = dict()
+    per_group = max(1, server_count / group_count)
+    for g in range(group_count):
+        group_servers = servers[g*per_group:(g+1)*per_group] + rnd.sample(servers, min(len(servers), per_group / 10))
+        if rnd.random() < ordered_ratio:
+            group_gitdeploys = [[gd] for gd in rnd.sample(gitdeploys, rnd.randint(2, 4))]
+        else:
+            group_gitdeploys = rnd.sample(gitdeploys, rnd.randint(1, 5))
+        doc = {'servers': group_servers, 'gitdeploys': group_gitdeploys}
+        if rnd.random() < nonrolling_ratio:
+            nonrolling["group{}".format(g)] = doc
+        else:
+            rolling["group{}".format(g)] = doc
+    return rolling, nonrolling
+
+
+def normalize(batches):
+    return [(sorted(b['servers']), sorted(b['gitdeploys']), b['ordered_gitdeploy']) for b in batches]
+
+
+def timed(func, *args):
+    '''
+    Best of five runs
+    '''
+    best = None
+    for i in range(5):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def run(server_count=10000, group_count=100, divisor=10):
+    rolling, nonrolling = generate_groups(server_count, group_count)
+    new, new_time = timed(BatchCompute.compute_rolling_batches, divisor, rolling, nonrolling)
+    old, old_time = timed(LegacyBatchCompute.compute_rolling_batches, divisor, rolling, nonrolling)
+    assert normalize(new) == normalize(old)
+    print "{} servers, {} groups, divisor {}: {} batches".format(server_count, group_count, divisor, len(new))
+    print "  index planner: {:.3f}s".format(new_time)
+    print "  legacy:        {:.3f}s".format(old_time)
+
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:4]])
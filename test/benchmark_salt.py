@@ -0,0 +1,50 @@
+#benchmark for phase 2 salt fan-out against simulated minions (not collected by py.test)
+#usage: python benchmark_salt.py [minions] [gitdeploys] [latency_ms] [batch]
+
+import sys
+import time
+import tempfile
+
+import mock
+
+from elita.deployment.salt_control import SaltController, RemoteCommands
+from elita.dataservice import DataService, ServerDataService, JobDataService
+
+
+def main():
+    minions = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    gitdeploys = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    latency = sys.argv[3] if len(sys.argv) > 3 else "10-200"
+    batch = sys.argv[4] if len(sys.argv) > 4 else None
+
+    mock_datasvc = mock.Mock(spec=DataService)
+    mock_datasvc.attach_mock(mock.Mock(spec=ServerDataService), "serversvc")
+    mock_datasvc.attach_mock(mock.Mock(spec=JobDataService), "jobsvc")
+    mock_datasvc.settings = {
+        'elita.salt.backend': 'simulated',
+        'elita.salt.slsdir': 'elita',
+        'elita.salt.simulator.latency_ms': latency,
+        'elita.salt.simulator.seed': '1',
+        'elita.salt.simulator.file_root': tempfile.mkdtemp()
+    }
+    rc = RemoteCommands(SaltController(mock_datasvc))
+
+    servers = ["server{}".format(i) for i in range(minions)]
+    sls_map = {"elita.app.gd{}".format(i): servers for i in range(gitdeploys)}
+    first = list()
+
+    def callback(r, arguments, **kwargs):
+        if not first:
+            first.append(time.time())
+
+    start = time.time()
+    res = rc.run_slses_async(callback, sls_map, args={}, batch=batch)
+    elapsed = time.time() - start
+    print "{} returns ({} minions x {} gitdeploys, latency {} ms, batch {})".format(len(res), minions, gitdeploys,
+                                                                                   latency, batch)
+    print "first return: {:.3f}s; total: {:.3f}s; {:.0f} returns/s".format(first[0] - start, elapsed,
+                                                                           len(res) / elapsed)
+
+
+if __name__ == '__main__':
+    main()
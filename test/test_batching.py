@@ -1,6 +1,7 @@
 __author__ = 'bkeroack'
 
 import elita.deployment.deploy
+import benchmark_batching
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
@@ -184,6 +185,63 @@ def test_simulated_scorebig_unordered_groups():
             assert server_batch_mapping[s]['Configs'] < server_batch_mapping[s]['ServiceBusLow']
 
 
+def test_adaptive_batch_sizes():
+    '''
+    Test that adaptive batch sizes grow geometrically and cover exactly the requested number of servers
+    '''
+    sizes = elita.deployment.deploy.BatchCompute.adaptive_batch_sizes(20, 1, 2)
+    assert sizes == [1, 2, 4, 8, 5]
+    assert elita.deployment.deploy.BatchCompute.adaptive_batch_sizes(3, 5, 2) == [3]
+    assert elita.deployment.deploy.BatchCompute.adaptive_batch_sizes(0, 1, 2) == []
+
+def test_adaptive_stages():
+    '''
+    Test that adaptive stages start with a canary per rolling group and put non-rolling groups in the first stage
+    '''
+    stages = elita.deployment.deploy.BatchCompute.compute_adaptive_stages(1, 2, rolling_groups, nonrolling_groups)
+
+    assert len(stages) == 3     # 4 servers per group: 1, 2, 1
+    assert all([len(s) == 1 for s in stages])
+    assert sorted(stages[0][0]['servers']) == sorted(['server0', 'server4', 'server8', 'server9'])
+    assert sorted(stages[1][0]['servers']) == sorted(['server1', 'server2', 'server5', 'server6'])
+    assert sorted(stages[2][0]['servers']) == sorted(['server3', 'server7'])
+    assert sorted(stages[0][0]['gitdeploys']) == sorted(['gd0', 'gd1', 'gd2', 'gd3'])
+
+def test_adaptive_ordered_stages():
+    '''
+    Test that adaptive stages still respect gitdeploy ordering within each stage
+    '''
+    stages = elita.deployment.deploy.BatchCompute.compute_adaptive_stages(1, 2, ordered_groups, None)
+
+    assert len(stages) == 2
+    assert all([len(s) == 2 for s in stages])
+    for s in stages:
+        assert s[0]['gitdeploys'] == ['gd9'] and s[0]['ordered_gitdeploy']
+        assert sorted(s[1]['gitdeploys']) == sorted(['gd4', 'gd5']) and not s[1]['ordered_gitdeploy']
+    assert sorted(stages[0][0]['servers']) == sorted(['server10', 'server12'])
+
+def test_batches_match_legacy_planner():
+    '''
+    Test that the index-array planner produces the same batches as the original list/set implementation on random
+    fleets with mixed ordered/unordered and rolling/non-rolling groups
+    '''
+    for seed in range(10):
+        for divisor in (1, 2, 3, 7, 50):
+            rolling, nonrolling = benchmark_batching.generate_groups(200, 12, seed=seed)
+            new = elita.deployment.deploy.BatchCompute.compute_rolling_batches(divisor, rolling, nonrolling)
+            old = benchmark_batching.LegacyBatchCompute.compute_rolling_batches(divisor, rolling, nonrolling)
+            assert benchmark_batching.normalize(new) == benchmark_batching.normalize(old)
+
+def test_large_fleet_batches():
+    '''
+    Test that 10k servers x 100 groups covers every server
+    '''
+    rolling, nonrolling = benchmark_batching.generate_groups(10000, 100)
+    batches = elita.deployment.deploy.BatchCompute.compute_rolling_batches(10, rolling, nonrolling)
+    all_servers = set([s for g in rolling.values() + nonrolling.values() for s in g['servers']])
+    assert set([s for b in batches for s in b['servers']]) == all_servers
+    assert all([len(b['servers']) == len(set(b['servers'])) for b in batches])
+
 
 if __name__ == '__main__':
     test_rolling_batches()
@@ -1,11 +1,17 @@
 import mock
+import datetime
+import itertools
+import pytz
 #from elita.deployment import deploy, salt_control
 import elita.deployment.deploy
 import elita.deployment.salt_control
+import elita.deployment.plan
 from elita.deployment import gitservice
 from elita.dataservice import DataService, BuildDataService, GitDataService, JobDataService, GroupDataService, \
     DeploymentDataService, ActionService
 from elita.actions.action import RegisterHooks
+from elita.dataservice.mongo_service import MongoService
+from elita.dataservice.progress import ProgressAggregator
 #import logging
 
 
@@ -21,6 +27,10 @@ def return_gitdeploy(app, name):
             "path": "/foo/bar",
             "default_branch": "master"
         },
+        "actions": {
+            "prepull": None,
+            "postpull": None
+        },
         "servers": ["server0", "server1"]
     }
 
@@ -49,6 +59,8 @@ def setup_mock_datasvc():
     mock_datasvc.job_id = "fake_job_id"
     mock_datasvc.gitsvc.GetGitDeploy = return_gitdeploy
     mock_datasvc.buildsvc.GetBuild = return_build
+    mock_datasvc.deploysvc.GetCancelRequest.return_value = None
+    mock_datasvc.deploysvc.GetCommits.return_value = {}
     mock_datasvc.settings = {
         'elita.mongo.host': 'localhost',
         'elita.mongo.port': 0,
@@ -125,6 +137,602 @@ def test_rolling_deployment(mockRD, mockGitDeployManager, mockRemoteCommands, mo
 
     #assert False
 
+@mock.patch('elita.deployment.deploy.time')
+def test_adaptive_rolling_deployment(mock_time):
+    '''
+    Test that adaptive rolling deployments grow batches after healthy stages and replan smaller batches after a slow one
+    '''
+    mock_datasvc = setup_mock_datasvc()
+    mock_datasvc.groupsvc = mock.Mock(spec=GroupDataService)
+    mock_datasvc.groupsvc.GetGroup = lambda app, name: {
+        "rolling_deploy": True,
+        "gitdeploys": ["gd0"],
+        "servers": ["server{}".format(i) for i in range(16)]
+    }
+    mock_datasvc.deploysvc.GetDeployment.return_value = {'status': 'running'}
+    mock_dc = mock.Mock()
+    mock_dc.run.return_value = True, []
+    # (start, end) per batch: stage 2 takes 10s vs 1s for stage 1, so growth should stop
+    mock_time.time.side_effect = [0, 1, 0, 1, 0, 10, 0, 1, 0, 1, 0, 1]
+
+    rdc = elita.deployment.deploy.RollingDeployController(mock_datasvc, mock_dc, 'mock_id')
+    strategy = {'name': 'adaptive', 'canary_size': 1, 'growth_factor': 2}
+    ok = rdc.run("example_app", "example_build", {"groups": ["gp0"], "gitdeploys": ["gd0"]}, 2, 0, 0,
+                 parallel=False, strategy=strategy)
+
+    assert ok
+    sizes = [len(c[0][2]) for c in mock_dc.run.call_args_list]
+    assert sizes == [1, 2, 4, 2, 4, 3]
+    assert sorted([s for c in mock_dc.run.call_args_list for s in c[0][2]]) == \
+        sorted(["server{}".format(i) for i in range(16)])
+    replan = mock_datasvc.deploysvc.InitializeDeploymentPlan.call_args_list[1]
+    assert replan[1]['start_batch'] == 3
+    assert len(replan[0][2]) == 6
+
+@mock.patch('elita.deployment.deploy.time')
+def test_resume_rolling_deployment(mock_time):
+    '''
+    Test that a resumed rolling deployment reuses the checkpointed plan and skips completed batches and gitdeploys
+    '''
+    mock_datasvc = setup_mock_datasvc()
+    mock_datasvc.groupsvc = mock.Mock(spec=GroupDataService)
+    mock_datasvc.groupsvc.GetGroup = return_group
+    mock_datasvc.deploysvc.GetDeployment.return_value = {'status': 'running'}
+    mock_dc = mock.Mock()
+    mock_dc.run.return_value = True, []
+    mock_time.time.return_value = 0
+    batches = [{'servers': ['server{}'.format(i)], 'gitdeploys': ['gd0', 'gd1'], 'ordered_gitdeploy': False}
+               for i in range(3)]
+    checkpoint = {
+        'plan': {'stage_sizes': [3], 'batches': batches},
+        'gitrepos': {'gr0': 'example_build'},
+        'batches': {'batch0': {'complete': True}, 'batch1': {'gitdeploys': {'gd0': True}}}
+    }
+
+    rdc = elita.deployment.deploy.RollingDeployController(mock_datasvc, mock_dc, 'mock_id')
+    ok = rdc.run("example_app", "example_build", {"groups": ["gp0", "gp1"], "gitdeploys": ["gd0", "gd1"]}, 2, 0, 0,
+                 parallel=False, checkpoint=checkpoint)
+
+    assert ok
+    calls = [(c[0][2], c[0][3], c[1]['batch_number']) for c in mock_dc.run.call_args_list]
+    assert calls == [(['server1'], ['gd1'], 1), (['server2'], ['gd0', 'gd1'], 2)]
+    assert [c[0][2] for c in mock_datasvc.deploysvc.CheckpointBatch.call_args_list] == [1, 2]
+    assert not mock_datasvc.deploysvc.InitializeDeploymentPlan.called
+    assert "AUTO_DEPLOYMENT_START" not in [c[0][1] for c in mock_datasvc.actionsvc.hooks.run_hook.call_args_list]
+
+    dc = elita.deployment.deploy.DeployController(mock_datasvc, 'mock_id')
+    dc.restore_checkpoint('example_build', checkpoint)
+    dc.restore_checkpoint('other_build', checkpoint)
+    assert dc.prepared_gitrepos == {'example_build': set(['gr0']), 'other_build': set()}
+
+def test_cancel_rolling_deployment():
+    '''
+    Test that a rolling deployment stops scheduling batches once a cancel is requested
+    '''
+    mock_datasvc = setup_mock_datasvc()
+    mock_datasvc.groupsvc = mock.Mock(spec=GroupDataService)
+    mock_datasvc.groupsvc.GetGroup = lambda app, name: {
+        "rolling_deploy": True,
+        "gitdeploys": ["gd0"],
+        "servers": ["server{}".format(i) for i in range(4)]
+    }
+    mock_datasvc.deploysvc.GetDeployment.return_value = {'status': 'running'}
+    mock_dc = mock.Mock()
+    mock_dc.run.return_value = True, []
+    requested = datetime.datetime.now(tz=pytz.utc)
+    mock_dc.check_cancelled.side_effect = [None, elita.deployment.deploy.DeploymentCancelled(requested)]
+
+    rdc = elita.deployment.deploy.RollingDeployController(mock_datasvc, mock_dc, 'mock_id')
+    try:
+        rdc.run("example_app", "example_build", {"groups": ["gp0"], "gitdeploys": ["gd0"]}, 4, 0, 0, parallel=False)
+        assert False
+    except elita.deployment.deploy.DeploymentCancelled as e:
+        assert e.requested_datetime == requested
+    assert mock_dc.run.call_count == 1
+    assert mock_dc.pause.call_count == 1
+
+@mock.patch('elita.deployment.salt_control.SaltController')
+@mock.patch('elita.deployment.salt_control.RemoteCommands')
+@mock.patch('elita.deployment.deploy.time')
+def test_cancel_in_flight_tasks(mock_time, mockRemoteCommands, mockSaltController):
+    '''
+    Test that waiting on phase 1 tasks notices a cancel request and marks in-flight work as cancelled
+    '''
+    mock_datasvc = setup_mock_datasvc()
+    mock_datasvc.deploysvc.GetCancelRequest.side_effect = [None, datetime.datetime.now(tz=pytz.utc)]
+    mockRemoteCommands.return_value.ping.return_value = {"server0": True}
+    mock_time.time.side_effect = itertools.count()
+    dc = elita.deployment.deploy.DeployController(mock_datasvc, 'mock_id')
+    dc.pool = mock.Mock()
+    dc.pool.parallel = True
+    dc.pool.submit.return_value.ready.return_value = False
+
+    try:
+        dc.run("example_app", "example_build", ["server0"], ["gd0"])
+        assert False
+    except elita.deployment.deploy.DeploymentCancelled:
+        pass
+    assert mock_datasvc.deploysvc.GetCancelRequest.call_count == 2
+    mock_datasvc.deploysvc.UpdateDeployment_Phase1.assert_called_with("example_app", 'mock_id', "gr0",
+                                                                      step="CANCELLED")
+
+@mock.patch('elita.deployment.deploy.DeployController')
+def test_run_deploy_cancelled(mockDeployController):
+    '''
+    Test that a cancelled deployment terminates the worker pool and records the cancellation latency
+    '''
+    mock_datasvc = setup_mock_datasvc()
+    requested = datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(seconds=5)
+    mock_dc = mockDeployController.return_value
+    mock_dc.run.side_effect = elita.deployment.deploy.DeploymentCancelled(requested.replace(tzinfo=None))
+
+    ret = elita.deployment.deploy.run_deploy(mock_datasvc, "example_app", "example_build",
+                                             {"servers": ["server0"], "gitdeploys": ["gd0"], "groups": None},
+                                             2, 0, 0, 'mock_id', timeouts={'task': 30})
+
+    assert ret['deploy_status'] == 'cancelled'
+    assert 5 <= ret['cancellation_latency_in_seconds'] < 60
+    assert mockDeployController.call_args[1]['timeouts'] == {'task': 30}
+    mock_dc.close.assert_called_once_with(terminate=True)
+    args = mock_datasvc.deploysvc.CancelDeployment.call_args[0]
+    assert args[:2] == ("example_app", 'mock_id') and args[2] == ret['cancellation_latency_in_seconds']
+    assert not mock_datasvc.deploysvc.CompleteDeployment.called
+
+@mock.patch('elita.deployment.salt_control.SaltController')
+@mock.patch('elita.deployment.salt_control.RemoteCommands')
+def test_connectivity_preflight(mockRemoteCommands, mockSaltController):
+    '''
+    Test that the preflight pings the union of servers once, retries only missing servers, caches reachable servers
+    and reports unreachable servers once per gitdeploy
+    '''
+    mock_datasvc = setup_mock_datasvc()
+    mock_rc = mockRemoteCommands.return_value
+    mock_rc.ping.side_effect = lambda servers, timeout: {s: True for s in servers if s != "server3"}
+    dc = elita.deployment.deploy.DeployController(mock_datasvc, 'mock_id')
+
+    assert dc.preflight("example_app", {"gd0": ["server0", "server1"], "gd1": ["server1", "server2"]}, 0, 10)
+    assert [c[0][0] for c in mock_rc.ping.call_args_list] == [["server0", "server1", "server2"]]
+
+    ok = dc.preflight("example_app", {"gd0": ["server1", "server3"], "gd1": ["server2", "server3"]}, 1, 5)
+    assert not ok
+    assert [c[0][0] for c in mock_rc.ping.call_args_list[1:]] == [["server3"]] * 3
+    assert all([c[1]['timeout'] == 5 for c in mock_rc.ping.call_args_list[1:]])
+    reported = sorted([(c[0][2], c[0][3]) for c in mock_datasvc.deploysvc.UpdateDeployment_Phase2.call_args_list])
+    assert reported == [("gd0", ["server3"]), ("gd1", ["server3"])]
+    assert mock_datasvc.deploysvc.FailDeployment.call_count == 1
+
+def test_deployment_timeouts():
+    '''
+    Test that timeouts come from the ini and can be overridden per deployment and per gitdeploy
+    '''
+    settings = {'elita.deployment.state_timeout': '300'}
+    assert elita.deployment.deploy.get_timeouts(settings) == {'task': 150, 'state': 300, 'ping': 10}
+    assert elita.deployment.deploy.get_timeouts(settings, {'ping': 5}) == {'task': 150, 'state': 300, 'ping': 5}
+
+    mock_datasvc = setup_mock_datasvc()
+    dc = elita.deployment.deploy.DeployController(mock_datasvc, 'mock_id', timeouts={'task': 60})
+    assert dc.task_timeout == 60
+    assert dc.gitdeploy_timeouts({'options': {'timeouts': {'state': 1200}}}) == {'task': 60, 'state': 1200, 'ping': 10}
+    assert dc.gitdeploy_timeouts({'options': {}}) == dc.timeouts
+
+def test_deployment_plan():
+    '''
+    Test that the deployment planner returns batches, gitrepo changes and an estimated duration without side effects
+    '''
+    mock_datasvc = setup_mock_datasvc()
+    mock_datasvc.groupsvc = mock.Mock(spec=GroupDataService)
+    mock_datasvc.groupsvc.GetGroup = return_group
+    mock_datasvc.buildsvc.GetBuilds.return_value = ['old_build', 'new_build']
+    manifests = {
+        'old_build': [['a.txt', '1'], ['b.txt', '1'], ['c.txt', '1']],
+        'new_build': [['a.txt', '1'], ['b.txt', '2'], ['d.txt', '1']]
+    }
+    mock_datasvc.buildsvc.GetPackageManifest = lambda app, build, pkg: manifests[build]
+    mock_datasvc.gitsvc.GetGitDeploy = lambda app, name: dict(return_gitdeploy(app, name), location={
+        'gitrepo': {'name': 'gr0', 'last_build': 'old_build'}, 'path': '/foo/bar'})
+    mock_datasvc.deploysvc.GetBatchTimings.return_value = [10.0, 30.0, 20.0]
+
+    planner = elita.deployment.plan.DeploymentPlanner(mock_datasvc)
+    target = {'servers': ['server0', 'server1', 'server2', 'server3'], 'gitdeploys': ['gd0', 'gd1', 'gd2', 'gd3'],
+              'environments': ['testing'], 'groups': ['gp0', 'gp1']}
+    plan = planner.plan('example_app', 'new_build', target, {'rolling_divisor': 2, 'rolling_pause': 5,
+                                                             'ordered_pause': 0})
+
+    assert plan['strategy'] == 'divisor'
+    assert len(plan['batches']) == 2 and plan['stage_sizes'] == [2]
+    assert sorted(plan['batches'][0]['servers']) == ['server0', 'server2', 'server3']
+    assert plan['gitrepos']['gr0']['changed']
+    assert sorted(plan['gitrepos']['gr0']['gitdeploys']) == target['gitdeploys']
+    assert plan['gitrepos']['gr0']['changed_files'] == {'added': ['d.txt'], 'modified': ['b.txt'],
+                                                        'removed': ['c.txt']}
+    assert plan['estimated_duration_in_seconds'] == 20.0 * 2 + 5
+    assert elita.deployment.plan.DeploymentPlanner.get_stages(plan) == [plan['batches']]
+    assert not mock_datasvc.deploysvc.NewDeployment.called
+    assert not mock_datasvc.deploysvc.InitializeDeploymentPlan.called
+
+@mock.patch('elita.deployment.salt_control.SaltController')
+@mock.patch('elita.deployment.salt_control.RemoteCommands')
+@mock.patch('elita.deployment.deploy.regen_datasvc')
+def test_deployment_worker_pool(mockRD, mockRemoteCommands, mockSaltController):
+    '''
+    Test that the deployment worker pool runs tasks on a bounded set of warm workers (and synchronously if not parallel)
+    '''
+    mockRD.return_value = None, setup_mock_datasvc()
+
+    pool = elita.deployment.deploy.DeploymentWorkerPool({'elita.deployment.workers': 2}, 'fake_job_id')
+    results = [pool.submit(sum, ([i, i],)) for i in range(0, 10)]
+    assert [r.get(10) for r in results] == [i*2 for i in range(0, 10)]
+    pool.close()
+
+    pool = elita.deployment.deploy.DeploymentWorkerPool({}, 'fake_job_id', parallel=False)
+    assert pool.submit(sum, ([1, 2],)).get() == 3
+    result = pool.submit(int, ("not_an_int",))
+    try:
+        result.get()
+        assert False
+    except ValueError:
+        pass
+    pool.close()
+
+
+@mock.patch('elita.deployment.salt_control.SaltController')
+@mock.patch('elita.deployment.salt_control.RemoteCommands')
+@mock.patch('elita.deployment.gitservice.GitDeployManager')
+@mock.patch('elita.deployment.deploy._threadsafe_pull_gitdeploy')
+@mock.patch('elita.deployment.deploy._threadsafe_prepare_pull')
+@mock.patch('elita.deployment.deploy._threadsafe_process_gitdeploy')
+def test_pipelined_phases(mock_process, mock_prepare, mock_pull, mockGitDeployManager, mockRemoteCommands,
+                          mockSaltController):
+    '''
+    Test that each gitdeploy is pulled once its own gitrepo is processed and never if its gitrepo failed
+    '''
+    def return_gitdeploy_own_repo(app, name):
+        gd = return_gitdeploy(app, name)
+        gd['location']['gitrepo']['name'] = "gr_{}".format(name)
+        return gd
+
+    mock_datasvc = setup_mock_datasvc()
+    mock_datasvc.gitsvc.GetGitDeploy = return_gitdeploy_own_repo
+    mockRemoteCommands.return_value.ping.side_effect = lambda servers, timeout: {s: True for s in servers}
+    mock_pull.side_effect = lambda app, gd_struct, *args: {gd: {'errors': False} for gd in gd_struct}
+    mock_prepare.side_effect = lambda app, gd, servers, *args: (servers, [])
+    pulled = lambda: sorted([gd for c in mock_pull.call_args_list for gd in c[0][1]])
+
+    mock_process.return_value = True
+    dc = elita.deployment.deploy.DeployController(mock_datasvc, 'mock_id')
+    assert not dc.combine_states
+    ok, results = dc.run("example_app", "example_build", ["server0", "server1"], ["gd0", "gd1"], parallel=False)
+    assert ok
+    assert mock_process.call_count == 2
+    assert mock_pull.call_count == 2
+    assert pulled() == ["gd0", "gd1"]
+    assert not mock_prepare.called
+
+    # second batch with combine_states: gitrepos were already prepared so only phase 2 runs, as one combined pull
+    mock_pull.reset_mock()
+    dc.combine_states = True
+    ok, results = dc.run("example_app", "example_build", ["server0", "server1"], ["gd0", "gd1"], parallel=False,
+                         batch_number=1)
+    assert ok
+    assert mock_process.call_count == 2
+    assert mock_pull.call_count == 1
+    assert pulled() == ["gd0", "gd1"]
+    # each gitdeploy is prepared by its own pool task and the pull gets their results
+    assert sorted([c[0][1] for c in mock_prepare.call_args_list]) == ["gd0", "gd1"]
+    assert mock_pull.call_args[0][-1] == {"gd0": (["server0", "server1"], []), "gd1": (["server0", "server1"], [])}
+
+    # a prepare whose worker died fails that gitdeploy only: the pull still runs for the other one
+    mock_pull.reset_mock()
+    mock_prepare.side_effect = lambda app, gd, servers, *args: int("died") if gd == "gd1" else (servers, [])
+    ok, results = dc.run("example_app", "example_build", ["server0", "server1"], ["gd0", "gd1"], parallel=False,
+                         batch_number=2)
+    assert mock_pull.call_args[0][-1] == {"gd0": (["server0", "server1"], []), "gd1": None}
+    assert mock_datasvc.deploysvc.FailDeployment.called
+    mock_datasvc.deploysvc.FailDeployment.reset_mock()
+
+    mock_pull.reset_mock()
+    mock_process.side_effect = lambda gddoc, *args: gddoc['name'] != "gd1"
+    ok, results = dc.run("example_app", "example_build2", ["server0", "server1"], ["gd0", "gd1"], parallel=False)
+    assert not ok
+    assert "gd1" not in pulled()
+    assert mock_datasvc.deploysvc.FailDeployment.called
+
+
+def test_progress_aggregator():
+    '''
+    Test that progress updates are coalesced in memory and written as one update on transitions
+    '''
+    mock_mongo = mock.Mock(spec=MongoService)
+    pa = ProgressAggregator(mock_mongo, 'deployments', {'application': 'app', 'name': 'd0'}, 60000)
+
+    pa.update({('progress', 'phase2', 'batch0', 'server0', 'gd0', 'progress'): 10})
+    pa.update({('progress', 'phase2', 'batch0', 'server0', 'gd0', 'progress'): 50,
+               ('progress', 'phase2', 'batch0', 'server1', 'gd0', 'progress'): 50})
+    assert not mock_mongo.modify_multi.called
+
+    pa.update({('progress', 'phase2', 'batch0', 'server2', 'gd0', 'state'): "Complete"}, transition=True)
+    assert mock_mongo.modify_multi.call_count == 1
+    assert mock_mongo.modify_multi.call_args[0][2] == {
+        ('progress', 'phase2', 'batch0', 'server0', 'gd0', 'progress'): 50,
+        ('progress', 'phase2', 'batch0', 'server1', 'gd0', 'progress'): 50,
+        ('progress', 'phase2', 'batch0', 'server2', 'gd0', 'state'): "Complete"
+    }
+
+    # conflicting parent/child paths can't be in the same $set: a new parent replaces pending children...
+    pa.update({('progress', 'phase1', 'gitrepos', 'gr0', 'step'): "foo"})
+    pa.update({('progress', 'phase1', 'gitrepos', 'gr0'): {'step': "bar"}})
+    pa.flush()
+    assert mock_mongo.modify_multi.call_args[0][2] == {('progress', 'phase1', 'gitrepos', 'gr0'): {'step': "bar"}}
+
+    # ...and a new child is merged into a pending parent, keeping its other fields
+    batch = {'state': "running", 'progress': 10}
+    pa.update({('progress', 'phase2', 'batch0'): batch})
+    pa.update({('progress', 'phase2', 'batch0', 'progress'): 50,
+               ('progress', 'phase2', 'batch0', 'gd0', 'state'): "Complete"})
+    pa.flush()
+    assert mock_mongo.modify_multi.call_args[0][2] == {
+        ('progress', 'phase2', 'batch0'): {'state': "running", 'progress': 50, 'gd0': {'state': "Complete"}}
+    }
+    assert batch == {'state': "running", 'progress': 10}
+    pa.flush()
+    assert mock_mongo.modify_multi.call_count == 3
+
+
+def test_salt_concurrency():
+    '''
+    Test resolution of salt concurrency options (ini defaults with per-deployment overrides)
+    '''
+    sc = elita.deployment.salt_control
+    assert sc.get_salt_concurrency({}) == {'max_jobs': 0, 'max_minions': 0, 'batch': None}
+    settings = {'elita.salt.max_jobs': '4', 'elita.salt.batch': '25%'}
+    assert sc.get_salt_concurrency(settings) == {'max_jobs': 4, 'max_minions': 0, 'batch': '25%'}
+    assert sc.get_salt_concurrency(settings, {'max_minions': 100, 'batch': '10'}) == \
+        {'max_jobs': 4, 'max_minions': 100, 'batch': '10'}
+
+    limiter = sc.SaltJobLimiter(max_jobs=1, max_minions=2)
+    limiter.acquire(2)
+    assert not limiter.jobs.acquire(False)
+    assert limiter.minions.value == 2
+    limiter.release(2)
+    assert limiter.jobs.acquire(False)
+    assert limiter.minions.value == 0
+
+    # minions are claimed all at once: a caller that needs more than are free waits for a release
+    import threading
+    limiter = sc.SaltJobLimiter(max_minions=3)
+    limiter.acquire(2)
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (limiter.acquire(2), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.2)
+    assert limiter.minions.value == 2
+    limiter.release(2)
+    assert acquired.wait(5)
+    waiter.join()
+    assert limiter.minions.value == 2
+
+
+@mock.patch('elita.deployment.salt_control.SaltController')
+@mock.patch('elita.deployment.salt_control.RemoteCommands')
+@mock.patch('elita.deployment.deploy.regen_datasvc')
+def test_pull_max_minions(mockRD, mockRemoteCommands, mockSaltController):
+    '''
+    Test that phase 2 state calls are issued at once with max_minions and a limiter, so salt jobs are split into chunks
+    of at most max_minions servers that wait for limiter slots
+    '''
+    servers = ["server{}".format(i) for i in range(0, 5)]
+    mock_datasvc = setup_mock_datasvc()
+    mockRD.return_value = None, mock_datasvc
+    mock_rc = mockRemoteCommands.return_value
+    mock_rc.ping.return_value = {s: True for s in servers}
+    mock_rc.run_slses_async.return_value = []
+
+    elita.deployment.deploy._threadsafe_pull_gitdeploy("example_app", {"gd0": servers}, mock_datasvc.settings,
+                                                       "fake_job_id", "mock_id", 0,
+                                                       {'max_jobs': 0, 'max_minions': 2, 'batch': '50%'})
+    assert mock_rc.run_slses_async.call_count == 1
+    args, kwargs = mock_rc.run_slses_async.call_args
+    assert args[1].values() == [servers]
+    assert kwargs['max_minions'] == 2
+    assert kwargs['limiter'].max_minions == 2     # not in a pool worker: local limiter
+    assert kwargs['batch'] == '50%'
+    assert kwargs['timeout'] == 600
+    assert mock_rc.ping.call_args[1]['timeout'] == 10
+
+
+@mock.patch('elita.deployment.salt_control.SaltController')
+@mock.patch('elita.deployment.salt_control.RemoteCommands')
+@mock.patch('elita.deployment.deploy.regen_datasvc')
+def test_pull_skips_current_servers(mockRD, mockRemoteCommands, mockSaltController):
+    '''
+    Test that phase 2 only pulls on servers that aren't already at the target commit, and records per-server commits
+    '''
+    servers = ["server0", "server1", "server2"]
+    mock_datasvc = setup_mock_datasvc()
+    mockRD.return_value = None, mock_datasvc
+    mock_rc = mockRemoteCommands.return_value
+    mock_rc.ping.return_value = {s: True for s in servers}
+    mock_rc.get_head_commits.return_value = {"server0": "abc123", "server1": "old456", "server2": "abc123"}
+    mock_rc.run_slses_async.return_value = [{"server1": {"ret": {"gitdeploy|cmd|pull|run": {
+        "result": True, "changes": {"stdout": "", "stderr": "", "retcode": 0}}}}}]
+
+    ret = elita.deployment.deploy._threadsafe_pull_gitdeploy("example_app", {"gd0": servers}, mock_datasvc.settings,
+                                                             "fake_job_id", "mock_id", 0, target_commit="abc123")
+
+    assert ret["gd0"]["skipped"] == ["server0", "server2"]
+    assert not ret["gd0"]["errors"]
+    assert mock_rc.get_head_commits.call_count == 1
+    assert [c[0][1].values()[0] for c in mock_rc.run_slses_async.call_args_list] == [["server1"]]
+    assert [c[0][2:] for c in mock_datasvc.gitsvc.UpdateServerCommits.call_args_list] == \
+        [(["server0", "server2"], "abc123"), (["server1"], "abc123")]
+
+    # everything current: no state calls at all; skip_current=False pulls everything without checking
+    mock_rc.reset_mock()
+    mock_rc.get_head_commits.return_value = {s: "abc123" for s in servers}
+    ret = elita.deployment.deploy._threadsafe_pull_gitdeploy("example_app", {"gd0": servers}, mock_datasvc.settings,
+                                                             "fake_job_id", "mock_id", 0, target_commit="abc123")
+    assert ret["gd0"]["skipped"] == servers
+    assert not mock_rc.run_slses_async.called
+    elita.deployment.deploy._threadsafe_pull_gitdeploy("example_app", {"gd0": servers}, mock_datasvc.settings,
+                                                       "fake_job_id", "mock_id", 0, target_commit="abc123",
+                                                       skip_current=False)
+    assert mock_rc.get_head_commits.call_count == 1
+    assert mock_rc.run_slses_async.call_args[0][1].values()[0] == servers
+
+
+@mock.patch('elita.deployment.salt_control.SaltController')
+@mock.patch('elita.deployment.salt_control.RemoteCommands')
+@mock.patch('elita.deployment.deploy.regen_datasvc')
+def test_pull_current_servers_with_actions(mockRD, mockRemoteCommands, mockSaltController):
+    '''
+    Test that gitdeploys with a postpull action are pulled on current servers too (so the action runs) and that
+    commits are only recorded for servers whose whole state run succeeded
+    '''
+    def return_gitdeploy_postpull(app, name):
+        gd = return_gitdeploy(app, name)
+        gd['actions']['postpull'] = {"restart": {"cmd#run": [{"name": "service webapp restart"}]}}
+        return gd
+
+    def state(result):
+        return {"result": result, "changes": {"stdout": "", "stderr": "", "retcode": 0 if result else 1}}
+
+    servers = ["server0", "server1"]
+    mock_datasvc = setup_mock_datasvc()
+    mock_datasvc.gitsvc.GetGitDeploy = return_gitdeploy_postpull
+    mockRD.return_value = None, mock_datasvc
+    mock_rc = mockRemoteCommands.return_value
+    mock_rc.ping.return_value = {s: True for s in servers}
+    mock_rc.get_head_commits.return_value = {s: "abc123" for s in servers}
+    # server0: pull succeeds but the postpull restart fails
+    mock_rc.run_slses_async.return_value = [
+        {"server0": {"ret": {"cmd_|-gitdeploy_gd0_|-pull_|-run": state(True),
+                             "cmd_|-restart_|-service webapp restart_|-run": state(False)}}},
+        {"server1": {"ret": {"cmd_|-gitdeploy_gd0_|-pull_|-run": state(True),
+                             "cmd_|-restart_|-service webapp restart_|-run": state(True)}}}]
+
+    ret = elita.deployment.deploy._threadsafe_pull_gitdeploy("example_app", {"gd0": servers}, mock_datasvc.settings,
+                                                             "fake_job_id", "mock_id", 0, target_commit="abc123")
+    assert ret["gd0"]["skipped"] == []
+    assert not mock_rc.get_head_commits.called
+    assert mock_rc.run_slses_async.call_args[0][1].values()[0] == servers
+    assert [c[0][2:] for c in mock_datasvc.gitsvc.UpdateServerCommits.call_args_list] == [(["server1"], "abc123")]
+
+
+
+@mock.patch('elita.deployment.salt_control.SaltController')
+@mock.patch('elita.deployment.salt_control.RemoteCommands')
+@mock.patch('elita.deployment.deploy.regen_datasvc')
+def test_pull_combined_states(mockRD, mockRemoteCommands, mockSaltController):
+    '''
+    Test that servers get one state run for all their gitdeploys and that results are attributed to each gitdeploy
+    '''
+    def return_gitdeploy_actions(app, name):
+        gd = return_gitdeploy(app, name)
+        gd['actions'] = {'prepull': {"restart#svc": {"cmd.run": [{"name": "restart"}]}} if name == "gd1" else None,
+                         'postpull': None}
+        return gd
+
+    def state(result):
+        return {"result": result, "changes": {"stdout": "", "stderr": "", "retcode": 0 if result else 1}}
+
+    def run_slses(callback, sls_map, args, batch, timeout, max_minions, limiter):
+        # server2: gd0 pull fails (failhard), so gd1 is never run
+        return [{"server0": {"ret": {"cmd_|-gitdeploy_gd0_|-pull_|-run": state(True)}}},
+                {"server1": {"ret": {"cmd_|-gitdeploy_gd0_|-pull_|-run": state(True),
+                                     "cmd_|-gitdeploy_gd1_|-pull_|-run": state(True),
+                                     "cmd_|-restart.svc_|-restart_|-run": state(True)}}},
+                {"server2": {"ret": {"cmd_|-gitdeploy_gd0_|-pull_|-run": state(False)}}}]
+
+    mock_datasvc = setup_mock_datasvc()
+    mock_datasvc.gitsvc.GetGitDeploy = return_gitdeploy_actions
+    mockRD.return_value = None, mock_datasvc
+    mockSaltController.return_value.get_gitdeploy_entry_name.side_effect = lambda app, gd: "sls.{}.{}".format(app, gd)
+    mock_rc = mockRemoteCommands.return_value
+    mock_rc.run_slses_async.side_effect = run_slses
+
+    ret = elita.deployment.deploy._threadsafe_pull_gitdeploy("example_app", {"gd0": ["server0", "server1", "server2"],
+                                                                             "gd1": ["server1", "server2"]},
+                                                             mock_datasvc.settings, "fake_job_id", "mock_id", 0,
+                                                             connectivity_verified=True)
+    assert mock_rc.run_slses_async.call_count == 1     # every server group in one call
+    assert mock_rc.run_slses_async.call_args[0][1] == {
+        "sls.example_app.gd0": ["server0"], "sls.example_app.gd0,sls.example_app.gd1": ["server1", "server2"]}
+    combined = mock_rc.run_slses_async.call_args[1]['args']['combined']
+    assert combined['states'] == {"gitdeploy_gd0": "gd0", "gitdeploy_gd1": "gd1", "restart.svc": "gd1"}
+
+    assert sorted(ret["gd0"]["success_results"].keys()) == ["server0", "server1"]
+    assert ret["gd0"]["error_results"].keys() == ["server2"]
+    assert ret["gd1"]["success_results"].keys() == ["server1"]
+    assert "not run" in ret["gd1"]["error_results"]["server2"]["comment"]
+    assert all(["restart" not in str(r) for r in ret["gd0"]["raw_results"]])
+    assert not mock_rc.ping.called
+
+    # the callback reports progress per gitdeploy
+    mock_datasvc.deploysvc.reset_mock()
+    elita.deployment.deploy._threadsafe_pull_callback(run_slses(None, {}, None, None, None, 0, None)[2],
+                                                       ["sls.example_app.gd0,sls.example_app.gd1"],
+                                                       datasvc=mock_datasvc, application="example_app",
+                                                       deployment_id="mock_id", batch_number=0, gitdeploy="gd0",
+                                                       combined=combined)
+    assert sorted([c[0][2] for c in mock_datasvc.deploysvc.UpdateDeployment_Phase2.call_args_list]) == ["gd0", "gd1"]
+
+def test_combine_colliding_state_ids():
+    '''
+    Test that gitdeploys declaring the same state ID are never combined into one state run
+    '''
+    def gitdeploy(name, prepull=None, postpull=None):
+        gd = return_gitdeploy("example_app", name)
+        gd['actions'] = {'prepull': prepull, 'postpull': postpull}
+        return gd
+
+    restart = {"cmd#run": [{"name": "service webapp restart"}]}
+    gd_docs = {
+        "gd0": gitdeploy("gd0", postpull={"restart": restart}),
+        "gd1": gitdeploy("gd1", postpull={"restart": restart}),
+        "gd2": gitdeploy("gd2", prepull={"warm#cache": restart}),
+        "gd3": gitdeploy("gd3", postpull={"warm.cache": restart})
+    }
+    assert elita.deployment.deploy._combinable_groups(gd_docs) == [("gd0", "gd2"), ("gd1", "gd3")]
+    assert elita.deployment.deploy._state_owners({gd: gd_docs[gd] for gd in ("gd0", "gd2")}) == {
+        "gitdeploy_gd0": "gd0", "restart": "gd0", "gitdeploy_gd2": "gd2", "warm.cache": "gd2"}
+    try:
+        elita.deployment.deploy._state_owners({gd: gd_docs[gd] for gd in ("gd0", "gd1")})
+        assert False
+    except AssertionError as e:
+        assert "restart" in str(e)
+
+
+@mock.patch('elita.deployment.salt_control.SaltController')
+@mock.patch('elita.deployment.salt_control.RemoteCommands')
+@mock.patch('elita.deployment.deploy.regen_datasvc')
+def test_pull_prepare_failure(mockRD, mockRemoteCommands, mockSaltController):
+    '''
+    Test that a gitdeploy that can't be prepared gets an error result while the other gitdeploys are still pulled
+    '''
+    mock_datasvc = setup_mock_datasvc()
+    mockRD.return_value = None, mock_datasvc
+    mockSaltController.return_value.get_gitdeploy_entry_name.side_effect = lambda app, gd: "sls.{}.{}".format(app, gd)
+    mock_rc = mockRemoteCommands.return_value
+    mock_rc.ping.side_effect = lambda servers, timeout: {s: True for s in servers if s != "server0"}
+    mock_rc.run_slses_async.return_value = [{"server1": {"ret": {"cmd_|-gitdeploy_gd1_|-pull_|-run": {
+        "result": True, "changes": {"stdout": "", "stderr": "", "retcode": 0}}}}}]
+
+    ret = elita.deployment.deploy._threadsafe_pull_gitdeploy("example_app", {"gd0": ["server0"], "gd1": ["server1"]},
+                                                             mock_datasvc.settings, "fake_job_id", "mock_id", 0)
+    assert ret["gd0"]["errors"] and ret["gd0"]["error_results"].keys() == ["server0"]
+    assert not ret["gd1"]["errors"] and ret["gd1"]["success_results"].keys() == ["server1"]
+    assert mock_rc.run_slses_async.call_args[0][1] == {"sls.example_app.gd1": ["server1"]}
+    assert mock_datasvc.deploysvc.FailDeployment.called
+
+    # the same prepare as a separate pool task (combined pulls)
+    timeouts = elita.deployment.deploy.get_timeouts(mock_datasvc.settings)
+    prepare = elita.deployment.deploy._threadsafe_prepare_pull
+    assert prepare("example_app", "gd1", ["server1"], mock_datasvc.settings, "fake_job_id", "mock_id", 0,
+                   timeouts) == (["server1"], [])
+    assert prepare("example_app", "gd0", ["server0"], mock_datasvc.settings, "fake_job_id", "mock_id", 0,
+                   timeouts) is None
+
+
 if __name__ == '__main__':
     test_simple_deployment()
     test_rolling_deployment()
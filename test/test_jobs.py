@@ -0,0 +1,225 @@
+import mock
+import os
+import datetime
+import pytz
+import elita.util
+from elita.actions import action
+from elita.dataservice import DataService, JobDataService, RESULTS_PREVIEW_SIZE
+from elita.dataservice.mongo_service import MongoService
+from elita.dataservice.root_tree import RootTree
+
+
+def test_job_routing():
+    '''
+    Test that builds get their own queue and other job types share the priority queue, deployments first
+    '''
+    settings = {}
+    assert action.get_job_routing(settings, "deployment") == ('elita_jobs', 9)
+    assert action.get_job_routing(settings, "gitdeploy") == ('elita_jobs', 5)
+    assert action.get_job_routing(settings, "build") == ('elita_build', 0)
+    assert action.get_job_routing(settings, "async") == (action.DEFAULT_JOB_QUEUE, action.DEFAULT_JOB_PRIORITY)
+    settings = {
+        'elita.jobs.queue.build': 'slow_builds',
+        'elita.jobs.priority.build': '3'
+    }
+    assert action.get_job_routing(settings, "build") == ('slow_builds', 3)
+
+
+def test_concurrency_limits():
+    '''
+    Test per job type and per application concurrency limits from settings
+    '''
+    assert action.get_concurrency_limits({}, "build", "app0") == (0, 0)
+    settings = {
+        'elita.jobs.concurrency.build': '2',
+        'elita.jobs.app_concurrency': '4',
+        'elita.jobs.app_concurrency.app1': '8'
+    }
+    assert action.get_concurrency_limits(settings, "build", "app0") == (2, 4)
+    assert action.get_concurrency_limits(settings, "build", "app1") == (2, 8)
+    assert action.get_concurrency_limits(settings, "deployment", None) == (0, 4)
+
+
+@mock.patch('elita.actions.action.run_job')
+def test_submit_job(mock_run_job):
+    '''
+    Test that submitting a job records routing on the job object and enqueues on the right queue
+    '''
+    mock_datasvc = mock.Mock(spec=DataService)
+    mock_datasvc.attach_mock(mock.Mock(spec=JobDataService), "jobsvc")
+    mock_datasvc.settings = {}
+    mock_datasvc.jobsvc.NewJob.return_value.job_id = "fake_job_id"
+
+    job_id = action.run_async(mock_datasvc, "deploy_app0_build0", "deployment", {}, None, {}, application="app0")
+
+    assert job_id == "fake_job_id"
+    mock_datasvc.jobsvc.NewJob.assert_called_once_with("deploy_app0_build0", "deployment", {}, application="app0",
+                                                       queue="elita_jobs", priority=9)
+    kwargs = mock_run_job.apply_async.call_args[1]
+    assert kwargs['queue'] == "elita_jobs"
+    assert kwargs['priority'] == 9
+    assert kwargs['task_id'] == "fake_job_id"
+
+
+@mock.patch('elita.celeryinit.celery')
+def test_cancel_job(mock_celery):
+    '''
+    Test that cancelling a job revokes its task and marks it failed without touching finished jobs
+    '''
+    mock_mongo, jobsvc = setup_jobsvc()
+    mock_datasvc = mock.Mock(spec=DataService)
+    mock_datasvc.jobsvc = jobsvc
+
+    action.cancel_job(mock_datasvc, "job0", "superseded")
+    mock_celery.control.revoke.assert_called_once_with("job0", terminate=True)
+    keys, update = mock_mongo.update.call_args_list[0][0][1:]
+    assert keys == {'job_id': "job0", 'status': {'$in': ['queued', 'running']}}
+    assert update['$set']['status'] == "failed" and update['$set']['cancel_reason'] == "superseded"
+    assert mock_mongo.update.call_args_list[1][0][:2] == ('job_slots', {'holders.job_id': "job0"})
+
+def setup_jobsvc(job_id=None):
+    mock_mongo = mock.Mock(spec=MongoService)
+    mock_root = mock.Mock(spec=RootTree)
+    return mock_mongo, JobDataService(mock_mongo, mock_root, {}, job_id=job_id)
+
+
+def test_get_jobs_filters():
+    '''
+    Test that GetJobs builds an indexed, paginated query from its filters
+    '''
+    mock_mongo, jobsvc = setup_jobsvc()
+    mock_mongo.get.return_value = [{'job_id': 'job0'}, {'job_id': 'job1'}]
+
+    assert jobsvc.GetJobs(active=True) == ['job0', 'job1']
+    args, kwargs = mock_mongo.get.call_args
+    assert args[1] == {'status': {'$in': ['queued', 'running']}}
+    assert kwargs['sort'] == [('_id', -1)]
+
+    jobsvc.GetJobs(status=['failed'], job_type="deployment", application="app0", skip=20, limit=10)
+    args, kwargs = mock_mongo.get.call_args
+    assert args[1] == {'status': {'$in': ['failed']}, 'job_type': 'deployment', 'application': 'app0'}
+    assert kwargs['skip'] == 20 and kwargs['limit'] == 10
+
+    jobsvc.GetJobs()
+    assert mock_mongo.get.call_args[0][1] == {}
+
+
+def test_get_job_counters():
+    '''
+    Test aggregation of job counters per job_type
+    '''
+    mock_mongo, jobsvc = setup_jobsvc()
+    mock_mongo.aggregate.return_value = [
+        {'_id': {'job_type': 'deployment', 'status': 'running'}, 'count': 2},
+        {'_id': {'job_type': 'deployment', 'status': 'failed'}, 'count': 1},
+        {'_id': {'job_type': 'build', 'status': 'completed'}, 'count': 5}
+    ]
+    counters = jobsvc.GetJobCounters()
+    assert counters['deployment'] == {'queued': 0, 'running': 2, 'completed': 0, 'failed': 1}
+    assert counters['build'] == {'queued': 0, 'running': 0, 'completed': 5, 'failed': 0}
+    # only active and recently finished jobs are aggregated
+    match = mock_mongo.aggregate.call_args[0][1][0]['$match']
+    assert match['$or'][0] == {'status': {'$in': ['queued', 'running']}}
+    assert '$gte' in match['$or'][1]['completed_datetime']
+
+
+def test_get_queue_stats():
+    '''
+    Test that queue stats only load the fields they need from active jobs
+    '''
+    mock_mongo, jobsvc = setup_jobsvc()
+    created = mock.Mock(generation_time=datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(seconds=30))
+    mock_mongo.get.side_effect = [
+        [{'_id': created, 'job_type': 'build', 'status': 'queued', 'queue': 'elita_build'},
+         {'_id': created, 'job_type': 'build', 'status': 'running', 'queue': 'elita_build'}],
+        [{'wait_in_seconds': 4}, {'wait_in_seconds': 2}]
+    ]
+    stats = jobsvc.GetQueueStats()
+    assert mock_mongo.get.call_args_list[0][1]['fields'] == ['job_type', 'status', 'queue']
+    assert stats['build']['depth'] == 1 and stats['build']['running'] == 1
+    assert stats['build']['oldest_wait_in_seconds'] >= 30
+    assert stats['build']['average_wait_in_seconds'] == 3
+
+
+def test_start_job_slots():
+    '''
+    Test that concurrency slots are claimed atomically and released again if a later cap is reached
+    '''
+    mock_mongo, jobsvc = setup_jobsvc(job_id="job0")
+    mock_mongo.get.return_value = {'_id': mock.Mock(generation_time=datetime.datetime.now(tz=pytz.utc)),
+                                   'job_type': 'build', 'application': 'app0'}
+    mock_mongo.count.return_value = 0
+    mock_mongo.find_and_modify.return_value = {'name': 'job_type.build'}
+
+    assert jobsvc.StartJob(type_limit=2, app_limit=4)
+    claims = [c[0][1] for c in mock_mongo.find_and_modify.call_args_list]
+    assert claims == [{'name': 'job_type.build', 'holders.1': {'$exists': False}},
+                      {'name': 'application.app0', 'holders.3': {'$exists': False}}]
+    assert mock_mongo.modify_multi.call_args[0][2][('status',)] == "running"
+    assert all(['$pull' in c[0][2] and 'holders.job_id' not in c[0][1] for c in mock_mongo.update.call_args_list])
+
+    # application cap reached: the job_type slot is given back and the job stays queued
+    mock_mongo.reset_mock()
+    mock_mongo.find_and_modify.side_effect = [{'name': 'job_type.build'}, None]
+    assert not jobsvc.StartJob(type_limit=2, app_limit=4)
+    assert not mock_mongo.modify_multi.called
+    assert mock_mongo.update.call_args == mock.call('job_slots', {'holders.job_id': 'job0'},
+                                                    {'$pull': {'holders': {'job_id': 'job0'}}}, multi=True)
+
+    # no caps: nothing to claim
+    mock_mongo.reset_mock()
+    assert jobsvc.StartJob()
+    assert not mock_mongo.find_and_modify.called
+
+def test_replace_dict_keys():
+    '''
+    Test single-pass key sanitization returns a sanitized copy and leaves the original alone
+    '''
+    results = {'a.b': {'c.d': [{'e.f': 1}, 'g.h']}, 'i': 'j.k'}
+    sanitized = elita.util.replace_dict_keys(results, '.', '_')
+    assert sanitized == {'a_b': {'c_d': [{'e_f': 1}, 'g.h']}, 'i': 'j.k'}
+    assert 'a.b' in results and 'c.d' in results['a.b']
+
+
+def test_save_job_results():
+    '''
+    Test that job completion is a single update plus a single job_data write and that large results are compressed
+    '''
+    mock_mongo, jobsvc = setup_jobsvc(job_id="job0")
+    jobsvc.job_created_datetime = datetime.datetime.now(tz=pytz.utc)
+
+    jobsvc.SaveJobResults({'error': 'something.bad'})
+    assert not mock_mongo.get.called
+    assert not mock_mongo.modify.called
+    assert mock_mongo.modify_multi.call_count == 1
+    assert mock_mongo.modify_multi.call_args[0][2][('status',)] == "failed"
+    assert mock_mongo.create_new.call_count == 1
+    assert mock_mongo.create_new.call_args[0][3]['data'] == {'completed_results': {'error': 'something.bad'}}
+
+    jobsvc.settings = {'elita.jobs.results_compress_threshold': '10'}
+    results = {'deploy_status': 'done', 'output.log': 'x'*1000}
+    jobsvc.SaveJobResults(results)
+    assert mock_mongo.modify_multi.call_args[0][2][('status',)] == "completed"
+    doc = mock_mongo.create_new.call_args[0][3]
+    assert 'compressed_data' in doc
+    assert jobsvc._decompress_job_data(doc) == {'completed_results': results}
+
+    # incompressible results over the size limit: only a small preview is kept
+    jobsvc.settings = {'elita.jobs.results_compress_threshold': '10', 'elita.jobs.results_max_size': '100'}
+    results = {'output': os.urandom(10000).encode('base64')}
+    jobsvc.SaveJobResults(results)
+    preview = mock_mongo.create_new.call_args[0][3]['data']['completed_results']
+    assert preview['truncated'] and len(preview['preview']) == RESULTS_PREVIEW_SIZE
+
+    # only an explicit 'error' key fails the job
+    jobsvc.SaveJobResults({'step': 'error'})
+    assert mock_mongo.modify_multi.call_args[0][2][('status',)] == "completed"
+
+    # unserializable results are rejected before the job status is changed
+    mock_mongo.reset_mock()
+    try:
+        jobsvc.SaveJobResults({'when': datetime.datetime.now()})
+        assert False
+    except TypeError:
+        pass
+    assert not mock_mongo.modify_multi.called
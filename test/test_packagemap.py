@@ -1,7 +1,7 @@
 #requires package_map_data/build-123.*
 
 import os, zipfile, tarfile, os
-from elita.builds import PackageMapper, SupportedFileType
+from elita.builds import PackageMapper, SupportedFileType, BuildFile
 
 BUILD_BASENAME = "package_map_data/build-123"
 BUILD_ZIP = "{}.zip".format(BUILD_BASENAME)
@@ -120,3 +120,13 @@ def test_packagemap_creates_expected_packages_tbz2():
         with tarfile.open(pname, 'r:bz2') as tf:
             assert set(tf.getnames()) == set(expected_members[p])
         os.unlink(pname)
+
+def test_build_file_manifest():
+    '''
+    Test that zip and tarball manifests list the same files without extracting them
+    '''
+    zip_manifest = BuildFile({'file_type': SupportedFileType.Zip, 'filename': BUILD_ZIP}).get_manifest()
+    tgz_manifest = BuildFile({'file_type': SupportedFileType.TarGz, 'filename': BUILD_TGZ}).get_manifest()
+    assert zip_manifest and tgz_manifest
+    assert [p for p, sig in zip_manifest] == sorted([p for p, sig in tgz_manifest])
+    assert all([not p.endswith('/') for p, sig in zip_manifest])
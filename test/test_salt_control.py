@@ -0,0 +1,219 @@
+import mock
+import elita.deployment.salt_control
+from salt.exceptions import SaltClientError
+from elita.dataservice import DataService, ServerDataService, JobDataService
+
+
+def setup_remote_commands():
+    mock_datasvc = mock.Mock(spec=DataService)
+    mock_datasvc.attach_mock(mock.Mock(spec=ServerDataService), "serversvc")
+    mock_datasvc.attach_mock(mock.Mock(spec=JobDataService), "jobsvc")
+    mock_sc = mock.Mock(spec=elita.deployment.salt_control.SaltController)
+    mock_sc.datasvc = mock_datasvc
+    mock_sc.settings = {'elita.salt.slsdir': 'elita'}
+    return mock_sc, elita.deployment.salt_control.RemoteCommands(mock_sc)
+
+
+def test_grains_inventory():
+    '''
+    Test that OS lookups use cached grains and refresh stale servers with one bulk grains.items call
+    '''
+    mock_sc, rc = setup_remote_commands()
+    serversvc = mock_sc.datasvc.serversvc
+    serversvc.GetServers.return_value = ['server0', 'server1', 'server2']
+    serversvc.GetServerInventory.return_value = {
+        'server0': {'server_type': 'windows', 'grains': {'os': 'Windows'}}
+    }
+    mock_sc.get_grains.return_value = {
+        'server1': {'os': 'Ubuntu', 'kernel': 'Linux', 'ip4_interfaces': {'eth0': ['10.0.0.1']}},
+        'server2': {'os': 'Windows', 'kernel': 'Windows'}
+    }
+
+    res = rc.group_remote_servers_by_os(['server0', 'server1', 'server2'])
+
+    assert res == {'unix': ['server1'], 'windows': ['server0', 'server2']}
+    mock_sc.get_grains.assert_called_once_with(['server1', 'server2'])
+    assert not mock_sc.salt_command.called
+    serversvc.UpdateServerGrains.assert_called_once_with({
+        'server1': {'os': 'Ubuntu', 'kernel': 'Linux'},
+        'server2': {'os': 'Windows', 'kernel': 'Windows'}
+    })
+
+    # refresh ignores the cache
+    mock_sc.get_grains.return_value = {'server0': {'os': 'Ubuntu'}}
+    assert rc.get_inventory(['server0'], refresh=True)['server0']['server_type'] == 'unix'
+    assert serversvc.GetServerInventory.call_count == 1
+
+    # unresponsive minion: no grains, OS unknown
+    mock_sc.get_grains.return_value = {}
+    assert rc.get_os('server3') is None
+    assert rc.get_os_text('server3') == "unknown"
+
+    # servers with unknown OS aren't silently dropped from the groups (and skipped by callers)
+    try:
+        rc.delete_directory(['server0', 'server3'], '/tmp/foo')
+        assert False, "expected FatalSaltError"
+    except elita.deployment.salt_control.FatalSaltError as e:
+        assert 'server3' in str(e)
+    assert not mock_sc.salt_command.called
+
+
+def test_batched_remove():
+    '''
+    Test that removals are one idempotent salt call per OS group regardless of the number of servers
+    '''
+    mock_sc, rc = setup_remote_commands()
+    servers = ['unix{}'.format(i) for i in range(50)] + ['win{}'.format(i) for i in range(50)]
+    mock_sc.datasvc.serversvc.GetServerInventory.return_value = {
+        s: {'server_type': 'windows' if s.startswith('win') else 'unix', 'grains': {}} for s in servers
+    }
+    mock_sc.salt_command.side_effect = lambda target, cmd, arg, opts=None: {s: '' for s in target}
+
+    res = rc.rm_dir_if_exists(servers, '/srv/app')
+
+    assert sorted(res.keys()) == sorted(servers)
+    assert mock_sc.salt_command.call_count == 2
+    unix_call, win_call = mock_sc.salt_command.call_args_list
+    assert len(unix_call[0][0]) == 50 and unix_call[0][2] == ["rm -rf '/srv/app'"]
+    assert len(win_call[0][0]) == 50 and win_call[1]['opts'] == {'shell': 'powershell'}
+
+    # '~' is expanded per server; servers with the same home still share a call
+    mock_sc.salt_command.reset_mock()
+    rc.get_remote_home = mock.Mock(return_value={'unix0': '/home/salt', 'unix1': '/home/salt', 'unix2': '/root'})
+    rc.rm_file_if_exists(['unix0', 'unix1', 'unix2'], '~/.ssh/config')
+    calls = sorted([(c[0][0], c[0][2][0]) for c in mock_sc.salt_command.call_args_list])
+    assert [c[0] for c in calls] == [['unix0', 'unix1'], ['unix2']]
+    assert "/home/salt/.ssh/config" in calls[0][1] and "/root/.ssh/config" in calls[1][1]
+
+
+def test_remote_home_cache():
+    '''
+    Test that home directories come from the server documents and only uncached servers are resolved (in bulk)
+    '''
+    mock_sc, rc = setup_remote_commands()
+    serversvc = mock_sc.datasvc.serversvc
+    serversvc.GetServers.return_value = ['server0', 'server1', 'server2']
+    serversvc.GetRemoteHomes.return_value = {'server0': '/home/salt'}
+    serversvc.GetServerInventory.return_value = {s: {'server_type': 'unix', 'grains': {}}
+                                                 for s in ('server1', 'server2', 'server3')}
+    mock_sc.salt_command.return_value = {'server1': '/root', 'server2': '/root', 'server3': '/root'}
+
+    res = rc.expand_home(['server0', 'server1', 'server2', 'server3'], '~/.ssh')
+
+    assert res == {'server0': '/home/salt/.ssh', 'server1': '/root/.ssh', 'server2': '/root/.ssh',
+                   'server3': '/root/.ssh'}
+    assert mock_sc.salt_command.call_count == 1
+    assert mock_sc.salt_command.call_args[0][0] == ['server1', 'server2', 'server3']
+    serversvc.SetRemoteHomes.assert_called_once_with({'server1': '/root', 'server2': '/root'})
+
+    # paths without '~' don't need homes at all
+    mock_sc.salt_command.reset_mock()
+    assert rc.group_by_expanded_paths(['server0', 'server1'], ['/etc/foo']) == {('/etc/foo',): ['server0', 'server1']}
+    assert not mock_sc.salt_command.called
+
+
+def test_multiplexed_returns():
+    '''
+    Test that returns from all command groups are handled as they arrive rather than one group after another
+    '''
+    import threading
+    import time
+    b_returned = threading.Event()
+
+    def cmd_iter(servers, command, arguments, **kwargs):
+        if arguments == ['a']:
+            # can't finish until the other group's return has been handled
+            b_returned.wait(5)
+            yield {'server0': {'ret': 'a'}}
+        else:
+            yield {'server1': {'ret': 'b'}}
+
+    client_a, client_b = mock.Mock(), mock.Mock()
+    client_a.cmd_iter.side_effect = cmd_iter
+    client_b.cmd_iter.side_effect = cmd_iter
+    mock_datasvc = mock.Mock(spec=DataService)
+    mock_datasvc.settings = {}
+    with mock.patch('elita.deployment.salt_control.salt.client.LocalClient', side_effect=[client_a, client_b]), \
+            mock.patch.object(elita.deployment.salt_control.SaltController, 'load_salt_info'):
+        sc = elita.deployment.salt_control.SaltController(mock_datasvc)
+        calls = list()
+
+        def callback(r, arguments, **kwargs):
+            calls.append((r.keys()[0], arguments, kwargs['tag']))
+            if arguments == ['b']:
+                b_returned.set()
+
+        res = sc.salt_commands_async(callback, {'tag': 1}, [
+            {'command': 'state.sls', 'arguments': ['a'], 'servers': ['server0']},
+            {'command': 'state.sls', 'arguments': ['b'], 'servers': ['server1']}
+        ])
+
+    assert calls == [('server1', ['b'], 1), ('server0', ['a'], 1)]
+    assert len(res) == 2
+
+    # exceptions in any stream are raised to the caller
+    client_a.cmd_iter.side_effect = SaltClientError
+    sc.salt_client = client_a
+    with mock.patch('elita.deployment.salt_control.salt.client.LocalClient', return_value=client_b):
+        try:
+            sc.salt_commands_async(callback, {'tag': 1}, [
+                {'command': 'state.sls', 'arguments': ['a'], 'servers': ['server0']},
+                {'command': 'state.sls', 'arguments': ['b'], 'servers': ['server1']}
+            ])
+            assert False
+        except SaltClientError:
+            pass
+
+    # a fixed pool of max_jobs threads (and clients) handles many groups; clients are only created to run a command
+    active = list()
+    peak = list()
+    lock = threading.Lock()
+
+    def counted_iter(servers, command, arguments, **kwargs):
+        with lock:
+            active.append(arguments)
+            peak.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.remove(arguments)
+        yield {servers[0]: {'ret': arguments[0]}}
+
+    client_a.cmd_iter.side_effect = counted_iter
+    client_b.cmd_iter.side_effect = counted_iter
+    limiter = elita.deployment.salt_control.SaltJobLimiter(max_jobs=2)
+    with mock.patch('elita.deployment.salt_control.salt.client.LocalClient', return_value=client_b) as local_client:
+        res = sc.salt_commands_async(callback, {'tag': 1}, [
+            {'command': 'state.sls', 'arguments': [str(i)], 'servers': ['server{}'.format(i)]} for i in range(20)
+        ], limiter=limiter)
+    assert len(res) == 20
+    assert local_client.call_count == 1
+    assert max(peak) <= 2
+
+    # batch mode gets the same timeout
+    client_a.cmd_batch.return_value = iter([{'server0': 'a'}])
+    res = sc.salt_commands_async(callback, {'tag': 1}, [
+        {'command': 'state.sls', 'arguments': ['a'], 'servers': ['server0']}
+    ], timeout=300, batch='50%')
+    assert res == [{'server0': {'ret': 'a'}}]
+    assert client_a.cmd_batch.call_args[1]['timeout'] == 300
+
+
+def test_sanitize_results():
+    '''
+    Test that salt results are sanitized, checked for errors and size-capped in one pass
+    '''
+    results = {
+        'server0': {'file_|-a.txt_|-/srv/a.txt_|-managed': {'result': True, 'comment': 'ok'}},
+        'server1': ['x' * 30, 'y' * 30]
+    }
+    sanitized, detected_in, truncated = elita.deployment.salt_control.sanitize_results(results, max_size=40)
+    assert detected_in is None and truncated
+    assert sanitized['server0'] == {'file_|-a_txt_|-/srv/a_txt_|-managed': {'result': True, 'comment': 'ok'}}
+    assert sanitized['server1'][0] == 'x' * 30
+    assert sanitized['server1'][1].startswith('y' * 8 + '...[truncated 22 bytes]')
+    assert 'file_|-a.txt_|-/srv/a.txt_|-managed' in results['server0']    # original untouched
+
+    # errors are detected even in output past the size cap
+    sanitized, detected_in, truncated = elita.deployment.salt_control.sanitize_results(
+        {'server0': 'z' * 50, 'server1': 'Traceback (most recent call last)'}, max_size=10)
+    assert detected_in == 'Traceback (most recent call last)'
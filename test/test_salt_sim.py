@@ -0,0 +1,255 @@
+import functools
+import os
+import shutil
+import tempfile
+import mock
+import elita.deployment.salt_control
+from elita.deployment.salt_control import SaltController, RemoteCommands, FatalSaltError
+from elita.deployment.salt_sim import SimulatedLocalClient
+from elita.dataservice import DataService, ServerDataService, JobDataService
+
+
+def with_tmpdir(test):
+    '''
+    Run test with a fresh temporary directory (passed as its only argument) that is removed afterward
+    '''
+    @functools.wraps(test)
+    def wrapper():
+        tmpdir = tempfile.mkdtemp()
+        try:
+            test(tmpdir)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    return wrapper
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def write_file(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def setup_simulated_controller(tmpdir, **settings):
+    mock_datasvc = mock.Mock(spec=DataService)
+    mock_datasvc.attach_mock(mock.Mock(spec=ServerDataService), "serversvc")
+    mock_datasvc.attach_mock(mock.Mock(spec=JobDataService), "jobsvc")
+    mock_datasvc.serversvc.GetServerInventory.return_value = {}
+    mock_datasvc.serversvc.GetServers.return_value = []
+    mock_datasvc.settings = {
+        'elita.salt.backend': 'simulated',
+        'elita.salt.slsdir': 'elita',
+        'elita.salt.simulator.seed': '1',
+        'elita.salt.simulator.file_root': tmpdir,
+        'elita.salt.lock_dir': os.path.join(tmpdir, 'locks')
+    }
+    mock_datasvc.settings.update(settings)
+    sc = SaltController(mock_datasvc)
+    return sc, RemoteCommands(sc)
+
+
+@with_tmpdir
+def test_simulated_backend(tmpdir):
+    '''
+    Test that the simulated backend is selected by settings and answers commands, grains and pings
+    '''
+    sc, rc = setup_simulated_controller(tmpdir, **{'elita.salt.simulator.windows_rate': '0.5',
+                                                  'elita.salt.simulator.unresponsive_rate': '0.1'})
+    assert isinstance(sc.salt_client, SimulatedLocalClient)
+    assert sc.sls_dir == os.path.join(tmpdir, 'salt', 'elita')
+
+    servers = ['server{}'.format(i) for i in range(200)]
+    pinged = rc.ping(servers, timeout=0)
+    assert 150 < len(pinged) < 200     # ~10% unresponsive
+    assert rc.ping(servers, timeout=0) == pinged    # unresponsive minions are stable
+
+    by_os = rc.group_remote_servers_by_os(list(pinged))
+    assert by_os['windows'] and by_os['unix']
+    assert sc.salt_client.cmd(['a'], 'test.ping', expr_form='list') == {'a': True}
+    assert len(sc.salt_client.cmd('sim-0000*', 'test.ping', timeout=0)) <= 10
+
+
+@with_tmpdir
+def test_simulated_deployment_load(tmpdir):
+    '''
+    Test phase 2 style state runs against thousands of simulated minions, with failures reported through callbacks
+    '''
+    sc, rc = setup_simulated_controller(tmpdir, **{'elita.salt.simulator.failure_rate': '0.01'})
+    servers = ['server{}'.format(i) for i in range(3000)]
+    returns = list()
+
+    def callback(r, arguments, **kwargs):
+        returns.append((arguments[0], r.keys()[0], r.values()[0]['ret'].values()[0]['result']))
+
+    res = rc.run_slses_async(callback, {'elita.app.gd0': servers[:1500], 'elita.app.gd1': servers[1500:]}, args={})
+    assert len(res) == len(returns) == 3000
+    assert sorted([r[1] for r in returns]) == sorted(servers)
+    failures = [r for r in returns if not r[2]]
+    assert 0 < len(failures) < 100
+
+    # split into jobs of max_minions servers, each waiting for its own limiter slots
+    limiter = elita.deployment.salt_control.SaltJobLimiter(max_jobs=2, max_minions=100)
+    with mock.patch.object(sc.salt_client, 'cmd_iter', wraps=sc.salt_client.cmd_iter) as cmd_iter:
+        res = rc.run_slses_async(callback, {'elita.app.gd0': servers[:250], 'elita.app.gd1': servers[250:300]},
+                                 args={}, max_minions=100, limiter=limiter)
+    assert len(res) == 300
+    assert sorted([len(c[0][0]) for c in cmd_iter.call_args_list]) == [50, 50, 100, 100]
+    assert limiter.minions.value == 0 and limiter.jobs.acquire(False)
+
+    # batched returns are wrapped to match cmd_iter output
+    res = rc.run_slses_async(callback, {'elita.app.gd0': servers[:100]}, args={}, batch='10%')
+    assert len(res) == 100 and all(['ret' in r.values()[0] for r in res])
+
+    # salt_command error detection sees simulated failures
+    sc.salt_client.failure_rate = 1.0
+    try:
+        rc.run_shell_command(servers[:5], 'ls')
+        assert False
+    except FatalSaltError:
+        pass
+
+
+@with_tmpdir
+def test_fire_and_collect(tmpdir):
+    '''
+    Test that salt jobs are published by JID, recorded on the elita job and collected incrementally from the job cache
+    '''
+    sc, rc = setup_simulated_controller(tmpdir, **{'elita.salt.simulator.latency_ms': '0-50',
+                                                  'elita.salt.poll_interval': '0.01'})
+    jobsvc = sc.datasvc.jobsvc
+    servers = ['server{}'.format(i) for i in range(100)]
+
+    jobs = [sc.submit_job(servers[:50], 'state.highstate', [], timeout=5),
+            sc.submit_job(servers[50:], 'cmd.run', ['git clone x y'], timeout=5)]
+    assert jobs[0]['jid'] != jobs[1]['jid']
+    assert jobsvc.AddSaltJob.call_args_list == [mock.call(jobs[0]['jid'], 'state.highstate', servers[:50], 5),
+                                                mock.call(jobs[1]['jid'], 'cmd.run', servers[50:], 5)]
+    collected = list()
+    res = sc.collect_jobs(jobs, callback=lambda jid, new: collected.append((jid, len(new))))
+
+    assert sorted(res[jobs[0]['jid']].keys()) == sorted(servers[:50])
+    assert sorted(res[jobs[1]['jid']].keys()) == sorted(servers[50:])
+    assert sum([n for jid, n in collected]) == 100
+    assert len(collected) > 2     # returns arrive over several polls
+    assert len([c for c in jobsvc.NewJobData.call_args_list if 'salt_job_returns' in c[0][0]]) == len(collected)
+    jobsvc.UpdateSaltJob.assert_any_call(jobs[0]['jid'], 50, 'complete')
+    jobsvc.UpdateSaltJob.assert_any_call(jobs[1]['jid'], 50, 'complete')
+
+    # unresponsive minions time out; errors are raised after collection
+    sc.salt_client.unresponsive_rate = 1.0
+    job = sc.submit_job(servers[:10], 'cmd.run', ['ls'], timeout=0.05)
+    assert sc.collect_jobs([job]) == {job['jid']: {}}
+    jobsvc.UpdateSaltJob.assert_called_with(job['jid'], 0, 'timeout')
+    sc.salt_client.unresponsive_rate = 0.0
+    sc.salt_client.failure_rate = 1.0
+    try:
+        sc.fire_and_collect(servers[:10], 'cmd.run', ['ls'])
+        assert False
+    except FatalSaltError:
+        pass
+
+
+@with_tmpdir
+def test_content_addressed_staging(tmpdir):
+    '''
+    Test that pushed files are staged once by content hash, pushed in one cp.get_file call and cleaned up when unused
+    '''
+    import hashlib
+    import time
+    sc, rc = setup_simulated_controller(tmpdir, **{'elita.salt.staging_ttl': '0'})
+    sc.datasvc.serversvc.GetRemoteHomes.return_value = {}
+    key = os.path.join(tmpdir, 'key')
+    write_file(key, 'secret')
+    ignore = os.path.join(tmpdir, 'ignore')
+    write_file(ignore, '*.pyc\n')
+    staging = os.path.join(tmpdir, 'salt', 'elita', 'staged')
+    servers = ['server{}'.format(i) for i in range(20)]
+
+    staged = rc.stage_files([key, ignore])
+    with mock.patch('shutil.copyfile') as copyfile:
+        again = rc.stage_files([key])
+    assert not copyfile.called      # already staged: hashed, not copied again
+    digest = hashlib.sha256('secret').hexdigest()
+    assert staged[key][0] == again[key][0] == 'salt://elita/staged/{}'.format(digest)
+    assert read_file(os.path.join(staging, digest)) == 'secret'
+    rc.release_staged_files([staged[p][1] for p in staged])
+    assert os.path.exists(os.path.join(staging, digest))     # still referenced
+    assert not os.path.exists(os.path.join(staging, hashlib.sha256('*.pyc\n').hexdigest()))
+    rc.release_staged_files([again[key][1]])
+    assert [f for f in os.listdir(staging) if not f.startswith('.')] == []
+
+    with mock.patch.object(sc, 'salt_command', wraps=sc.salt_command) as salt_command:
+        rc.push_files(servers, {key: '/root/.ssh/key', ignore: '/srv/app/.gitignore'}, mode='600')
+    pushes = [c for c in salt_command.call_args_list if isinstance(c[0][1], list)]
+    assert len(pushes) == 1
+    assert pushes[0][0][1] == ['cp.get_file', 'file.set_mode', 'cp.get_file', 'file.set_mode']
+    assert [f for f in os.listdir(staging) if not f.startswith('.')] == []
+
+    # with a TTL, unreferenced files are kept for reuse in later pushes; reuse refreshes the TTL
+    sc.settings['elita.salt.staging_ttl'] = '3600'
+    path = os.path.join(staging, digest)
+    rc.release_staged_files([r for p, (uri, r) in rc.stage_files([key]).items()])
+    assert os.path.exists(path)
+    old = time.time() - 7200
+    os.utime(path, (old, old))
+    rc.release_staged_files([r for p, (uri, r) in rc.stage_files([key]).items()])
+    assert os.path.getmtime(path) > old + 3600
+    # files not released by this push are only checked by the periodic sweep
+    os.utime(path, (old, old))
+    rc.release_staged_files([r for p, (uri, r) in rc.stage_files([ignore]).items()])
+    assert os.path.exists(path)
+    os.utime(os.path.join(staging, '.swept'), (old, old))
+    rc.release_staged_files([])
+    assert not os.path.exists(path)
+
+
+@with_tmpdir
+def test_gitdeploy_sls_generation(tmpdir):
+    '''
+    Test that gitdeploy SLS files are rendered from the doc, skipped when unchanged and replaced atomically
+    '''
+    import copy
+    import threading
+    import yaml
+    sc, rc = setup_simulated_controller(tmpdir)
+    gd = {
+        'name': 'WebApp',
+        'application': 'app',
+        'options': {'favor': 'ours', 'ignore-whitespace': 'true'},
+        'location': {'path': '/srv/webapp'},
+        'actions': {
+            'prepull': None,
+            'postpull': {'restart': {'cmd#run': [{'name': 'service webapp restart'}]}}
+        }
+    }
+    original = copy.deepcopy(gd)
+    sls = os.path.join(tmpdir, 'salt', 'elita', 'app', 'WebApp.sls')
+
+    assert sc.new_gitdeploy_yaml(gd)
+    assert gd == original
+    states = yaml.safe_load(read_file(sls))
+    assert states['restart'] == {'cmd.run': [{'name': 'service webapp restart'}, {'order': 'last'}]}
+    assert states['gitdeploy_WebApp']['cmd.run'][1] == {'cwd': '/srv/webapp'}
+    inode = os.stat(sls).st_ino
+    assert not sc.new_gitdeploy_yaml(gd)
+    assert os.stat(sls).st_ino == inode
+
+    # removed actions don't linger; concurrent writers leave one complete file and no temp files
+    gd['actions']['postpull'] = None
+    threads = [threading.Thread(target=sc.new_gitdeploy_yaml, args=(gd,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert os.stat(sls).st_ino != inode
+    assert yaml.safe_load(read_file(sls)).keys() == ['gitdeploy_WebApp']
+    assert os.listdir(os.path.dirname(sls)) == ['WebApp.sls']     # lock files are kept out of the salt tree
+    assert len(os.listdir(os.path.join(tmpdir, 'locks'))) == 1
+
+    res = sc.regenerate_gitdeploy_yaml([gd, dict(gd, name='Other')])
+    assert res == {'written': ['app/Other'], 'unchanged': ['app/WebApp']}
+    sc.rm_gitdeploy_yaml(gd)
+    assert not os.path.exists(sls)